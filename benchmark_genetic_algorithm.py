@@ -0,0 +1,59 @@
+import numpy as np
+import sys
+import time
+import utils_optimizers as uopt
+
+
+def define_ga_benchmark_params():
+    benchmark_params = {}
+    benchmark_params["population_sizes"] = [10**4, 10**5, 10**6]
+    benchmark_params["num_optimization_params"] = 6
+    benchmark_params["num_generations"] = 5
+    benchmark_params["crossover_methods"] = ["single_point", "uniform", "blend", "sbx"]
+    benchmark_params["random_seed"] = 12345
+    return benchmark_params
+
+
+
+def sphere_fitness(X_pop):
+    # cheap stand-in for the surrogate, maximal at 0.3 in every parameter
+    return -np.sum((X_pop - 0.3)**2, axis=1)
+
+
+
+def time_generations(pop_size, crossover_method, benchmark_params):
+    num_params = benchmark_params["num_optimization_params"]
+    pbounds = np.zeros((num_params, 2))
+    pbounds[:,1] = 1.0
+    opt_params = {"random_seed": benchmark_params["random_seed"]}
+    ga_params = uopt.define_genetic_algorithm_params(pop_size, max(2, pop_size // 10), num_params // 2)
+    ga_params["crossover_method"] = crossover_method
+
+    X_pop = uopt.generation_generator(opt_params, 0).random((pop_size, num_params))
+    tic = time.perf_counter()
+    for generation in range(1, benchmark_params["num_generations"] + 1):
+        fitness = sphere_fitness(X_pop)
+        X_pop = uopt.evolve_population(X_pop, fitness, ga_params, pbounds, uopt.generation_generator(opt_params, generation))
+    toc = time.perf_counter()
+    return (toc - tic) / benchmark_params["num_generations"], np.max(sphere_fitness(X_pop))
+
+
+
+def main(argv):
+    benchmark_params = define_ga_benchmark_params()
+    if len(argv) > 1:
+        benchmark_params["population_sizes"] = [int(size) for size in argv[1].split(",")]
+
+    generation_times = {}
+    for pop_size in benchmark_params["population_sizes"]:
+        for crossover_method in benchmark_params["crossover_methods"]:
+            generation_time, best_fitness = time_generations(pop_size, crossover_method, benchmark_params)
+            generation_times[(pop_size, crossover_method)] = generation_time
+            print("Population {}, {} crossover: {:.4f}s per generation, best fitness {:.3e}".format(
+                pop_size, crossover_method, generation_time, best_fitness))
+    return generation_times
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
@@ -0,0 +1,66 @@
+import subprocess
+import sys
+
+
+def define_import_benchmark_params():
+    import_params = {}
+    # module imported: startup budget in seconds
+    import_params["modules"] = {"optimize": 1.0,
+                                "training_data_generation": 1.0,
+                                "utils_deck_generation": 0.5}
+    # these must only be imported on first use, never at start-up
+    import_params["deferred_modules"] = ["tensorflow", "healpy", "scipy", "matplotlib"]
+    import_params["num_repeats"] = 3
+    return import_params
+
+
+
+def time_import(module_name, deferred_modules):
+    # cumulative import time of module_name in a fresh interpreter, and the deferred modules it loaded
+    code = ("import sys, " + module_name + "\n"
+            "print(','.join(m for m in " + repr(deferred_modules) + " if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            capture_output=True, text=True, check=True)
+
+    import_time = 0.0
+    for line in result.stderr.splitlines():
+        columns = line.split("|")
+        # top level imports are not indented in the importtime output
+        if len(columns) == 3 and columns[2].rstrip() == " " + module_name:
+            import_time = float(columns[1]) * 1.0e-6
+    loaded_deferred = [name for name in result.stdout.strip().split(",") if name != ""]
+
+    return import_time, loaded_deferred
+
+
+
+def main(argv):
+    import_params = define_import_benchmark_params()
+    if len(argv) > 1:
+        budget_factor = float(argv[1]) # scale all budgets, e.g. for slow shared nodes
+    else:
+        budget_factor = 1.0
+
+    within_budget = True
+    for module_name, budget in import_params["modules"].items():
+        import_times = []
+        for irepeat in range(import_params["num_repeats"]):
+            import_time, loaded_deferred = time_import(module_name, import_params["deferred_modules"])
+            import_times.append(import_time)
+        best_time = min(import_times)
+
+        print("{}: {:.3f}s (budget {:.3f}s)".format(module_name, best_time, budget * budget_factor))
+        if best_time > budget * budget_factor:
+            print("Import of " + module_name + " is over budget!")
+            within_budget = False
+        if len(loaded_deferred) > 0:
+            print("Import of " + module_name + " loads deferred modules: ", loaded_deferred)
+            within_budget = False
+
+    return within_budget
+
+
+
+if __name__ == "__main__":
+    if not main(sys.argv):
+        sys.exit("Import time benchmark failed")
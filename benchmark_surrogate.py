@@ -0,0 +1,130 @@
+import numpy as np
+import sys
+import time
+import os
+import netcdf_read_write as nrw
+import np_neural_network as npnn
+
+
+def define_surrogate_benchmark_params():
+    benchmark_params = {}
+    benchmark_params["num_examples"] = 100000
+    benchmark_params["input_size"] = 6
+    benchmark_params["output_size"] = 2 * 496
+    benchmark_params["hidden_units"] = 600
+    benchmark_params["use_final_sigmoid"] = 1
+    benchmark_params["parity_tolerance"] = 1.0e-5 # float32 rounding between BLAS implementations
+    benchmark_params["random_seed"] = 12345
+    benchmark_params["precisions"] = ["f4", "f2", "bf16", "i1"]
+    return benchmark_params
+
+
+
+def random_nn_weights(benchmark_params, random_generator):
+    # Glorot normal weights with the shapes used by tfnn.initialize_parameters
+    layer_sizes = [benchmark_params["input_size"], benchmark_params["hidden_units"],
+                   benchmark_params["hidden_units"], benchmark_params["hidden_units"],
+                   benchmark_params["output_size"]]
+    nn_weights = {}
+    for il in range(4):
+        std_dev = np.sqrt(2.0 / (layer_sizes[il] + layer_sizes[il+1]))
+        nn_weights["W"+str(il+1)] = (random_generator.standard_normal((layer_sizes[il+1], layer_sizes[il])) * std_dev).astype(np.float32)
+        nn_weights["b"+str(il+1)] = (random_generator.standard_normal((layer_sizes[il+1], 1)) * std_dev).astype(np.float32)
+    return nn_weights
+
+
+
+def time_inference(apply_function, x_test, nn_weights, use_final_sigmoid):
+    apply_function(x_test[:10,:], nn_weights, use_final_sigmoid) # warm up
+    tic = time.perf_counter()
+    y_pred = apply_function(x_test, nn_weights, use_final_sigmoid)
+    toc = time.perf_counter()
+    return y_pred, np.shape(x_test)[0] / (toc - tic)
+
+
+
+def check_parity(x_test, nn_weights, benchmark_params):
+    # maximum absolute difference between the NumPy and TensorFlow forward passes, and if it is in tolerance
+    import tf_neural_network as tfnn
+
+    y_np, np_throughput = time_inference(npnn.apply_network, x_test, nn_weights, benchmark_params["use_final_sigmoid"])
+    y_tf, tf_throughput = time_inference(tfnn.apply_network, x_test, nn_weights, benchmark_params["use_final_sigmoid"])
+    max_difference = np.max(np.abs(y_np - y_tf))
+
+    print("NumPy throughput: {:.3e} examples/s".format(np_throughput))
+    print("TensorFlow throughput: {:.3e} examples/s".format(tf_throughput))
+    print("Max abs difference NumPy vs TensorFlow: {:.3e}".format(max_difference))
+    return max_difference, max_difference < benchmark_params["parity_tolerance"]
+
+
+
+def precision_report(x_test, y_test, nn_weights, benchmark_params):
+    # error against y_test, throughput and memory of the weights rounded to each storage precision
+    report = {}
+    for precision in benchmark_params["precisions"]:
+        if precision == "i1":
+            precision_weights = npnn.quantise_parameters(nn_weights)
+            weight_bytes = sum(np.asarray(item).nbytes for key, item in precision_weights.items())
+        else:
+            precision_weights = {}
+            weight_bytes = 0
+            for key, item in nn_weights.items():
+                stored, _, _ = nrw.encode_nn_weights(item, precision)
+                precision_weights[key] = nrw.decode_nn_weights(stored, precision)
+                weight_bytes += stored.nbytes
+        y_pred, throughput = time_inference(npnn.apply_network, x_test, precision_weights, benchmark_params["use_final_sigmoid"])
+        mae = np.mean(np.abs(y_pred - y_test))
+        report[precision] = (mae, throughput, weight_bytes)
+        print("{:>5}: MAE {:.4e}, {:.3e} examples/s, weights {:.2f}MB".format(precision, mae, throughput, weight_bytes / 1.0e6))
+    return report
+
+
+
+def held_out_test_set(root_dir, filename_nn_weights):
+    # the same held-out examples and normalisation used when the network was trained
+    import training_data_generation as tdg
+    import neural_network_generation as nng
+
+    sys_params = tdg.define_system_params(root_dir)
+    X_all, Y_all, avg_powers_all = nrw.import_training_data(sys_params)
+    nn_params = nng.define_nn_params(1)
+    nn_dataset = nng.seperate_test_set(X_all, Y_all, avg_powers_all, nn_params)
+    nn_hyperparams = nrw.read_nn_weights(os.path.dirname(filename_nn_weights) + "/" + nn_params["filename_hyperparams"])
+    x_test = (np.array(nn_dataset["X_test"]) - nn_hyperparams["mu"][0]) / nn_hyperparams["sigma"][0]
+    y_test = np.array(nn_dataset["Y_test"]).T
+    return x_test, y_test
+
+
+
+def main(argv):
+    """
+    python benchmark_surrogate.py [neural_network_weights/NN0] [use_final_sigmoid] [Data]
+    Without a weights file a random network is used, without a training data directory the precision
+    report is relative to the float32 network on random inputs.
+    """
+    benchmark_params = define_surrogate_benchmark_params()
+    random_generator = np.random.default_rng(benchmark_params["random_seed"])
+    if len(argv) > 1:
+        nn_weights = npnn.read_nn_weights(argv[1])
+        benchmark_params["input_size"] = np.shape(nn_weights["W1"])[1]
+    else:
+        nn_weights = random_nn_weights(benchmark_params, random_generator)
+    if len(argv) > 2:
+        benchmark_params["use_final_sigmoid"] = int(argv[2])
+
+    x_test = random_generator.standard_normal((benchmark_params["num_examples"], benchmark_params["input_size"]))
+    max_difference, within_tolerance = check_parity(x_test, nn_weights, benchmark_params)
+
+    if len(argv) > 3:
+        x_held_out, y_held_out = held_out_test_set(argv[3], argv[1])
+    else:
+        x_held_out = x_test
+        y_held_out = npnn.apply_network(x_test, nn_weights, benchmark_params["use_final_sigmoid"])
+    _ = precision_report(x_held_out, y_held_out, nn_weights, benchmark_params)
+    return within_tolerance
+
+
+
+if __name__ == "__main__":
+    if not main(sys.argv):
+        sys.exit("NumPy inference does not match TensorFlow")
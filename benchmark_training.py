@@ -0,0 +1,70 @@
+import numpy as np
+import sys
+import time
+import neural_network_generation as nng
+
+
+def define_training_benchmark_params():
+    benchmark_params = {}
+    benchmark_params["dataset_sizes"] = [1000, 10000]
+    benchmark_params["input_size"] = 6 # LMJ, 2 cones x (theta, phi, power)
+    benchmark_params["output_size"] = 2 * 496 # real and imaginary modes for LMAX=30
+    benchmark_params["hidden_units"] = 600
+    benchmark_params["minibatch_size"] = 32
+    benchmark_params["num_epochs"] = 3
+    # (label, compile_steps, jit_compile)
+    benchmark_params["step_modes"] = [("eager", False, False),
+                                      ("tf.function", True, False),
+                                      ("tf.function+XLA", True, True)]
+    return benchmark_params
+
+
+
+def time_epochs(nn_params, nn_dataset, benchmark_params, compile_steps, jit_compile):
+    import tf_neural_network as tfnn
+
+    # the difference between runs removes the set-up, tracing and pre-training evaluation
+    run_times = []
+    for num_epochs in (1, benchmark_params["num_epochs"] + 1):
+        tic = time.perf_counter()
+        tfnn.model_wrapper(nn_params, nn_dataset, num_epochs, 0.001,
+                           benchmark_params["hidden_units"], benchmark_params["hidden_units"],
+                           benchmark_params["hidden_units"],
+                           minibatch_size=benchmark_params["minibatch_size"], print_cost=False,
+                           compile_steps=compile_steps, jit_compile=jit_compile)
+        run_times.append(time.perf_counter() - tic)
+
+    return (run_times[1] - run_times[0]) / benchmark_params["num_epochs"]
+
+
+
+def main(argv):
+    benchmark_params = define_training_benchmark_params()
+    if len(argv) > 1:
+        benchmark_params["dataset_sizes"] = [int(size) for size in argv[1].split(",")]
+
+    random_generator = np.random.default_rng(12345)
+    nn_params = nng.define_nn_params(1)
+    epoch_times = {}
+    for num_examples in benchmark_params["dataset_sizes"]:
+        X_all = random_generator.random((benchmark_params["input_size"], num_examples))
+        Y_all = random_generator.random((benchmark_params["output_size"], num_examples))
+        nn_dataset = nng.seperate_test_set(X_all, Y_all, np.ones(num_examples), nn_params)
+        nn_dataset = nng.normalise(nn_dataset)
+
+        for label, compile_steps, jit_compile in benchmark_params["step_modes"]:
+            epoch_time = time_epochs(nn_params, nn_dataset, benchmark_params, compile_steps, jit_compile)
+            epoch_times[(num_examples, label)] = epoch_time
+            print("{} examples, {}: {:.3f}s per epoch".format(num_examples, label, epoch_time))
+
+        eager_time = epoch_times[(num_examples, benchmark_params["step_modes"][0][0])]
+        for label, _, _ in benchmark_params["step_modes"][1:]:
+            print("{} examples, {} speed-up over eager: {:.2f}x".format(num_examples, label,
+                                                                    eager_time / epoch_times[(num_examples, label)]))
+
+    return epoch_times
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
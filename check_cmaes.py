@@ -0,0 +1,147 @@
+import copy
+import numpy as np
+import sys
+from scipy.optimize import minimize
+import utils_cmaes as ucma
+
+
+def define_cmaes_check_params(**kwargs):
+    check_params = {}
+    check_params["num_trials"] = kwargs.get("num_trials", 10)
+    check_params["num_dims"] = kwargs.get("num_dims", 6)
+    check_params["population_size"] = kwargs.get("population_size", 10)
+    check_params["max_generations"] = kwargs.get("max_generations", 600)
+    check_params["condition"] = kwargs.get("condition", 1.0e4) # of the rotated ellipsoid
+    check_params["tolerance"] = kwargs.get("tolerance", 1.0e-3) # distance to the optimum in units of the bounds
+    check_params["random_seed"] = kwargs.get("random_seed", 12345)
+    return check_params
+
+
+
+def rotated_ellipsoid(rng, num_dims, condition, optimum):
+    # -(x - optimum)^T A (x - optimum), maximised at optimum, which may lie outside the unit box.
+    # Returns the fitness and the best point in the box
+    rotation, _ = np.linalg.qr(rng.standard_normal((num_dims, num_dims)))
+    A = np.matmul(rotation * condition**(np.arange(num_dims) / (num_dims - 1)), rotation.T)
+    def fitness(X_unit):
+        deviation = np.atleast_2d(X_unit) - optimum
+        return -np.sum(np.matmul(deviation, A) * deviation, axis=1)
+    result = minimize(lambda x: -fitness(x)[0], np.clip(optimum, 0.0, 1.0), jac=lambda x: 2.0 * np.matmul(A, x - optimum),
+                      method="L-BFGS-B", bounds=[(0.0, 1.0)] * num_dims, options={"ftol": 1.0e-15, "gtol": 1.0e-12})
+    return fitness, result.x
+
+
+
+def check_distribution(es):
+    # the eigen decomposition must describe the covariance, and the covariance stay positive definite
+    failures = []
+    C_rebuilt = np.matmul(es["B"] * es["D"]**2, es["B"].T)
+    if not np.allclose(C_rebuilt, es["C"], rtol=1.0e-8, atol=1.0e-10 * np.max(es["D"])**2):
+        failures.append("eigen decomposition does not rebuild the covariance")
+    if not np.allclose(np.matmul(np.matmul(es["inv_sqrt_C"], es["C"]), es["inv_sqrt_C"]), np.eye(len(es["D"])),
+                       atol=1.0e-6):
+        failures.append("inv_sqrt_C is not the inverse square root of the covariance")
+    if np.min(np.linalg.eigvalsh(es["C"])) <= 0.0:
+        failures.append("covariance not positive definite")
+    if not (np.isfinite(es["sigma"]) and (es["sigma"] > 0.0)):
+        failures.append("step size not positive")
+    return failures
+
+
+
+def minimise(cmaes_params, pbounds, fitness, rng, max_generations):
+    # the ask and tell loop of optimize.py with restarts, returns the best unit input and the failures
+    failures = []
+    es = ucma.initialise_cmaes(cmaes_params, pbounds, rng)
+    num_restarts = 0
+    best_X, best_fitness = None, -np.inf
+    for generation in range(max_generations):
+        X_unit, X = ucma.ask(es)
+        if np.any(X < pbounds[:,0]) or np.any(X > pbounds[:,1]):
+            failures.append("candidates outside the bounds")
+        X_run = ucma.scale_to_unit(X, pbounds)
+        generation_fitness = fitness(X_run)
+        if np.max(generation_fitness) > best_fitness:
+            best_fitness = np.max(generation_fitness)
+            best_X = X_run[np.argmax(generation_fitness),:]
+        es = ucma.tell(es, X_unit, generation_fitness)
+        failures += check_distribution(es)
+        if ucma.should_restart(es, cmaes_params) != "":
+            if num_restarts == cmaes_params["max_restarts"]:
+                break
+            num_restarts += 1
+            es = ucma.restart(es, cmaes_params)
+    return best_X, failures
+
+
+
+def check_resume(cmaes_params, pbounds, fitness, rng, num_generations):
+    # a search restored from cmaes_state must continue exactly as the original
+    es = ucma.initialise_cmaes(cmaes_params, pbounds, rng)
+    for generation in range(num_generations):
+        X_unit, X = ucma.ask(es)
+        es = ucma.tell(es, X_unit, fitness(ucma.scale_to_unit(X, pbounds)))
+    state = copy.deepcopy(ucma.cmaes_state(es))
+    restored = ucma.restore_cmaes(state, pbounds, copy.deepcopy(rng))
+    for generation in range(num_generations):
+        X_unit, X = ucma.ask(es)
+        es = ucma.tell(es, X_unit, fitness(ucma.scale_to_unit(X, pbounds)))
+        X_unit_restored, X_restored = ucma.ask(restored)
+        restored = ucma.tell(restored, X_unit_restored, fitness(ucma.scale_to_unit(X_restored, pbounds)))
+    if not (np.array_equal(X, X_restored) and np.array_equal(es["C"], restored["C"]) and (es["sigma"] == restored["sigma"])):
+        return ["restored search differs from the original"]
+    return []
+
+
+
+def check_warm_start(cmaes_params, pbounds, rng):
+    # the warm-start mean is the weighted mean of the best rows, with a positive definite covariance
+    failures = []
+    X_warm = ucma.scale_from_unit(rng.random((8, len(pbounds))), pbounds)
+    target_warm = rng.random(8)
+    es = ucma.initialise_cmaes(cmaes_params, pbounds, rng, X_warm=X_warm, target_warm=target_warm)
+    order = np.argsort(-target_warm)
+    expected = np.matmul(ucma.selection_weights(8), ucma.scale_to_unit(X_warm[order,:], pbounds))
+    if not np.allclose(es["mean"], expected):
+        failures.append("warm-start mean is not the weighted mean of the best rows")
+    return failures + check_distribution(es)
+
+
+
+def main(argv):
+    """
+    python check_cmaes.py [number of trials]
+    Runs CMA-ES on rotated ill-conditioned ellipsoids, with the optimum inside and outside the bounds,
+    and checks that it converges, that its covariance stays consistent and that a restored search
+    continues exactly. Stops with an error if any check fails.
+    """
+    check_params = define_cmaes_check_params()
+    if len(argv) > 1:
+        check_params["num_trials"] = int(argv[1])
+    rng = np.random.default_rng(check_params["random_seed"])
+    num_dims = check_params["num_dims"]
+    cmaes_params = ucma.define_cmaes_params(num_dims, check_params["population_size"], tol_x=1.0e-6)
+
+    failures = []
+    for trial in range(check_params["num_trials"]):
+        pbounds = np.sort(rng.uniform(-2.0, 2.0, (num_dims, 2)), axis=1)
+        for optimum in (rng.uniform(0.1, 0.9, num_dims), rng.uniform(-0.5, 1.5, num_dims)):
+            fitness, best_in_box = rotated_ellipsoid(rng, num_dims, check_params["condition"], optimum)
+            best_X, trial_failures = minimise(cmaes_params, pbounds, fitness, rng, check_params["max_generations"])
+            failures += trial_failures
+            distance = np.linalg.norm(best_X - best_in_box)
+            if distance > check_params["tolerance"]:
+                failures.append("best input {:.2e} from the optimum in the bounds".format(distance))
+        failures += check_resume(cmaes_params, pbounds, fitness, rng, 15)
+        failures += check_warm_start(cmaes_params, pbounds, rng)
+    for failure in sorted(set(failures)):
+        print(failure)
+    if len(failures) > 0:
+        sys.exit(str(len(failures)) + " CMA-ES checks failed")
+    print("CMA-ES converged and restored exactly in " + str(check_params["num_trials"]) + " trials")
+    return failures
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
@@ -0,0 +1,116 @@
+import numpy as np
+import sys
+import utils_gaussian_process as ugp
+
+
+def define_gp_check_params(**kwargs):
+    check_params = {}
+    check_params["num_trials"] = kwargs.get("num_trials", 50)
+    check_params["num_dims"] = kwargs.get("num_dims", 5)
+    check_params["max_init_points"] = kwargs.get("max_init_points", 40)
+    check_params["num_appends"] = kwargs.get("num_appends", 4)
+    check_params["max_append_size"] = kwargs.get("max_append_size", 10)
+    check_params["num_test_points"] = kwargs.get("num_test_points", 30)
+    check_params["rtol"] = kwargs.get("rtol", 1.0e-6)
+    check_params["random_seed"] = kwargs.get("random_seed", 12345)
+    return check_params
+
+
+
+def dense_predict(X, y, gp_params, X_star):
+    # the posterior by a direct solve of the full covariance
+    K = ugp.matern52_kernel(X, X, gp_params["length_scales"], gp_params["signal_variance"])
+    K[np.diag_indices_from(K)] += gp_params["noise_variance"]
+    K_star = ugp.matern52_kernel(X, X_star, gp_params["length_scales"], gp_params["signal_variance"])
+    y_mean = np.mean(y)
+    y_std = max(np.std(y), 1.0e-12)
+    mean = np.matmul(K_star.T, np.linalg.solve(K, (y - y_mean) / y_std))
+    variance = np.maximum(gp_params["signal_variance"] - np.sum(K_star * np.linalg.solve(K, K_star), axis=0), 1.0e-12)
+    return mean * y_std + y_mean, np.sqrt(variance) * y_std
+
+
+
+def check_appends(X, y, batch_sizes, gp_params, X_star, rtol):
+    # rank-k appends must give the factor and posterior of a fit on all the points, and leave the old gp alone
+    failures = []
+    num_init = len(y) - np.sum(batch_sizes)
+    gp = ugp.gp_fit(X[:num_init,:], y[:num_init], gp_params)
+    start = num_init
+    for batch_size in batch_sizes:
+        L_before = gp["L"].copy()
+        updated = ugp.gp_append(gp, X[start:start+batch_size,:], y[start:start+batch_size])
+        if not np.array_equal(gp["L"], L_before) or (len(gp["y"]) != start):
+            failures.append("gp_append modified the gp it was given")
+        gp = updated
+        start += batch_size
+
+    refit = ugp.gp_fit(X, y, gp_params)
+    scale = np.max(np.abs(refit["L"]))
+    if not np.allclose(gp["L"], refit["L"], rtol=rtol, atol=rtol * scale):
+        failures.append("appended Cholesky factor differs from a refit")
+    mean, std_dev = ugp.gp_predict(gp, X_star)
+    dense_mean, dense_std_dev = dense_predict(X, y, gp_params, X_star)
+    if not np.allclose(mean, dense_mean, rtol=rtol, atol=rtol * np.std(y)):
+        failures.append("appended posterior mean differs from a direct solve")
+    if not np.allclose(std_dev, dense_std_dev, rtol=rtol, atol=rtol * np.std(y)):
+        failures.append("appended posterior standard deviation differs from a direct solve")
+    return failures
+
+
+
+def check_duplicate_appends(X, y, gp_params):
+    # a Kriging believer fantasy on top of existing points at tiny noise, the factor must stay usable
+    failures = []
+    gp_params = dict(gp_params, noise_variance=0.0)
+    gp = ugp.gp_fit(X, y, gp_params)
+    try:
+        with np.errstate(all="ignore"):
+            gp = ugp.gp_append(gp, X[:3,:], y[:3])
+            mean, std_dev = ugp.gp_predict(gp, X)
+    except np.linalg.LinAlgError:
+        return ["duplicate append failed to factorise"]
+    if np.shape(gp["L"])[0] != len(y) + 3:
+        failures.append("duplicate append has the wrong size")
+    if not (np.all(np.isfinite(gp["L"])) and np.all(np.isfinite(mean)) and np.all(np.isfinite(std_dev))):
+        failures.append("duplicate append gave a non-finite factor or posterior")
+    elif not np.allclose(mean, y, atol=1.0e-3 * np.std(y)):
+        failures.append("duplicate append no longer interpolates the data")
+    return failures
+
+
+
+def main(argv):
+    """
+    python check_gaussian_process.py [number of trials]
+    Checks the rank-k Cholesky updates of the Gaussian process against a refit and a direct solve
+    on random data, and appends on top of existing points. Stops with an error if any check fails.
+    """
+    check_params = define_gp_check_params()
+    if len(argv) > 1:
+        check_params["num_trials"] = int(argv[1])
+    rng = np.random.default_rng(check_params["random_seed"])
+    num_dims = check_params["num_dims"]
+
+    failures = []
+    for trial in range(check_params["num_trials"]):
+        gp_params = ugp.define_gp_params(num_dims, length_scale=rng.uniform(0.1, 1.0),
+                                         signal_variance=rng.uniform(0.5, 2.0),
+                                         noise_variance=10.0**rng.uniform(-6, -2))
+        batch_sizes = rng.integers(1, check_params["max_append_size"] + 1, check_params["num_appends"])
+        num_points = rng.integers(1, check_params["max_init_points"] + 1) + np.sum(batch_sizes)
+        X = rng.random((num_points, num_dims))
+        y = np.sin(3.0 * np.sum(X, axis=1)) + 0.01 * rng.standard_normal(num_points)
+        X_star = rng.random((check_params["num_test_points"], num_dims))
+        failures += check_appends(X, y, batch_sizes, gp_params, X_star, check_params["rtol"])
+        failures += check_duplicate_appends(X, y, gp_params)
+    for failure in sorted(set(failures)):
+        print(failure)
+    if len(failures) > 0:
+        sys.exit(str(len(failures)) + " Gaussian process checks failed")
+    print("Gaussian process appends agree with a refit in " + str(check_params["num_trials"]) + " trials")
+    return failures
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
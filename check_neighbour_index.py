@@ -0,0 +1,95 @@
+import numpy as np
+import sys
+import utils_neighbour_index as uknn
+
+
+def define_index_check_params(**kwargs):
+    check_params = {}
+    check_params["num_trials"] = kwargs.get("num_trials", 20)
+    check_params["num_dims"] = kwargs.get("num_dims", 4)
+    check_params["max_batch_size"] = kwargs.get("max_batch_size", 150) # several buffers, so the trees are merged
+    check_params["num_batches"] = kwargs.get("num_batches", 8)
+    check_params["num_queries"] = kwargs.get("num_queries", 20)
+    check_params["k"] = kwargs.get("k", 5)
+    check_params["random_seed"] = kwargs.get("random_seed", 12345)
+    return check_params
+
+
+
+def check_queries(index, X_unit, queries, k, rng):
+    # k nearest, ball and ARD scaled queries against brute force over every appended point
+    failures = []
+    distances, ids = uknn.index_query(index, queries, k=k, is_unit=True)
+    for iq, query in enumerate(queries):
+        brute = np.sort(np.sqrt(np.sum((X_unit - query)**2, axis=1)))[:k]
+        if not np.allclose(distances[iq,:len(brute)], brute):
+            failures.append("k nearest distances differ from brute force")
+        if not np.allclose(np.sqrt(np.sum((X_unit[ids[iq,:len(brute)],:] - query)**2, axis=1)), brute):
+            failures.append("k nearest ids do not match their distances")
+
+        radius = rng.uniform(0.1, 0.5)
+        inside = np.where(np.sum((X_unit - query)**2, axis=1) <= radius**2)[0]
+        if not np.array_equal(np.sort(uknn.index_query_ball(index, query, radius)), inside):
+            failures.append("ball query differs from brute force")
+
+        length_scales = rng.uniform(0.05, 2.0, np.shape(X_unit)[1])
+        scaled = np.sum(((X_unit - query) / length_scales)**2, axis=1)
+        nearest = uknn.index_nearest_scaled(index, query, k, length_scales)
+        if not np.allclose(np.sort(scaled[nearest]), np.sort(scaled)[:k]):
+            failures.append("ARD scaled nearest points differ from brute force")
+    return failures
+
+
+
+def check_redirect(index, index_params, pbounds, rng):
+    # copies of indexed points and of each other are moved apart, inside the bounds
+    failures = []
+    X_indexed = uknn.scale_from_unit(uknn.index_points(index, np.arange(index["num_points"])), pbounds)
+    X_new = np.vstack((X_indexed[rng.integers(0, np.shape(X_indexed)[0], 5),:], pbounds[:,0], pbounds[:,0]))
+    X_moved, num_redirected = uknn.redirect_duplicates(index, X_new, rng)
+    if num_redirected < 6:
+        failures.append(str(num_redirected) + " duplicates moved instead of at least 6")
+    if np.any(X_moved < pbounds[:,0]) or np.any(X_moved > pbounds[:,1]):
+        failures.append("redirected inputs outside the bounds")
+    if np.any(uknn.find_duplicates(uknn.create_index(pbounds, index_params, X_indexed), X_moved)):
+        failures.append("redirected inputs are still duplicates")
+    return failures
+
+
+
+def main(argv):
+    """
+    python check_neighbour_index.py [number of trials]
+    Checks the nearest-neighbour index against brute force while points are appended, and that
+    redirected duplicates are moved apart. Stops with an error if any check fails.
+    """
+    check_params = define_index_check_params()
+    if len(argv) > 1:
+        check_params["num_trials"] = int(argv[1])
+    rng = np.random.default_rng(check_params["random_seed"])
+    num_dims = check_params["num_dims"]
+
+    failures = []
+    for trial in range(check_params["num_trials"]):
+        pbounds = np.sort(rng.uniform(-2.0, 2.0, (num_dims, 2)), axis=1)
+        index_params = uknn.define_index_params(buffer_size=int(rng.integers(4, 64)))
+        index = uknn.create_index(pbounds, index_params)
+        X_unit = np.zeros((0, num_dims))
+        for batch in range(check_params["num_batches"]):
+            X_batch = rng.random((rng.integers(1, check_params["max_batch_size"]), num_dims))
+            index = uknn.index_append(index, uknn.scale_from_unit(X_batch, pbounds))
+            X_unit = np.vstack((X_unit, X_batch))
+            failures += check_queries(index, X_unit, rng.random((check_params["num_queries"], num_dims)),
+                                      check_params["k"], rng)
+        failures += check_redirect(index, index_params, pbounds, rng)
+    for failure in sorted(set(failures)):
+        print(failure)
+    if len(failures) > 0:
+        sys.exit(str(len(failures)) + " neighbour index checks failed")
+    print("Neighbour index agrees with brute force in " + str(check_params["num_trials"]) + " trials")
+    return failures
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
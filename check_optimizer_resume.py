@@ -0,0 +1,139 @@
+import numpy as np
+import contextlib
+import os
+import shutil
+import sys
+import netcdf_read_write as nrw
+import optimizer_race as race
+import utils_optimizers as uopt
+
+# the optimizer state stage each optimiser saves under
+RESUME_STAGES = {"genetic_algorithm": "genetic_algorithm", "steady_state_genetic_algorithm": "genetic_algorithm",
+                 "gradient_ascent": "gradient_ascent", "speculative_gradient_ascent": "gradient_ascent",
+                 "bayesian_optimisation": "bayesian_optimisation", "cmaes": "cmaes", "nsga2": "nsga2"}
+
+
+class Interrupted(Exception):
+    pass
+
+
+
+def define_resume_check_params(dir_check, **kwargs):
+    check_params = {}
+    check_params["dir_check"] = dir_check
+    check_params["optimisers"] = kwargs.get("optimisers", list(RESUME_STAGES.keys()))
+    check_params["interrupt_after"] = kwargs.get("interrupt_after", [1, 6]) # objective calls before the interruption
+    check_params["random_seed"] = kwargs.get("random_seed", 7)
+    check_params["race_params"] = race.define_race_params(dir_check, num_simulations=kwargs.get("num_simulations", 40),
+                                                          num_slots=kwargs.get("num_slots", 4))
+    return check_params
+
+
+
+def run_with_interrupt(optimiser, run_dir, check_params, interrupt_after=None):
+    # interrupted before objective call interrupt_after, if given, and resumed as resume=1 would. Returns
+    # the final dataset, the rows evaluated after resuming, the rows complete in the saved state and the
+    # saved inputs of the rows that were running
+    race_params = check_params["race_params"]
+    seed = check_params["random_seed"]
+    shutil.rmtree(run_dir, ignore_errors=True)
+    dataset, dataset_params, facility_spec, evaluate = race.prepare_race_dir(run_dir, seed, race.analytic_objective,
+                                                                             race_params)
+    race_log = race.define_race_log()
+    objective = race.objective_function(evaluate, race_log)
+
+    def interruptible_objective(dataset, start, stop):
+        if len(race_log["rows"]) == interrupt_after:
+            raise Interrupted()
+        return objective(dataset, start, stop)
+
+    def optimizer_params():
+        opt_params = uopt.define_optimizer_parameters(run_dir, dataset_params["num_input_params"],
+                                                      race_params["num_init_examples"], 0, seed, facility_spec, True)
+        opt_params["objective_function"] = interruptible_objective
+        return opt_params
+
+    saved_complete = np.arange(race_params["num_init_examples"])
+    running_inputs = {}
+    num_calls_before = 0
+    try:
+        dataset = race.run_optimiser(optimiser, dataset, dataset_params, facility_spec, optimizer_params(), race_params)
+    except Interrupted:
+        interrupt_after = None
+        num_calls_before = len(race_log["rows"])
+        checkpoint = uopt.read_optimizer_state(run_dir)
+        saved_complete = np.arange(checkpoint["num_evaluated"])
+        if "state_is_complete" in checkpoint.keys():
+            # the fake runs finish in order, so the first completed offspring is marked as still running
+            # to leave a completed offspring after a running one, as real runs do
+            is_complete = np.array(np.ma.getdata(checkpoint["state_is_complete"]))
+            first_offspring = int(checkpoint["state_first_offspring"])
+            if np.sum(is_complete[first_offspring:] > 0.5) > 1:
+                is_complete[first_offspring] = 0.0
+                checkpoint["state_is_complete"] = is_complete
+                checkpoint["num_evaluated"] = first_offspring
+            saved_complete = np.where(is_complete > 0.5)[0]
+            saved_inputs = nrw.read_general_netcdf(run_dir + "/training_data_and_labels.nc")["input_parameters"]
+            for iex in np.where(is_complete < 0.5)[0]:
+                running_inputs[iex] = np.array(saved_inputs[iex,:])
+        opt_params = optimizer_params()
+        resume_state = uopt.resume_optimizer_state(checkpoint, opt_params, RESUME_STAGES[optimiser])
+        dataset = nrw.read_general_netcdf(run_dir + "/training_data_and_labels.nc")
+        dataset = race.run_optimiser(optimiser, dataset, dataset_params, facility_spec, opt_params, race_params,
+                                     resume_state)
+    resumed_rows = [np.arange(start, stop) for start, stop, _ in race_log["rows"][num_calls_before:]]
+    return dataset, np.concatenate(resumed_rows + [np.zeros(0, dtype=int)]), saved_complete, running_inputs
+
+
+
+def check_resume(optimiser, interrupt_after, check_params):
+    # a resumed run must not evaluate a row that was complete when it was interrupted, and must match the
+    # uninterrupted run exactly, except the steady-state genetic algorithm whose offspring complete in any order
+    dir_check = check_params["dir_check"]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        reference, _, _, _ = run_with_interrupt(optimiser, dir_check + "/" + optimiser + "_reference", check_params)
+        resumed, resumed_rows, saved_complete, running_inputs = run_with_interrupt(
+            optimiser, dir_check + "/" + optimiser + "_resumed", check_params, interrupt_after)
+    failures = []
+    num_again = len(np.intersect1d(resumed_rows, saved_complete))
+    if num_again > 0:
+        failures.append(str(num_again) + " completed rows evaluated again")
+    for iex, inputs in running_inputs.items():
+        if not np.array_equal(np.float32(resumed["input_parameters"][iex,:]), np.float32(inputs)):
+            failures.append("running example " + str(iex) + " run again with different inputs")
+    if resumed["num_evaluated"] != reference["num_evaluated"]:
+        failures.append("{} rows evaluated instead of {}".format(resumed["num_evaluated"], reference["num_evaluated"]))
+    elif optimiser != "steady_state_genetic_algorithm":
+        for key in ("input_parameters", "rms", "avg_flux"):
+            if not np.array_equal(np.ma.getdata(resumed[key]), np.ma.getdata(reference[key])):
+                failures.append(key + " differs from the uninterrupted run")
+    return failures
+
+
+
+def main(argv):
+    """
+    python check_optimizer_resume.py [check directory] [optimisers, comma separated]
+    Interrupts every optimiser part way through, resumes it and checks the result against an
+    uninterrupted run. Stops with an error if any check fails.
+    """
+    check_params = define_resume_check_params(argv[1] if len(argv) > 1 else "Check_resume")
+    if len(argv) > 2:
+        check_params["optimisers"] = argv[2].split(",")
+    os.makedirs(check_params["dir_check"], exist_ok=True)
+
+    num_failed = 0
+    for optimiser in check_params["optimisers"]:
+        for interrupt_after in check_params["interrupt_after"]:
+            failures = check_resume(optimiser, interrupt_after, check_params)
+            print("{} interrupted before objective call {}: {}".format(optimiser, interrupt_after,
+                                                                      "ok" if len(failures) == 0 else ", ".join(failures)))
+            num_failed += len(failures) > 0
+    if num_failed > 0:
+        sys.exit(str(num_failed) + " resume checks failed")
+    return num_failed
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
@@ -0,0 +1,120 @@
+import numpy as np
+import sys
+import utils_optimizers as uopt
+import utils_pareto as upar
+
+
+def define_pareto_check_params(**kwargs):
+    check_params = {}
+    check_params["num_trials"] = kwargs.get("num_trials", 200)
+    check_params["max_points"] = kwargs.get("max_points", 60)
+    check_params["num_levels"] = kwargs.get("num_levels", 8) # objectives on a coarse grid so ties are common
+    check_params["random_seed"] = kwargs.get("random_seed", 12345)
+    return check_params
+
+
+
+def brute_force_fronts(objectives):
+    # O(n^2) front numbers by repeatedly removing the non-dominated points
+    num_points = np.shape(objectives)[0]
+    fronts = np.full(num_points, -1)
+    front = 0
+    while np.any(fronts < 0):
+        remaining = np.where(fronts < 0)[0]
+        for i in remaining:
+            dominated = ((objectives[remaining,0] <= objectives[i,0]) & (objectives[remaining,1] <= objectives[i,1])
+                         & np.any(objectives[remaining,:] != objectives[i,:], axis=1))
+            if not np.any(dominated):
+                fronts[i] = front
+        front += 1
+    return fronts
+
+
+
+def check_archive(objectives, batch_sizes):
+    # the archive after inserting the points in batches must hold exactly the non-dominated points
+    failures = []
+    archive = upar.define_pareto_archive()
+    start = 0
+    for batch_size in batch_sizes:
+        upar.archive_insert(archive, objectives[start:start+batch_size,:], range(start, start + batch_size))
+        start += batch_size
+        if np.any(np.diff(archive["f1"]) < 0.0) or np.any(np.diff(archive["f2"]) > 0.0):
+            failures.append("archive not sorted")
+    finite = np.all(np.isfinite(objectives), axis=1)
+    fronts = np.full(np.shape(objectives)[0], -1)
+    fronts[finite] = brute_force_fronts(objectives[finite,:])
+    expected = sorted(np.where(fronts == 0)[0].tolist())
+    if sorted(archive["rows"]) != expected:
+        failures.append("archive rows {} instead of {}".format(sorted(archive["rows"]), expected))
+    for f1, f2, row in zip(archive["f1"], archive["f2"], archive["rows"]):
+        if (f1 != objectives[row,0]) or (f2 != objectives[row,1]):
+            failures.append("archive objectives of row " + str(row) + " do not match")
+    return failures
+
+
+
+def check_nondominated_sort(objectives):
+    if not np.array_equal(upar.nondominated_sort(objectives), brute_force_fronts(objectives)):
+        return ["nondominated_sort fronts differ from the brute force sort"]
+    return []
+
+
+
+def check_invalid_rows():
+    # screened, broken and unread runs must never reach the front
+    failures = []
+    opt_params = {"fitness_limit_broken_pressure_mbar": 100.0}
+    dataset = {}
+    dataset["rms"] = np.array([[0.02], [0.0], [0.03]])
+    dataset["avg_flux"] = np.array([[1.0], [0.0], [2.0]])
+    objectives = uopt.pareto_objectives(dataset, opt_params)
+    if np.all(np.isfinite(objectives[1,:])) or not np.all(np.isfinite(objectives[[0,2],:])):
+        failures.append("unread run not marked invalid")
+
+    dataset["rms"] = np.array([[0.02, 0.02], [0.02, 0.01], [0.02, 0.01], [0.02, 0.01]])
+    dataset["avg_flux"] = np.array([[1.0, 50.0], [1.0, 500.0], [1.0, 60.0], [1.0, 70.0]])
+    dataset["fidelity"] = np.array([2, 2, 1, 2])
+    objectives = uopt.pareto_objectives(dataset, opt_params)
+    if not np.array_equal(np.all(np.isfinite(objectives), axis=1), [True, False, False, True]):
+        failures.append("broken or screened run not marked invalid")
+
+    archive = upar.define_pareto_archive()
+    upar.archive_insert(archive, objectives, range(4))
+    if archive["rows"] != [3]:
+        failures.append("archive of invalid rows holds {} instead of [3]".format(archive["rows"]))
+    return failures
+
+
+
+def main(argv):
+    """
+    python check_pareto_archive.py [number of trials]
+    Checks the Pareto archive and non-dominated sort against a brute force sort of random points,
+    and that invalid runs never reach the front. Stops with an error if any check fails.
+    """
+    check_params = define_pareto_check_params()
+    if len(argv) > 1:
+        check_params["num_trials"] = int(argv[1])
+    rng = np.random.default_rng(check_params["random_seed"])
+
+    failures = check_invalid_rows()
+    for trial in range(check_params["num_trials"]):
+        num_points = rng.integers(1, check_params["max_points"] + 1)
+        objectives = rng.integers(0, check_params["num_levels"], (num_points, 2)).astype(float)
+        failures += check_nondominated_sort(objectives)
+        objectives[rng.random(num_points) < 0.1,:] = np.inf # invalid runs
+        batch_sizes = np.diff(np.unique(np.concatenate(([0, num_points], rng.integers(0, num_points, 3)))))
+        failures += check_archive(objectives, batch_sizes)
+    for failure in sorted(set(failures)):
+        print(failure)
+    if len(failures) > 0:
+        sys.exit(str(len(failures)) + " Pareto checks failed")
+    print("Pareto archive and non-dominated sort agree with the brute force sort in "
+          + str(check_params["num_trials"]) + " trials")
+    return failures
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
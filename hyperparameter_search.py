@@ -0,0 +1,169 @@
+import numpy as np
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import training_data_generation as tdg
+import netcdf_read_write as nrw
+import neural_network_generation as nng
+
+# set once in each worker process by initialise_worker
+worker_state = {}
+
+
+def define_search_params(num_configs, **kwargs):
+    search_params = {}
+    search_params["num_configs"] = num_configs
+    search_params["random_seed"] = kwargs.get("random_seed", 12345)
+    search_params["learning_rate_range"] = kwargs.get("learning_rate_range", [1.0e-4, 1.0e-2]) # sampled log-uniformly
+    search_params["hidden_units"] = kwargs.get("hidden_units", [100, 200, 400, 600, 800])
+    search_params["minibatch_sizes"] = kwargs.get("minibatch_sizes", [16, 32, 64, 128])
+    search_params["use_final_sigmoid"] = kwargs.get("use_final_sigmoid", [0, 1])
+    search_params["min_epochs"] = kwargs.get("min_epochs", 10) # epochs trained by every configuration
+    search_params["max_epochs"] = kwargs.get("max_epochs", 270)
+    search_params["reduction_factor"] = kwargs.get("reduction_factor", 3) # 1/reduction_factor survive each rung
+    search_params["threads_per_worker"] = kwargs.get("threads_per_worker", 1)
+    search_params["num_workers"] = kwargs.get("num_workers", max(1, (os.cpu_count() or 1) // search_params["threads_per_worker"]))
+    search_params["dir_search"] = kwargs.get("dir_search", "hyperparameter_search")
+    return search_params
+
+
+
+def sample_configurations(search_params):
+    random_generator = np.random.default_rng(search_params["random_seed"])
+    num_configs = search_params["num_configs"]
+    log_lr = np.log10(search_params["learning_rate_range"])
+
+    configs = {}
+    configs["learning_rate"] = 10.0**random_generator.uniform(log_lr[0], log_lr[1], num_configs)
+    for key in ("hidden_units1", "hidden_units2", "hidden_units3"):
+        configs[key] = random_generator.choice(search_params["hidden_units"], num_configs)
+    configs["minibatch_size"] = random_generator.choice(search_params["minibatch_sizes"], num_configs)
+    configs["use_final_sigmoid"] = random_generator.choice(search_params["use_final_sigmoid"], num_configs)
+    configs["initialize_seed"] = np.arange(num_configs)
+    return configs
+
+
+
+def rung_epochs(search_params):
+    # geometric budgets min_epochs * reduction_factor**rung, the last rung trains to max_epochs
+    epochs = [search_params["min_epochs"]]
+    while epochs[-1] < search_params["max_epochs"]:
+        epochs.append(min(epochs[-1] * search_params["reduction_factor"], search_params["max_epochs"]))
+    return epochs
+
+
+
+def initialise_worker(nn_params, nn_dataset, threads_per_worker):
+    # each worker receives the normalised dataset once, not with every configuration
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads_per_worker)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    worker_state["nn_params"] = nn_params
+    worker_state["nn_dataset"] = nn_dataset
+
+
+
+def train_configuration(config, num_epochs, checkpoint_dir):
+    # checkpointed to checkpoint_dir so the next rung continues from its weights and Adam state
+    import tf_neural_network as tfnn
+
+    parameters, costs, train_acc, test_acc, epochs = tfnn.model_wrapper(
+        worker_state["nn_params"], worker_state["nn_dataset"], num_epochs, config["learning_rate"],
+        config["hidden_units1"], config["hidden_units2"], config["hidden_units3"],
+        minibatch_size=config["minibatch_size"], print_cost=False,
+        initialize_seed=config["initialize_seed"], use_final_sigmoid=config["use_final_sigmoid"],
+        jit_compile=worker_state["nn_params"]["jit_compile"], checkpoint_dir=checkpoint_dir,
+        checkpoint_every=num_epochs)
+    return parameters, float(np.atleast_1d(costs)[-1]), float(np.atleast_1d(train_acc)[-1]), float(np.atleast_1d(test_acc)[-1])
+
+
+
+def successive_halving(search_params, configs, nn_params, nn_dataset):
+    # each rung keeps the best 1/reduction_factor of the configurations by test error and trains them
+    # for longer, until max_epochs or one is left
+    num_configs = search_params["num_configs"]
+    results = {}
+    results["num_epochs"] = np.zeros(num_configs, dtype=int)
+    results["cost"] = np.full(num_configs, np.nan)
+    results["train_acc"] = np.full(num_configs, np.nan)
+    results["test_acc"] = np.full(num_configs, np.inf)
+    weights = [None] * num_configs
+
+    surviving = np.arange(num_configs)
+    with ProcessPoolExecutor(max_workers=search_params["num_workers"],
+                             initializer=initialise_worker,
+                             initargs=(nn_params, nn_dataset, search_params["threads_per_worker"])) as executor:
+        for rung, num_epochs in enumerate(rung_epochs(search_params)):
+            futures = {}
+            for iconfig in surviving:
+                config = {key: item[iconfig] for key, item in configs.items()}
+                checkpoint_dir = search_params["dir_search"] + "/checkpoints/config" + str(iconfig)
+                futures[iconfig] = executor.submit(train_configuration, config, num_epochs, checkpoint_dir)
+            for iconfig, future in futures.items():
+                weights[iconfig], results["cost"][iconfig], results["train_acc"][iconfig], results["test_acc"][iconfig] = future.result()
+                results["num_epochs"][iconfig] = num_epochs
+
+            ranked = surviving[np.argsort(results["test_acc"][surviving])]
+            print("Rung ", rung, ", ", num_epochs, " epochs, best test mean abs error: ", results["test_acc"][ranked[0]],
+                  " (configuration ", ranked[0], ")")
+            num_keep = max(1, len(surviving) // search_params["reduction_factor"])
+            surviving = ranked[:num_keep]
+            if len(ranked) == 1:
+                break
+
+    return results, weights
+
+
+
+def save_search_results(search_params, configs, results, weights, nn_dataset):
+    # the configurations best first as in define_nn_hyperparams, with the weights of each as NN<rank>
+    order = np.argsort(results["test_acc"], kind="stable")
+    num_configs = search_params["num_configs"]
+    nn_hyperparams = nng.define_nn_hyperparams(0, num_configs, mean=nn_dataset["mu"], std_dev=nn_dataset["sigma"])
+    for key in ("use_final_sigmoid", "learning_rate", "hidden_units1", "hidden_units2", "hidden_units3",
+                "minibatch_size", "initialize_seed"):
+        nn_hyperparams[key] = np.array(configs[key])[order]
+    for key in ("num_epochs", "cost", "train_acc", "test_acc"):
+        nn_hyperparams[key] = results[key][order]
+
+    nn_params = nng.define_nn_params(num_configs)
+    for rank, iconfig in enumerate(order):
+        nrw.save_nn_weights(weights[iconfig], search_params["dir_search"] + "/NN" + str(rank),
+                            precision=nn_params["weights_precision"])
+    nrw.save_nn_weights(nn_hyperparams, search_params["dir_search"] + "/" + nn_params["filename_hyperparams"])
+    return nn_hyperparams
+
+
+
+def main(argv):
+    """
+    python hyperparameter_search.py [training data directory] [number of configurations]
+    """
+    root_dir = argv[1]
+    num_configs = int(argv[2])
+
+    sys_params = tdg.define_system_params(root_dir)
+    search_params = define_search_params(num_configs, dir_search=root_dir + "/hyperparameter_search")
+    os.makedirs(search_params["dir_search"], exist_ok=True)
+
+    nn_params = nng.define_nn_params(1)
+    X_all, Y_all, avg_powers_all = nrw.import_training_data(sys_params)
+    nn_dataset = nng.seperate_test_set(np.array(X_all), np.array(Y_all), np.array(avg_powers_all), nn_params)
+    nn_dataset = nng.normalise(nn_dataset)
+
+    configs = sample_configurations(search_params)
+    results, weights = successive_halving(search_params, configs, nn_params, nn_dataset)
+    nn_hyperparams = save_search_results(search_params, configs, results, weights, nn_dataset)
+    nng.remove_checkpoints(search_params["dir_search"] + "/checkpoints")
+
+    print("Best configuration: learning rate ", nn_hyperparams["learning_rate"][0],
+          ", hidden units ", nn_hyperparams["hidden_units1"][0], nn_hyperparams["hidden_units2"][0],
+          nn_hyperparams["hidden_units3"][0], ", minibatch size ", nn_hyperparams["minibatch_size"][0],
+          ", final sigmoid ", nn_hyperparams["use_final_sigmoid"][0],
+          ", test mean abs error ", nn_hyperparams["test_acc"][0])
+    return search_params, nn_hyperparams
+
+
+
+if __name__ == "__main__":
+    _, _ = main(sys.argv)
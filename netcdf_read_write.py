@@ -2,9 +2,7 @@ from netCDF4 import Dataset
 import numpy as np
 import os
 import glob
-from healpy_pointings import rot_mat
 import utils_intensity_map as uim
-import utils_healpy as uhp
 
 
 def read_nn_weights(filename_nn_weights):
@@ -13,6 +11,18 @@ def read_nn_weights(filename_nn_weights):
     rootgrp = Dataset(filename_nn_weights + ".nc")
     keys = list(rootgrp["parameters"].variables.keys())
     for key in keys:
+        variable = rootgrp["parameters"][key]
+        if "storage" in variable.ncattrs():
+            # reduced precision weights are decoded back to float32
+            variable.set_auto_mask(False)
+            if variable.storage == "i1":
+                scale = np.array(rootgrp["parameters"][key + "_scale"][:])
+            else:
+                scale = None
+            parameters[key] = decode_nn_weights(np.array(variable[:,:]), variable.storage, scale)
+            continue
+        if key.endswith("_scale") and (key[:-len("_scale")] in keys):
+            continue
         if np.shape(np.shape(rootgrp["parameters"][key]))[0] == 2:
             parameters[key] = rootgrp["parameters"][key][:,:]
         if np.shape(np.shape(rootgrp["parameters"][key]))[0] == 1:
@@ -23,6 +33,44 @@ def read_nn_weights(filename_nn_weights):
 
 
 
+def encode_nn_weights(item, precision):
+    # NetCDF has no 16 bit floats, so "f2" and "bf16" are stored as raw bits in 'u2', "i1" stores int8
+    # values with a float32 scale per output channel (row)
+    item = np.asarray(item, dtype=np.float32)
+    scale = None
+    if precision == "f2":
+        stored = item.astype(np.float16).view(np.uint16)
+        var_type = 'u2'
+    elif precision == "bf16":
+        bits = item.view(np.uint32).astype(np.uint64)
+        # round to nearest even on the 16 discarded mantissa bits
+        stored = ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+        var_type = 'u2'
+    elif precision == "i1":
+        scale = np.max(np.abs(item), axis=1) / 127.0
+        scale[scale == 0.0] = 1.0
+        stored = np.round(item / scale[:,np.newaxis]).astype(np.int8)
+        var_type = 'i1'
+    else:
+        stored = item
+        var_type = 'f4'
+    return stored, var_type, scale
+
+
+
+def decode_nn_weights(stored, precision, scale=None):
+    if precision == "f2":
+        item = stored.astype(np.uint16).view(np.float16).astype(np.float32)
+    elif precision == "bf16":
+        item = (stored.astype(np.uint32) << 16).view(np.float32)
+    elif precision == "i1":
+        item = stored.astype(np.float32) * scale[:,np.newaxis].astype(np.float32)
+    else:
+        item = stored.astype(np.float32)
+    return item
+
+
+
 def read_general_netcdf(filename):
     parameters = {}
 
@@ -47,7 +95,8 @@ def read_general_netcdf(filename):
 
 
 
-def save_general_netcdf(parameters, filename):
+def save_general_netcdf(parameters, filename, float_type='f4'):
+    # float_type='f8' keeps double precision, e.g. for optimiser states that must restore exactly
     if os.path.exists(filename):
         os.remove(filename)
 
@@ -57,13 +106,13 @@ def save_general_netcdf(parameters, filename):
         total_dims = np.shape(dims)[0]
         #print(key, type(item))
         if isinstance(item, tuple):
-            var_type = 'f4'
+            var_type = float_type
         if isinstance(item, np.ndarray):
             #print(item.dtype)
             if item.dtype == "i":
                 var_type = 'i4'
             if "float" in str(item.dtype):# == "float64":
-                var_type = 'f4'
+                var_type = float_type
             if "<U" in str(item.dtype):
                 # this is designed to catch strings use np.array(my_array, dtype='<U*')
                 str_length = len(item[0])
@@ -114,11 +163,14 @@ def save_general_netcdf(parameters, filename):
 
 
 
-def retrieve_xtrain_and_delete(min_parallel, max_parallel, dataset, dataset_params, sys_params, facility_spec):
+def retrieve_xtrain_and_delete(min_parallel, max_parallel, dataset, dataset_params, sys_params, facility_spec, profiles=None):
+    # profiles restricts the read to some time steps, e.g. the solid sphere when screening
+    if profiles is None:
+        profiles = range(dataset_params["num_profiles_per_config"])
 
     for iex in range(min_parallel, max_parallel+1):
         config_location = sys_params["root_dir"] + "/" + sys_params["config_dir"] + str(iex)
-        for tind in range(dataset_params["num_profiles_per_config"]):
+        for tind in profiles:
             run_location = config_location + "/" + sys_params["sim_dir"] + str(tind)
             dir_illumination = run_location+"/"+sys_params["heat_source_nc"]
             if os.path.exists(dir_illumination):
@@ -134,6 +186,7 @@ def retrieve_xtrain_and_delete(min_parallel, max_parallel, dataset, dataset_para
             else:
                 dir_illumination = run_location + "/" + sys_params["ifriit_ouput_name"]
                 if os.path.exists(dir_illumination):
+                    import utils_healpy as uhp # healpy is slow to import, only load it when needed
                     parameters = read_general_netcdf(dir_illumination)
                     intensity_map = parameters["intensity"] * (facility_spec["target_radius"] / 10000.0)**2
 
@@ -159,7 +212,41 @@ def retrieve_xtrain_and_delete(min_parallel, max_parallel, dataset, dataset_para
 
 
 
-def save_nn_weights(parameters, filename_nn_weights):
+def example_outputs_exist(iex, dataset_params, sys_params):
+    config_location = sys_params["root_dir"] + "/" + sys_params["config_dir"] + str(iex)
+    for tind in range(dataset_params["num_profiles_per_config"]):
+        run_location = config_location + "/" + sys_params["sim_dir"] + str(tind)
+        if not (os.path.exists(run_location + "/" + sys_params["heat_source_nc"])
+                or os.path.exists(run_location + "/" + sys_params["ifriit_ouput_name"])):
+            return False
+    return True
+
+
+
+def harvest_completed_examples(example_indices, dataset, dataset_params, sys_params, facility_spec):
+    # reads the examples of example_indices whose runs have all finished and returns their indices,
+    # only the existence checks are threaded as HDF5 is not thread safe
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=sys_params["num_scan_threads"]) as executor:
+        is_complete = list(executor.map(lambda iex: example_outputs_exist(iex, dataset_params, sys_params),
+                                        example_indices))
+
+    harvested = []
+    for iex, complete in zip(example_indices, is_complete):
+        if not complete:
+            continue
+        try:
+            retrieve_xtrain_and_delete(iex, iex, dataset, dataset_params, sys_params, facility_spec)
+        except (OSError, RuntimeError, KeyError, IndexError) as err:
+            print("Could not read outputs of example " + str(iex) + ", it will be re-run: ", err)
+            continue
+        harvested.append(iex)
+    return harvested
+
+
+
+def save_nn_weights(parameters, filename_nn_weights, precision="f4"):
     if os.path.exists(filename_nn_weights + '.nc'):
         os.remove(filename_nn_weights + '.nc')
 
@@ -177,12 +264,19 @@ def save_nn_weights(parameters, filename_nn_weights):
                                              key+'_'+'item_dim3'))
             variable[:,:,:] = item
         if np.shape(dims)[0] == 2:
+            # weights and biases are the only 2D items, so only they use the storage precision
+            stored, var_type, scale = encode_nn_weights(item, precision)
             parms.createDimension(key+'_'+'item_dim1', dims[0])
             parms.createDimension(key+'_'+'item_dim2', dims[1])
-            variable = parms.createVariable(key, 'f4',
+            variable = parms.createVariable(key, var_type,
                                             (key+'_'+'item_dim1',
                                              key+'_'+'item_dim2'))
-            variable[:,:] = item
+            variable[:,:] = stored
+            if precision != "f4":
+                variable.storage = precision
+            if scale is not None:
+                variable = parms.createVariable(key+'_scale', 'f4', (key+'_'+'item_dim1'))
+                variable[:] = scale
         if np.shape(dims)[0] == 1:
             parms.createDimension(key+'_'+'item_dim1', dims[0])
             variable = parms.createVariable(key, 'f4',
@@ -292,3 +386,49 @@ def import_training_data(sys_params):
     training_data.close()
 
     return X_all, Y_all, avg_powers_all
+
+
+
+def training_data_shape(filename):
+    training_data = Dataset(filename)
+    input_size, num_examples = training_data.variables["X_train"].shape
+    output_size = training_data.variables["Y_train"].shape[0]
+    training_data.close()
+
+    return num_examples, input_size, output_size
+
+
+
+def read_training_data_chunk(filename, start, stop):
+    # examples start to stop as float32 arrays of shape (number of examples, input or output size)
+    training_data = Dataset(filename)
+    training_data.set_auto_mask(False)
+    X_chunk = np.ascontiguousarray(training_data.variables["X_train"][:,start:stop].T, dtype=np.float32)
+    Y_chunk = np.ascontiguousarray(training_data.variables["Y_train"][:,start:stop].T, dtype=np.float32)
+    training_data.close()
+
+    return X_chunk, Y_chunk
+
+
+
+def training_data_statistics(filename, start, stop, chunk_size):
+    # np.mean and np.std of X_train over the examples start to stop, read chunk_size examples at a time
+    training_data = Dataset(filename)
+    training_data.set_auto_mask(False)
+    count = 0
+    mean = 0.0
+    sum_sq = 0.0
+    for il in range(start, stop, chunk_size):
+        iu = min(il + chunk_size, stop)
+        X_chunk = np.array(training_data.variables["X_train"][:,il:iu], dtype=np.float64)
+        chunk_count = X_chunk.size
+        chunk_mean = np.mean(X_chunk)
+        chunk_sum_sq = np.sum((X_chunk - chunk_mean)**2)
+        delta = chunk_mean - mean
+        total = count + chunk_count
+        mean += delta * chunk_count / total
+        sum_sq += chunk_sum_sq + delta**2 * count * chunk_count / total
+        count = total
+    training_data.close()
+
+    return mean, np.sqrt(sum_sq / count)
@@ -1,13 +1,9 @@
-from netCDF4 import Dataset
 import numpy as np
 import training_data_generation as tdg
-import tf_neural_network as tfnn
-import matplotlib.pyplot as plt
-import nn_plots as nnp
 import netcdf_read_write as nrw
 import utils_intensity_map as uim
+import shutil
 import sys
-import healpy as hp
 
 
 def define_nn_params(num_nn):
@@ -19,6 +15,16 @@ def define_nn_params(num_nn):
     nn_params["dir_nn_weights"] = "neural_network_weights"
     nn_params["num_nn"] = num_nn
     nn_params["filename_hyperparams"] = "NN_hyper_parameters"
+    nn_params["jit_compile"] = False # compile the training step with XLA
+    nn_params["use_ensemble_training"] = True # train all seeds together when their hyperparameters match
+    nn_params["weights_precision"] = "f4" # storage of saved weights: "f4", "f2", "bf16" or "i1"
+    nn_params["use_streaming"] = False # read the training data from file in chunks instead of into memory
+    nn_params["stream_chunk_size"] = 4096 # examples read from file at a time when streaming
+    nn_params["shuffle_buffer_size"] = 65536 # examples held for shuffling when streaming, 0 to not shuffle
+    nn_params["stream_cache_dir"] = "" # local directory to cache the normalised examples, "" for no cache
+    nn_params["checkpoint_dir"] = nn_params["dir_nn_weights"] + "/checkpoints" # "" to not checkpoint
+    nn_params["checkpoint_every"] = 0 # epochs between checkpoints, 0 to not checkpoint
+    nn_params["early_stopping_patience"] = 0 # epochs without a better test error before stopping, 0 for never
 
     return nn_params
 
@@ -101,20 +107,60 @@ def normalise(nn_dataset, **kwargs):
 
 
 
+def ensemble_compatible(nn_hyperparams):
+    # networks can be trained as one ensemble if they only differ by their seed
+    for key in ("use_final_sigmoid", "num_epochs", "learning_rate", "hidden_units1", "hidden_units2", "hidden_units3"):
+        if len(set(nn_hyperparams[key])) != 1:
+            return False
+    return True
+
+
+
+def checkpoint_location(nn_params, name):
+    # a killed run resumes from here, the checkpoints are removed once the weights are saved
+    if (nn_params["checkpoint_dir"] == "") or (nn_params["checkpoint_every"] <= 0):
+        return ""
+    return nn_params["checkpoint_dir"] + "/" + name
+
+
+
+def remove_checkpoints(checkpoint_dir):
+    if checkpoint_dir != "":
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+
 def multiple_nn(nn_params, nn_dataset, sys_params, nn_hyperparams):
+    # tensorflow and matplotlib take seconds to import, only load them when training
+    import tf_neural_network as tfnn
+    import nn_plots as nnp
 
     print_cost = False
     if nn_params["num_nn"] == 1:
         print_cost = True
 
-    for inn in range(nn_params["num_nn"]):
-        parameters, costs, train_acc, test_acc, epochs = tfnn.model_wrapper(nn_params, nn_dataset, nn_hyperparams["num_epochs"][inn], nn_hyperparams["learning_rate"][inn], nn_hyperparams["hidden_units1"][inn], nn_hyperparams["hidden_units2"][inn], nn_hyperparams["hidden_units3"][inn], initialize_seed = nn_hyperparams["initialize_seed"][inn], print_cost = print_cost, use_final_sigmoid = nn_hyperparams["use_final_sigmoid"][inn])
-        filename_nn_weights = nn_params["dir_nn_weights"] + "/NN" + str(inn)
-        nrw.save_nn_weights(parameters, filename_nn_weights)
-        nn_hyperparams["cost"][inn] = costs[-1]
-        nn_hyperparams["train_acc"][inn] = train_acc[-1]
-        nn_hyperparams["test_acc"][inn] = test_acc[-1]
-        print("Trained neural network index/seed: ", inn)
+    if nn_params["use_ensemble_training"] and (nn_params["num_nn"] > 1) and ensemble_compatible(nn_hyperparams):
+        checkpoint_dir = checkpoint_location(nn_params, "ensemble")
+        member_parameters, costs, train_acc, test_acc, epochs = tfnn.ensemble_model_wrapper(nn_params, nn_dataset, nn_hyperparams["num_epochs"][0], nn_hyperparams["learning_rate"][0], nn_hyperparams["hidden_units1"][0], nn_hyperparams["hidden_units2"][0], nn_hyperparams["hidden_units3"][0], nn_hyperparams["initialize_seed"], print_cost = print_cost, use_final_sigmoid = nn_hyperparams["use_final_sigmoid"][0], jit_compile = nn_params["jit_compile"], checkpoint_dir = checkpoint_dir, checkpoint_every = nn_params["checkpoint_every"], early_stopping_patience = nn_params["early_stopping_patience"])
+        for inn in range(nn_params["num_nn"]):
+            filename_nn_weights = nn_params["dir_nn_weights"] + "/NN" + str(inn)
+            nrw.save_nn_weights(member_parameters[inn], filename_nn_weights, precision=nn_params["weights_precision"])
+            nn_hyperparams["cost"][inn] = costs[-1,inn]
+            nn_hyperparams["train_acc"][inn] = train_acc[-1,inn]
+            nn_hyperparams["test_acc"][inn] = test_acc[-1,inn]
+        remove_checkpoints(checkpoint_dir)
+        print("Trained ensemble of neural networks with seeds: ", nn_hyperparams["initialize_seed"])
+    else:
+        for inn in range(nn_params["num_nn"]):
+            checkpoint_dir = checkpoint_location(nn_params, "NN" + str(inn))
+            parameters, costs, train_acc, test_acc, epochs = tfnn.model_wrapper(nn_params, nn_dataset, nn_hyperparams["num_epochs"][inn], nn_hyperparams["learning_rate"][inn], nn_hyperparams["hidden_units1"][inn], nn_hyperparams["hidden_units2"][inn], nn_hyperparams["hidden_units3"][inn], initialize_seed = nn_hyperparams["initialize_seed"][inn], print_cost = print_cost, use_final_sigmoid = nn_hyperparams["use_final_sigmoid"][inn], jit_compile = nn_params["jit_compile"], checkpoint_dir = checkpoint_dir, checkpoint_every = nn_params["checkpoint_every"], early_stopping_patience = nn_params["early_stopping_patience"])
+            filename_nn_weights = nn_params["dir_nn_weights"] + "/NN" + str(inn)
+            nrw.save_nn_weights(parameters, filename_nn_weights, precision=nn_params["weights_precision"])
+            nn_hyperparams["cost"][inn] = costs[-1]
+            nn_hyperparams["train_acc"][inn] = train_acc[-1]
+            nn_hyperparams["test_acc"][inn] = test_acc[-1]
+            remove_checkpoints(checkpoint_dir)
+            print("Trained neural network index/seed: ", inn)
     filename_hyperparams = nn_params["dir_nn_weights"] + "/" + nn_params["filename_hyperparams"]
     nrw.save_nn_weights(nn_hyperparams, filename_hyperparams)
 
@@ -129,13 +175,19 @@ def main(argv):
     root_dir = argv[1]
     num_epochs = int(argv[2])
     num_nn = int(argv[3])
-    use_final_sigmoid = argv[4]
+    use_final_sigmoid = int(argv[4])
 
     sys_params = tdg.define_system_params(root_dir)
-    X_all, Y_all, avg_powers_all = import_training_data(sys_params)
     nn_params = define_nn_params(num_nn)
-    nn_dataset = seperate_test_set(X_all, Y_all, avg_powers_all, nn_params)
-    nn_dataset = normalise(nn_dataset)
+    if len(argv) > 5:
+        nn_params["use_streaming"] = bool(int(argv[5]))
+    if nn_params["use_streaming"]:
+        import tf_neural_network as tfnn
+        nn_dataset = tfnn.streaming_training_datasets(nn_params, sys_params["root_dir"] + "/" + sys_params["trainingdata_filename"])
+    else:
+        X_all, Y_all, avg_powers_all = nrw.import_training_data(sys_params)
+        nn_dataset = seperate_test_set(X_all, Y_all, avg_powers_all, nn_params)
+        nn_dataset = normalise(nn_dataset)
 
     if (nn_params["num_nn"] > 0):
         nn_hyperparams = define_nn_hyperparams(num_epochs, num_nn, mean=nn_dataset["mu"], std_dev=nn_dataset["sigma"], use_final_sigmoid=use_final_sigmoid)
@@ -0,0 +1,108 @@
+import numpy as np
+import netcdf_read_write as nrw
+
+
+def read_nn_weights(filename_nn_weights, dtype=np.float32):
+    # contiguous arrays of a single dtype so every matmul goes straight to BLAS
+    nn_weights = nrw.read_nn_weights(filename_nn_weights)
+    parameters = {}
+    for key in nn_weights.keys():
+        parameters[key] = np.ascontiguousarray(np.array(nn_weights[key], dtype=dtype))
+    return parameters
+
+
+
+def apply_network(x_test, nn_weights, use_final_sigmoid, batch_size=65536):
+    """
+    NumPy equivalent of tfnn.apply_network, evaluated batch_size examples at a time. x_test has shape
+    (number of examples, input size) and the prediction (output size, number of examples).
+    """
+    num_examples = np.shape(x_test)[0]
+    input_size = np.shape(x_test)[1]
+    X_test = np.array(x_test, dtype=np.float32).reshape((num_examples, input_size)).T
+
+    if "W1_scale" in nn_weights.keys():
+        # int8 weights from quantise_parameters
+        parameters = nn_weights
+        forward = forward_propagation_int8
+    else:
+        parameters = {}
+        for key in nn_weights.keys():
+            parameters[key] = np.asarray(nn_weights[key], dtype=np.float32)
+        forward = forward_propagation
+
+    y_pred = np.zeros((np.shape(parameters["W4"])[0], num_examples), dtype=np.float32)
+    for il in range(0, num_examples, batch_size):
+        iu = min(il + batch_size, num_examples)
+        y_pred[:,il:iu] = forward(X_test[:,il:iu], parameters, use_final_sigmoid)
+
+    return y_pred
+
+
+
+def forward_propagation(X, parameters, use_final_sigmoid):
+    """
+    Implements the same model as tfnn.forward_propagation:
+    LINEAR -> RELU -> LINEAR -> RELU -> LINEAR -> RELU -> LINEAR -> SIGMOID (or RELU)
+
+    Arguments:
+    X -- input dataset, of shape (input size, number of examples)
+    parameters -- python dictionary containing "W1", "b1", ..., "W4", "b4"
+
+    Returns:
+    A4 -- the output of the network, of shape (output size, number of examples)
+    """
+    W1 = parameters['W1']
+    b1 = parameters['b1']
+    W2 = parameters['W2']
+    b2 = parameters['b2']
+    W3 = parameters['W3']
+    b3 = parameters['b3']
+    W4 = parameters['W4']
+    b4 = parameters['b4']
+
+    A1 = np.maximum(np.matmul(W1, X) + b1, 0.0)
+    A2 = np.maximum(np.matmul(W2, A1) + b2, 0.0)
+    A3 = np.maximum(np.matmul(W3, A2) + b3, 0.0)
+    Z4 = np.matmul(W4, A3) + b4
+    A4 = final_activation(Z4, use_final_sigmoid)
+
+    return A4
+
+
+
+def final_activation(Z4, use_final_sigmoid):
+    if use_final_sigmoid==1:
+        with np.errstate(over='ignore'): # exp overflow gives the correct limit of 0
+            A4 = 1.0 / (1.0 + np.exp(-Z4))
+    else:
+        A4 = np.maximum(Z4, 0.0)
+    return A4
+
+
+
+def quantise_parameters(parameters):
+    # int8 weight matrices with a float32 scale per row (output channel), biases stay float32
+    quantised = {}
+    for key, item in parameters.items():
+        if key.startswith("W"):
+            stored, _, scale = nrw.encode_nn_weights(item, "i1")
+            quantised[key] = stored
+            quantised[key + "_scale"] = scale[:,np.newaxis].astype(np.float32)
+        else:
+            quantised[key] = np.asarray(item, dtype=np.float32)
+    return quantised
+
+
+
+def forward_propagation_int8(X, quantised, use_final_sigmoid):
+    # NumPy has no int8 GEMM, each layer is expanded to float32 only while it is applied
+    A = X
+    for il in range(1, 5):
+        W = quantised["W"+str(il)]
+        Z = np.matmul(W.astype(np.float32), A) * quantised["W"+str(il)+"_scale"] + quantised["b"+str(il)]
+        if il < 4:
+            A = np.maximum(Z, 0.0)
+    A4 = final_activation(Z, use_final_sigmoid)
+
+    return A4
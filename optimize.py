@@ -1,4 +1,3 @@
-#some code copied from https://github.com/fmfn/BayesianOptimization edited by Duncan Barlow
 #some code copied from https://github.com/ahmedfgad/GeneticAlgorithmPython/tree/master/Tutorial%20Project edited by Duncan Barlow
 import training_data_generation as tdg
 import netcdf_read_write as nrw
@@ -9,115 +8,220 @@ import sys
 import time
 import os
 import shutil
-import copy
 
 
-def wrapper_bayesian_optimisation(dataset, bo_params, opt_params):
-    pbounds = {}
-    for ii in range(opt_params["num_optimization_params"]):
-        pbounds["x"+str(ii)] = opt_params["pbounds"][ii,:]
+def wrapper_bayesian_optimisation(dataset, bo_params, opt_params, resume_state=None):
+    import utils_gaussian_process as ugp
 
-    target = uopt.fitness_function(dataset, opt_params)
-
-    optimizer, utility = uopt.initialize_unknown_func(dataset["input_parameters"],
-                                                      target, pbounds,
-                                                      opt_params["num_init_examples"],
-                                                      opt_params["num_optimization_params"])
+    dataset = uopt.optimizer_start_dataset(dataset, opt_params, resume_state)
+    first_iteration = 0
+    if resume_state is None:
+        num_evaluated = dataset["num_evaluated"]
+        target = uopt.tracked_fitness(dataset, opt_params)
+        bo_state = ugp.initialise_bayesian_optimiser(dataset["input_parameters"][:num_evaluated,:],
+                                                     target[:num_evaluated], bo_params["gp_params"],
+                                                     opt_params["pbounds"], opt_params["random_generator"])
+        uopt.save_optimizer_state(dataset, opt_params, "bayesian_optimisation", 0, ugp.bayesian_optimiser_state(bo_state))
+    else:
+        bo_state = ugp.restore_bayesian_optimiser(resume_state, bo_params["gp_params"], opt_params["pbounds"],
+                                                  opt_params["random_generator"])
+        first_iteration = resume_state["iteration"]
     print("Starting Bayesian optimizer")
 
     tic = time.perf_counter()
-    for it in range(opt_params["n_iter"]):
-        optimizer2 = copy.deepcopy(optimizer)
+    for it in range(first_iteration, opt_params["n_iter"]):
+        X_new = ugp.suggest_batch(bo_state, bo_params["ifriit_runs_per_iteration"])
 
-        X_new = np.zeros((bo_params["ifriit_runs_per_iteration"], opt_params["num_optimization_params"]))
         old_max_eval = dataset["num_evaluated"]
+        dataset = uopt.run_ifriit_input(bo_params["ifriit_runs_per_iteration"], X_new, opt_params)
 
-        for npar in range(bo_params["ifriit_runs_per_iteration"]):
-            ieval = old_max_eval + npar
-            next_point = optimizer2.suggest(utility)
-            for ii in range(opt_params["num_optimization_params"]):
-                X_new[npar,ii] = next_point["x"+str(ii)]
-
-            try:
-                optimizer2.register(params=next_point, target=bo_params["target_set_undetermined"])
-            except:
-                boolean_array = np.isclose(X_new[npar,0], dataset["input_parameters"][:,0], rtol=1.0e-5)
-                print("Broken input! Likely degererate, index: ", ieval)
-                print("First parameter degenerate with: ", np.where(boolean_array))
-
-                print("Trying random mutation:")
-                for_mutation = X_new[npar,:].reshape((1,opt_params["num_optimization_params"]))
-                print("old: ", for_mutation)
-                after_mutation = uopt.mutation(for_mutation, opt_params["random_generator"],
-                                           opt_params["pbounds"],
-                                           num_mutations=bo_params["num_mutations"],
-                                           mutation_amplitude=bo_params["mutation_amplitude"])
-                print("new: ", after_mutation)
-                X_new[npar,:] = after_mutation[0,:]
+        target = uopt.tracked_fitness(dataset, opt_params)
+        bo_state = ugp.register_observations(bo_state, dataset["input_parameters"][old_max_eval:dataset["num_evaluated"],:],
+                                             target[old_max_eval:dataset["num_evaluated"]])
+        uopt.save_optimizer_state(dataset, opt_params, "bayesian_optimisation", it+1, ugp.bayesian_optimiser_state(bo_state))
+
+        if (it+1)%opt_params["printout_iteration_skip"] <= 0.0:
+            uopt.printout_optimizer_iteration(tic, dataset, opt_params)
+    uopt.save_optimizer_state(dataset, opt_params, "bayesian_optimisation", opt_params["n_iter"], {}, finished=True)
+    return dataset
 
-        old_max_eval = dataset["num_evaluated"]
-        dataset = uopt.run_ifriit_input(bo_params["ifriit_runs_per_iteration"], X_new, opt_params)
 
-        target = uopt.fitness_function(dataset, opt_params)
-        for npar in range(bo_params["ifriit_runs_per_iteration"]):
-            ieval = old_max_eval + npar
 
-            for ii in range(opt_params["num_optimization_params"]):
-                next_point["x"+str(ii)] = dataset["input_parameters"][ieval,ii]
+def wrapper_cmaes(dataset, cmaes_params, opt_params, resume_state=None):
+    # warm-started from the num_warm_start best examples, restarted with a doubled population (IPOP) when
+    # it converges, up to max_restarts times
+    import utils_cmaes as ucma
+
+    dataset = uopt.optimizer_start_dataset(dataset, opt_params, resume_state)
+    first_iteration = 0
+    if resume_state is None:
+        num_evaluated = dataset["num_evaluated"]
+        target = uopt.tracked_fitness(dataset, opt_params)
+        X_warm, target_warm = None, None
+        if cmaes_params["num_warm_start"] > 0:
+            best = np.argsort(-target[:num_evaluated], kind="stable")[:cmaes_params["num_warm_start"]]
+            X_warm = dataset["input_parameters"][best,:]
+            target_warm = target[best]
+        es = ucma.initialise_cmaes(cmaes_params, opt_params["pbounds"], opt_params["random_generator"],
+                                   X_warm=X_warm, target_warm=target_warm)
+        num_restarts = 0
+        state = ucma.cmaes_state(es)
+        state["num_restarts"] = num_restarts
+        uopt.save_optimizer_state(dataset, opt_params, "cmaes", 0, state)
+    else:
+        es = ucma.restore_cmaes(resume_state, opt_params["pbounds"], opt_params["random_generator"])
+        num_restarts = int(resume_state["num_restarts"])
+        first_iteration = resume_state["iteration"]
+    print("Starting CMA-ES with step size {:.3f}".format(es["sigma"]))
+
+    tic = time.perf_counter()
+    for it in range(first_iteration, opt_params["n_iter"]):
+        X_unit, X_new = ucma.ask(es)
+        dataset = uopt.run_ifriit_input(es["population_size"], X_new, opt_params)
 
-            try:
-                optimizer.register(params=next_point, target=target[ieval])
-            except:
-                print("Broken input!", next_point, target[ieval])
+        target = uopt.tracked_fitness(dataset, opt_params)
+        es = ucma.tell(es, X_unit, target[-es["population_size"]:])
 
         if (it+1)%opt_params["printout_iteration_skip"] <= 0.0:
+            print("Generation {} step size {:.2e} best of generation: {}".format(it+1, es["sigma"],
+                                                                                 np.max(target[-es["population_size"]:])))
             uopt.printout_optimizer_iteration(tic, dataset, opt_params)
+
+        reason = ucma.should_restart(es, cmaes_params)
+        if reason != "":
+            if num_restarts >= cmaes_params["max_restarts"]:
+                print("CMA-ES converged (" + reason + "), no restarts left")
+                break
+            es = ucma.restart(es, cmaes_params)
+            num_restarts += 1
+            print("CMA-ES restart " + str(num_restarts) + " (" + reason + ") with population " + str(es["population_size"]))
+
+        state = ucma.cmaes_state(es)
+        state["num_restarts"] = num_restarts
+        uopt.save_optimizer_state(dataset, opt_params, "cmaes", it+1, state)
+    uopt.save_optimizer_state(dataset, opt_params, "cmaes", opt_params["n_iter"], {}, finished=True)
     return dataset
 
 
 
-def wrapper_gradient_ascent(dataset, gd_params, opt_params):
-    learning_rate = 10.0**gd_params["learn_exp"]
-    step_size = np.array([gd_params["learn_exp"] - 1.0, gd_params["learn_exp"] + 1.0])
+def wrapper_nsga2(dataset, nsga2_params, opt_params, resume_state=None):
+    # every evaluated example goes through the Pareto archive, written to the run directory each generation
+    import utils_pareto as upar
+
+    dataset = uopt.optimizer_start_dataset(dataset, opt_params, resume_state)
+    num_evaluated = dataset["num_evaluated"]
+    objectives = uopt.pareto_objectives(dataset, opt_params)[:num_evaluated,:]
+    archive = upar.define_pareto_archive()
+    upar.archive_insert(archive, objectives, np.arange(num_evaluated))
+    archive_filename = opt_params["run_dir"] + "/" + nsga2_params["archive_filename"]
+    population_size = nsga2_params["population_size"]
+    first_iteration = 0
+    if resume_state is None:
+        population = upar.environmental_selection(objectives, population_size)
+        uopt.save_optimizer_state(dataset, opt_params, "nsga2", 0, {"population":population})
+    else:
+        population = np.array(resume_state["population"], dtype=int)
+        first_iteration = resume_state["iteration"]
+    print("Starting NSGA-II with " + str(len(archive["rows"])) + " examples on the front")
+
+    tic = time.perf_counter()
+    for it in range(first_iteration, opt_params["n_iter"]):
+        fronts = upar.nondominated_sort(objectives[population,:])
+        distance = upar.crowding_distance(objectives[population,:], fronts)
+        parents = population[upar.binary_tournament(fronts, distance, population_size, opt_params["random_generator"])]
+        X_new = uopt.crossover(dataset["input_parameters"][parents,:], (population_size, nsga2_params["num_dims"]),
+                               method="sbx", rng=opt_params["random_generator"], pbounds=opt_params["pbounds"],
+                               sbx_eta=nsga2_params["sbx_eta"])
+        X_new = uopt.mutation(X_new, opt_params["random_generator"], opt_params["pbounds"],
+                              nsga2_params["num_mutations"], nsga2_params["mutation_amplitude"])
+
+        old_max_eval = dataset["num_evaluated"]
+        dataset = uopt.run_ifriit_input(population_size, X_new, opt_params)
+        new_rows = np.arange(old_max_eval, dataset["num_evaluated"])
+        new_objectives = uopt.pareto_objectives(dataset, opt_params, new_rows)
+        objectives = np.vstack((objectives, new_objectives))
+        num_added = upar.archive_insert(archive, new_objectives, new_rows)
+
+        candidates = np.concatenate((population, new_rows))
+        population = candidates[upar.environmental_selection(objectives[candidates,:], population_size)]
+        upar.save_pareto_archive(archive, dataset, archive_filename)
+        uopt.save_optimizer_state(dataset, opt_params, "nsga2", it+1, {"population":population})
+
+        if (it+1)%opt_params["printout_iteration_skip"] <= 0.0:
+            print("Generation {}: {} new examples on the front of {}".format(it+1, num_added, len(archive["rows"])))
+            uopt.printout_optimizer_iteration(tic, dataset, opt_params)
+    uopt.save_optimizer_state(dataset, opt_params, "nsga2", opt_params["n_iter"], {}, finished=True)
+    return dataset
+
+
+
+def wrapper_gradient_ascent(dataset, gd_params, opt_params, resume_state=None):
+    # the state is saved after both the stencil and the line search, so a resumed run can start at either
     stencil_size = opt_params["num_optimization_params"] * 2
+    dataset = uopt.optimizer_start_dataset(dataset, opt_params, resume_state)
+    first_iteration = 0
+    run_stencil = True
+    if resume_state is None:
+        learning_rate = 10.0**gd_params["learn_exp"]
+        step_size = np.array([gd_params["learn_exp"] - 1.0, gd_params["learn_exp"] + 1.0])
 
-    target = uopt.fitness_function(dataset, opt_params)
+        target = uopt.tracked_fitness(dataset, opt_params)
 
-    X_old = np.zeros((1, opt_params["num_optimization_params"]))
-    maxdex_new = np.argmax(target)
-    X_old[0,:] = dataset["input_parameters"][maxdex_new,:]
+        X_old = np.zeros((1, opt_params["num_optimization_params"]))
+        maxdex_new = uopt.best_fitness_row(opt_params)
+        X_old[0,:] = dataset["input_parameters"][maxdex_new,:]
 
-    print("The index with the max fitness was: ", str(maxdex_new))
-    print("It had intial rms: {:.2f} %".format(dataset["rms"][maxdex_new, 0]*100.0), " and mean intensity: {:.2e}W/sr".format(dataset["avg_flux"][maxdex_new, 0]))
+        print("The index with the max fitness was: ", str(maxdex_new))
+        print("It had intial rms: {:.2f} %".format(dataset["rms"][maxdex_new, 0]*100.0), " and mean intensity: {:.2e}W/sr".format(dataset["avg_flux"][maxdex_new, 0]))
 
-    number_of_snapshots = np.shape(dataset["rms"][:,:])[1]
-    if number_of_snapshots != 1:
-        print("It had ablation pressure rms: {:.2f} %".format(dataset["rms"][maxdex_new, 1]*100.0), " and mean pressure: {:.2f}Mbar".format(dataset["avg_flux"][maxdex_new, 1]))
+        number_of_snapshots = np.shape(dataset["rms"][:,:])[1]
+        if number_of_snapshots != 1:
+            print("It had ablation pressure rms: {:.2f} %".format(dataset["rms"][maxdex_new, 1]*100.0), " and mean pressure: {:.2f}Mbar".format(dataset["avg_flux"][maxdex_new, 1]))
+        uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", 0,
+                                  {"learn_exp":gd_params["learn_exp"], "step_size":step_size, "X_old":X_old,
+                                   "maxdex":maxdex_new})
+    else:
+        gd_params["learn_exp"] = resume_state["learn_exp"]
+        learning_rate = 10.0**gd_params["learn_exp"]
+        step_size = resume_state["step_size"]
+        X_old = resume_state["X_old"]
+        maxdex_new = int(resume_state["maxdex"])
+        first_iteration = resume_state["iteration"]
+        run_stencil = "grad" not in resume_state.keys()
+        grad = resume_state.get("grad", None)
+        target = uopt.tracked_fitness(dataset, opt_params)
 
     tic = time.perf_counter()
-    for ieval in range(opt_params["n_iter"]):
+    for ieval in range(first_iteration, opt_params["n_iter"]):
         maxdex_old = maxdex_new
 
-        X_stencil = uopt.gradient_stencil(X_old, learning_rate, opt_params["pbounds"],
-                                     opt_params["num_optimization_params"], stencil_size)
-        dataset = uopt.run_ifriit_input(stencil_size, X_stencil, opt_params)
+        if run_stencil:
+            X_stencil = uopt.gradient_stencil(X_old, learning_rate, opt_params["pbounds"],
+                                         opt_params["num_optimization_params"], stencil_size)
+            dataset = uopt.run_ifriit_input(stencil_size, X_stencil, opt_params, redirect_duplicates=False)
 
-        target = uopt.fitness_function(dataset, opt_params)
-        target_stencil = target[-stencil_size:]
-        uopt.printout_optimizer_iteration(tic, dataset, opt_params)
+            target = uopt.tracked_fitness(dataset, opt_params)
+            target_stencil = target[-stencil_size:]
+            uopt.printout_optimizer_iteration(tic, dataset, opt_params)
+
+            grad = uopt.determine_gradient(X_stencil, target_stencil, target[maxdex_old], learning_rate,
+                                      opt_params["pbounds"], opt_params["num_optimization_params"])
+            grad = grad / np.sum(np.abs(grad))
+            uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", ieval,
+                                      {"learn_exp":gd_params["learn_exp"], "step_size":step_size, "X_old":X_old,
+                                       "maxdex":maxdex_old, "grad":grad})
+        run_stencil = True
 
-        grad = uopt.determine_gradient(X_stencil, target_stencil, target[maxdex_old], learning_rate,
-                                  opt_params["pbounds"], opt_params["num_optimization_params"])
-        grad = grad / np.sum(np.abs(grad))
         X_downhill = uopt.grad_ascent(X_old, grad, step_size, opt_params["pbounds"],
                              opt_params["num_optimization_params"],
                              gd_params["num_steps_per_iter"])
-        dataset = uopt.run_ifriit_input(gd_params["num_steps_per_iter"], X_downhill, opt_params)
+        dataset = uopt.run_ifriit_input(gd_params["num_steps_per_iter"], X_downhill, opt_params,
+                                        redirect_duplicates=False)
 
-        target = uopt.fitness_function(dataset, opt_params)
+        target = uopt.tracked_fitness(dataset, opt_params)
         uopt.printout_optimizer_iteration(tic, dataset, opt_params)
 
-        maxdex_new = np.argmax(target)
+        maxdex_new = uopt.best_fitness_row(opt_params)
         X_old[0,:] = dataset["input_parameters"][maxdex_new,:]
 
         if (maxdex_new == maxdex_old):
@@ -132,59 +236,281 @@ def wrapper_gradient_ascent(dataset, gd_params, opt_params):
 
         print("Iteration {} with learn rate {} value: {}".format(ieval, learning_rate, target[maxdex_new]))
         print(X_old)
+        uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", ieval+1,
+                                  {"learn_exp":gd_params["learn_exp"], "step_size":step_size, "X_old":X_old,
+                                   "maxdex":maxdex_new})
+    uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", opt_params["n_iter"], {}, finished=True)
     return dataset
 
 
 
-def wrapper_genetic_algorithm(dataset, ga_params, opt_params):
-    X_pop = dataset["input_parameters"]
+def wrapper_speculative_gradient_ascent(dataset, gd_params, opt_params, resume_state=None):
+    # the line search along the previous gradient, from the centre of its stencil, runs in the same batch
+    # as the stencil for the next gradient around the line search step that was best last iteration
+    num_inputs = opt_params["num_optimization_params"]
+    stencil_size = num_inputs * 2
+    num_steps = gd_params["num_steps_per_iter"]
+    X_old = np.zeros((1, num_inputs))
+
+    dataset = uopt.optimizer_start_dataset(dataset, opt_params, resume_state)
+    first_iteration = 0
+    if resume_state is None:
+        learning_rate = 10.0**gd_params["learn_exp"]
+        step_size = np.array([gd_params["learn_exp"] - 1.0, gd_params["learn_exp"] + 1.0])
+        grad = None
+        uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", 0,
+                                  {"learn_exp":gd_params["learn_exp"], "step_size":step_size})
+    else:
+        gd_params["learn_exp"] = resume_state["learn_exp"]
+        learning_rate = 10.0**gd_params["learn_exp"]
+        step_size = resume_state["step_size"]
+        grad = resume_state.get("grad", None)
+        predicted_step = int(resume_state.get("predicted_step", 0))
+        first_iteration = resume_state["iteration"]
+    target = uopt.tracked_fitness(dataset, opt_params)
+    if grad is not None:
+        centre_row = int(resume_state.get("centre_row", uopt.best_fitness_row(opt_params)))
+
+    if grad is None:
+        maxdex_new = uopt.best_fitness_row(opt_params)
+        X_old[0,:] = dataset["input_parameters"][maxdex_new,:]
+        print("The index with the max fitness was: ", str(maxdex_new))
+
+        X_stencil = uopt.gradient_stencil(X_old, learning_rate, opt_params["pbounds"], num_inputs, stencil_size)
+        dataset = uopt.run_ifriit_input(stencil_size, X_stencil, opt_params, redirect_duplicates=False)
+        target = uopt.tracked_fitness(dataset, opt_params)
+        grad = uopt.determine_gradient(X_stencil, target[-stencil_size:], target[maxdex_new], learning_rate,
+                                       opt_params["pbounds"], num_inputs)
+        grad = grad / np.sum(np.abs(grad))
+        predicted_step = num_steps // 2
+        centre_row = maxdex_new
+        uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", 0,
+                                  {"learn_exp":gd_params["learn_exp"], "step_size":step_size, "grad":grad,
+                                   "predicted_step":predicted_step, "centre_row":centre_row})
 
     tic = time.perf_counter()
-    for generation in range(opt_params["n_iter"]-1):
-        print("Generation : ", generation+1)
-        target = uopt.fitness_function(dataset, opt_params)
+    for ieval in range(first_iteration, opt_params["n_iter"]):
+        maxdex_old = uopt.best_fitness_row(opt_params)
+        # the gradient is only valid where its stencil was centred
+        X_old[0,:] = dataset["input_parameters"][centre_row,:]
 
-        # Selecting the best parents in the population for mating.
-        parents = uopt.select_mating_pool(X_pop, target[-ga_params["initial_pop_size"]:], ga_params["num_parents_mating"])
+        X_batch = uopt.speculative_gradient_batch(X_old, grad, step_size, predicted_step, learning_rate,
+                                                  opt_params["pbounds"], num_inputs, num_steps, stencil_size)
+        dataset = uopt.run_ifriit_input(num_steps + stencil_size, X_batch, opt_params, redirect_duplicates=False)
+
+        target = uopt.tracked_fitness(dataset, opt_params)
+        uopt.printout_optimizer_iteration(tic, dataset, opt_params)
+        # the stencil centre is itself a line search point
+        target_line = target[-(num_steps + stencil_size):-stencil_size]
+        grad = uopt.determine_gradient(X_batch[num_steps:,:], target[-stencil_size:], target_line[predicted_step],
+                                       learning_rate, opt_params["pbounds"], num_inputs)
+        grad = grad / np.sum(np.abs(grad))
+        centre_row = len(target) - (num_steps + stencil_size) + predicted_step
+        predicted_step = np.argmax(target_line)
+
+        maxdex_new = uopt.best_fitness_row(opt_params)
+        if (maxdex_new == maxdex_old):
+            gd_params["learn_exp"] = gd_params["learn_exp"]-0.5
+            learning_rate = 10.0**(gd_params["learn_exp"])
+            step_size = step_size - 0.5
+            print("Reducing step size to: " + str(learning_rate))
+            if learning_rate < 1.0e-4:
+                print("Early stopping due to repeated results")
+                break
+
+        print("Iteration {} with learn rate {} value: {}".format(ieval, learning_rate, target[maxdex_new]))
+        print(dataset["input_parameters"][maxdex_new,:])
+        uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", ieval+1,
+                                  {"learn_exp":gd_params["learn_exp"], "step_size":step_size, "grad":grad,
+                                   "predicted_step":predicted_step, "centre_row":centre_row})
+    uopt.save_optimizer_state(dataset, opt_params, "gradient_ascent", opt_params["n_iter"], {}, finished=True)
+    return dataset
 
-        # Generating next generation using crossover.
-        offspring_crossover = uopt.crossover(parents,
-                                             offspring_size=(ga_params["initial_pop_size"]
-                                                             - ga_params["num_parents_mating"],
-                                                             opt_params["num_optimization_params"]))
 
-        # Adding some variations to the offspring using mutation.
-        offspring_mutation = uopt.mutation(offspring_crossover, opt_params["random_generator"],
-                                           opt_params["pbounds"],
-                                           num_mutations=ga_params["num_mutations"],
-                                           mutation_amplitude=ga_params["mutation_amplitude"])
 
-        # Creating the new population based on the parents and offspring.
-        X_pop[0:ga_params["num_parents_mating"],:] = parents
-        X_pop[ga_params["num_parents_mating"]:,:] = offspring_mutation
+def wrapper_genetic_algorithm(dataset, ga_params, opt_params, resume_state=None):
+    dataset = uopt.optimizer_start_dataset(dataset, opt_params, resume_state)
+    X_pop = dataset["input_parameters"]
+    first_generation = 0
+    if resume_state is None:
+        uopt.save_optimizer_state(dataset, opt_params, "genetic_algorithm", 0, {"X_pop":X_pop})
+    else:
+        X_pop = resume_state["X_pop"]
+        first_generation = resume_state["iteration"]
+
+    tic = time.perf_counter()
+    for generation in range(first_generation, opt_params["n_iter"]-1):
+        print("Generation : ", generation+1)
+        target = uopt.tracked_fitness(dataset, opt_params)
+
+        # Selection of the best parents, crossover and mutation for the next population.
+        X_pop = uopt.evolve_population(X_pop, target[-ga_params["initial_pop_size"]:], ga_params,
+                                       opt_params["pbounds"], uopt.generation_generator(opt_params, generation))
 
         dataset = uopt.run_ifriit_input(ga_params["initial_pop_size"], X_pop, opt_params)
+        uopt.save_optimizer_state(dataset, opt_params, "genetic_algorithm", generation+1, {"X_pop":X_pop})
 
         if (generation+1)%opt_params["printout_iteration_skip"] <= 0.0:
             print(str((generation+1) * ga_params["initial_pop_size"]) + " data points added")
             uopt.printout_optimizer_iteration(tic, dataset, opt_params)
-    
+    uopt.save_optimizer_state(dataset, opt_params, "genetic_algorithm", opt_params["n_iter"]-1, {}, finished=True)
+    return dataset
+
+
+
+def wrapper_steady_state_genetic_algorithm(dataset, ga_params, opt_params, resume_state=None):
+    # an offspring is bred by tournament from the best initial_pop_size examples whenever a simulation
+    # slot frees up, and replaces the worst member if it is fitter
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    num_offspring = ga_params["num_offspring"]
+    if resume_state is not None:
+        opt_params.pop("resume_num_evaluated")
+        num_offspring = int(resume_state["first_offspring"]) + num_offspring - resume_state["num_evaluated"]
+    async_runs = uopt.prepare_async_runs(num_offspring, opt_params, resume_state)
+    dataset = async_runs["dataset"]
+    num_slots = ga_params["num_slots"] if ga_params["num_slots"] > 0 else async_runs["sys_params"]["num_parallel_ifriits"]
+    rng = opt_params["random_generator"]
+
+    rerun = []
+    if resume_state is None:
+        archive = np.where(async_runs["is_complete"])[0]
+        target = uopt.fitness_function(dataset, opt_params, rows=archive)
+        population = archive[np.argsort(-target)[:ga_params["initial_pop_size"]]]
+        first_offspring = len(archive)
+    else:
+        population = np.array(resume_state["population"], dtype=int)
+        first_offspring = int(resume_state["first_offspring"])
+        harvested, rerun = uopt.harvest_interrupted_runs(async_runs)
+        print("Resuming with " + str(len(harvested)) + " offspring finished since the state was saved, "
+              + str(len(rerun)) + " to run again")
+    population_fitness = np.array(uopt.fitness_function(dataset, opt_params, rows=population))
+
+    def breed():
+        parents = population[uopt.tournament_selection(population_fitness, 2, ga_params["tournament_size"], rng)]
+        offspring = uopt.crossover(dataset["input_parameters"][parents,:],
+                                   offspring_size=(1, opt_params["num_optimization_params"]),
+                                   method=ga_params["crossover_method"], rng=rng, pbounds=opt_params["pbounds"],
+                                   blend_alpha=ga_params["blend_alpha"], sbx_eta=ga_params["sbx_eta"])
+        return uopt.mutation(offspring, rng, opt_params["pbounds"], num_mutations=ga_params["num_mutations"],
+                             mutation_amplitude=ga_params["mutation_amplitude"])[0,:]
+
+    def register(iex):
+        fitness = uopt.fitness_function(dataset, opt_params, rows=[iex])[0]
+        iworst = np.argmin(population_fitness)
+        if fitness > population_fitness[iworst]:
+            population[iworst] = iex
+            population_fitness[iworst] = fitness
+        return fitness
+
+    def save_state(num_completed):
+        uopt.save_async_runs(async_runs)
+        uopt.save_optimizer_state(dataset, opt_params, "genetic_algorithm", num_completed,
+                                  {"first_offspring":first_offspring, "num_submitted":next_index,
+                                   "is_complete":async_runs["is_complete"][:next_index], "population":population})
+
+    if resume_state is not None:
+        for iex in harvested: # finished after the state was saved
+            register(iex)
+
+    tic = time.perf_counter()
+    next_index = async_runs["num_submitted"]
+    num_completed = int(np.sum(async_runs["is_complete"][first_offspring:]))
+    save_state(num_completed)
+    num_examples = async_runs["dataset_params"]["num_examples"]
+    running = {}
+    with ThreadPoolExecutor(max_workers=num_slots) as executor:
+        for iex in rerun:
+            running[uopt.submit_async_run(executor, iex, dataset["input_parameters"][iex,:], async_runs, is_rerun=True)] = iex
+        while (next_index < num_examples) and (len(running) < num_slots):
+            running[uopt.submit_async_run(executor, next_index, breed(), async_runs)] = next_index
+            next_index += 1
+
+        while len(running) > 0:
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                iex = running.pop(future)
+                dataset = uopt.harvest_async_run(iex, async_runs, cost=future.result())
+                # offspring complete out of order, only the new one is evaluated
+                fitness = register(iex)
+
+                num_completed += 1
+                if num_completed % opt_params["printout_iteration_skip"] == 0:
+                    print(str(num_completed) + " offspring evaluated, fitness of example " + str(iex) + ": " + str(fitness))
+                if num_completed % num_slots == 0:
+                    save_state(num_completed)
+                    if "surrogate_refresher" in opt_params.keys():
+                        import surrogate_refresh as sref
+                        sref.submit_dataset(opt_params["surrogate_refresher"], dataset)
+
+                if (next_index < num_examples) and (len(running) < num_slots):
+                    running[uopt.submit_async_run(executor, next_index, breed(), async_runs)] = next_index
+                    next_index += 1
+
+    uopt.save_async_runs(async_runs)
+    uopt.save_optimizer_state(dataset, opt_params, "genetic_algorithm", num_completed, {}, finished=True)
+    uopt.printout_optimizer_iteration(tic, dataset, opt_params)
     return dataset
 
 
 
+def optional_arguments(argv, first_index):
+    # key=value arguments after the positional ones
+    options = {}
+    for arg in argv[first_index:]:
+        key, value = arg.split("=", 1)
+        options[key] = value
+    return options
+
+
+
+def apply_optimizer_options(opt_params, options):
+    # with promote_fraction below 1 new examples are screened by their solid-sphere run first
+    if "promote_fraction" in options.keys():
+        opt_params["promote_fraction"] = float(options["promote_fraction"])
+    return opt_params
+
+
+
+def attach_surrogate_refresh(opt_params, options, refresher, num_trained):
+    # started the first time it is needed, the rows evaluated by then count as already seen
+    if "refresh_surrogate" not in options.keys():
+        return refresher
+    if refresher is None:
+        import surrogate_refresh as sref
+        refresh_params = sref.define_refresh_params(options["refresh_surrogate"])
+        refresher = sref.start_refresh_service(refresh_params, num_trained)
+    opt_params["surrogate_refresher"] = refresher
+    return refresher
+
+
+
 def main(argv):
     """ 
                        dir         iex  init_type  bayes_opt grad_descent random_sampler random_seed  dir
     python optimize.py Data_output 100   0-2 10     0-1 10     0-1  10        0           12345      Data_input
     python optimize.py Data_output 100 2 10 1 10 1 10 0 12345 Data_input
     index:                       1  2  3 4  5  6 7 8  9   10      11
+    Optional key=value arguments follow from index 12:
+    refresh_surrogate=neural_network_weights  fine-tune the surrogate on new runs in the background
+    ga_mode=steady_state  breed a new offspring whenever a simulation slot frees up (init_type 2)
+    gd_mode=speculative  run the line search and the next gradient stencil in one batch
+    cmaes_iterations=10  then run CMA-ES for this many generations of num_parallel_ifriits runs
+    nsga2_iterations=10  then run NSGA-II on rms and drive, writing the Pareto front to Data_output/pareto_archive.nc
+    promote_fraction=0.25  run the plasma profiles only for this fraction of solid-sphere screened examples
+    resume=1  continue from the optimizer state saved in Data_output, finished stages and runs are not repeated
     """
     #
     data_init_type = int(argv[3])
     input_dir = argv[11]
     output_dir = argv[1]
     num_examples = int(argv[2])
+    options = optional_arguments(argv, 12)
+    refresher = None
+    resume = options.get("resume", "0") == "1"
+    checkpoint = uopt.read_optimizer_state(output_dir) if resume else None
+    # without a saved optimizer state the optimisers never started, the initial data may be incomplete
+    init_run_type = "run_type=resume" if resume else "run_type=full"
     #random_seed = int(argv[10])
     #random_sampling = int(argv[9])
 
@@ -192,14 +518,17 @@ def main(argv):
 
     if data_init_type == 1: # Generate new initialization dataset
         print("Generating data!")
-
-        dataset, dataset_params, sys_params, facility_spec = tdg.main((None, sys_params["root_dir"], num_examples, "run_type=full"))
+        if checkpoint is None:
+            dataset, dataset_params, sys_params, facility_spec = tdg.main((None, sys_params["root_dir"], num_examples, init_run_type))
 
     elif data_init_type == 2: # Genetic algorithm
         print("Using a genetic algorithm!")
         ga_n_iter = int(argv[4])
         initial_pop_size = num_examples
-        dataset, dataset_params, sys_params, facility_spec = tdg.main((None, sys_params["root_dir"], initial_pop_size, "run_type=full"))
+        if checkpoint is None:
+            dataset, dataset_params, sys_params, facility_spec = tdg.main((None, sys_params["root_dir"], initial_pop_size, init_run_type))
+        else:
+            dataset, dataset_params, _, facility_spec = idg.load_data_dicts_from_file(sys_params)
 
         num_parents_mating = int(initial_pop_size / 10.0)
         if (num_parents_mating % 2) != 0:
@@ -212,10 +541,22 @@ def main(argv):
                                                      num_init_examples, ga_n_iter, dataset_params["random_seed"],
                                                      facility_spec, sys_params["run_clean"])
         num_mutations = int(opt_params["num_optimization_params"] / 2)
+        opt_params = apply_optimizer_options(opt_params, options)
+        refresher = attach_surrogate_refresh(opt_params, options, refresher, dataset["num_evaluated"])
 
         ga_params = uopt.define_genetic_algorithm_params(initial_pop_size, num_parents_mating, num_mutations)
-        dataset = wrapper_genetic_algorithm(dataset, ga_params, opt_params)
-
+        resume_state = uopt.resume_optimizer_state(checkpoint, opt_params, "genetic_algorithm")
+        if uopt.stage_finished(checkpoint, "genetic_algorithm"):
+            print("The genetic algorithm has already finished")
+        elif options.get("ga_mode", "generational") == "steady_state":
+            # the same number of evaluations as the generational algorithm
+            ga_params["num_offspring"] = (ga_n_iter - 1) * initial_pop_size
+            dataset = wrapper_steady_state_genetic_algorithm(dataset, ga_params, opt_params, resume_state)
+        else:
+            dataset = wrapper_genetic_algorithm(dataset, ga_params, opt_params, resume_state)
+
+    elif (data_init_type == 0) and (checkpoint is not None):
+        print("Resuming with the data already imported")
     elif data_init_type == 0:
         print("Importing pre-generated data!")
         # copy across dataset_params and facility_spec
@@ -238,33 +579,70 @@ def main(argv):
     num_init_examples = dataset["num_evaluated"]
 
     use_bayesian_optimization = bool(int(argv[5]))
-    if use_bayesian_optimization: # Bayesian optimization
+    if use_bayesian_optimization and not uopt.stage_finished(checkpoint, "bayesian_optimisation"): # Bayesian optimization
         bo_n_iter = int(argv[6])
         opt_params = uopt.define_optimizer_parameters(output_dir, dataset_params["num_input_params"],
                                                      num_init_examples, bo_n_iter,
                                                      dataset_params["random_seed"], facility_spec, sys_params["run_clean"])
+        opt_params = apply_optimizer_options(opt_params, options)
+        refresher = attach_surrogate_refresh(opt_params, options, refresher, dataset["num_evaluated"])
         ifriit_runs_per_bo_iteration = sys_params["num_parallel_ifriits"]
 
-        target = uopt.fitness_function(dataset, opt_params)
-        target_set_undetermined = np.mean(target) / 2.0 # half mean for all undetermined BO values
-        num_mutations = int(opt_params["num_optimization_params"] / 2)
-        bo_params = uopt.define_bayesian_optimisation_params(ifriit_runs_per_bo_iteration, target_set_undetermined, num_mutations)
-        dataset = wrapper_bayesian_optimisation(dataset, bo_params, opt_params)
+        bo_params = uopt.define_bayesian_optimisation_params(ifriit_runs_per_bo_iteration, opt_params["num_optimization_params"])
+        resume_state = uopt.resume_optimizer_state(checkpoint, opt_params, "bayesian_optimisation")
+        dataset = wrapper_bayesian_optimisation(dataset, bo_params, opt_params, resume_state)
         num_init_examples = dataset["num_evaluated"]
 
     use_gradient_ascent = bool(int(argv[7]))
-    if use_gradient_ascent: # Gradient ascent
+    if use_gradient_ascent and not uopt.stage_finished(checkpoint, "gradient_ascent"): # Gradient ascent
         print("Using gradient ascent!")
         gd_n_iter = int(argv[8])
         line_search_evaluations = sys_params["num_parallel_ifriits"]
         opt_params = uopt.define_optimizer_parameters(output_dir, dataset_params["num_input_params"],
                                                      num_init_examples, gd_n_iter,
                                                      dataset_params["random_seed"], facility_spec, sys_params["run_clean"])
+        opt_params = apply_optimizer_options(opt_params, options)
+        refresher = attach_surrogate_refresh(opt_params, options, refresher, dataset["num_evaluated"])
 
         gd_params = uopt.define_gradient_ascent_params(line_search_evaluations, dataset_params["num_input_params"])
-        dataset = wrapper_gradient_ascent(dataset, gd_params, opt_params)
+        resume_state = uopt.resume_optimizer_state(checkpoint, opt_params, "gradient_ascent")
+        if options.get("gd_mode", "sequential") == "speculative":
+            dataset = wrapper_speculative_gradient_ascent(dataset, gd_params, opt_params, resume_state)
+        else:
+            dataset = wrapper_gradient_ascent(dataset, gd_params, opt_params, resume_state)
+        num_init_examples = dataset["num_evaluated"]
+
+    if ("cmaes_iterations" in options.keys()) and not uopt.stage_finished(checkpoint, "cmaes"): # CMA-ES
+        print("Using CMA-ES!")
+        cmaes_n_iter = int(options["cmaes_iterations"])
+        opt_params = uopt.define_optimizer_parameters(output_dir, dataset_params["num_input_params"],
+                                                     num_init_examples, cmaes_n_iter,
+                                                     dataset_params["random_seed"], facility_spec, sys_params["run_clean"])
+        opt_params = apply_optimizer_options(opt_params, options)
+        refresher = attach_surrogate_refresh(opt_params, options, refresher, dataset["num_evaluated"])
+
+        cmaes_params = uopt.define_cmaes_optimisation_params(sys_params["num_parallel_ifriits"], opt_params["num_optimization_params"])
+        resume_state = uopt.resume_optimizer_state(checkpoint, opt_params, "cmaes")
+        dataset = wrapper_cmaes(dataset, cmaes_params, opt_params, resume_state)
+        num_init_examples = dataset["num_evaluated"]
+
+    if ("nsga2_iterations" in options.keys()) and not uopt.stage_finished(checkpoint, "nsga2"): # multi-objective
+        print("Using NSGA-II!")
+        nsga2_n_iter = int(options["nsga2_iterations"])
+        opt_params = uopt.define_optimizer_parameters(output_dir, dataset_params["num_input_params"],
+                                                     num_init_examples, nsga2_n_iter,
+                                                     dataset_params["random_seed"], facility_spec, sys_params["run_clean"])
+        opt_params = apply_optimizer_options(opt_params, options)
+        refresher = attach_surrogate_refresh(opt_params, options, refresher, dataset["num_evaluated"])
+
+        nsga2_params = uopt.define_nsga2_optimisation_params(sys_params["num_parallel_ifriits"], opt_params["num_optimization_params"])
+        resume_state = uopt.resume_optimizer_state(checkpoint, opt_params, "nsga2")
+        dataset = wrapper_nsga2(dataset, nsga2_params, opt_params, resume_state)
         num_init_examples = dataset["num_evaluated"]
 
+    if refresher is not None:
+        import surrogate_refresh as sref
+        sref.stop_refresh_service(refresher)
     return
 
 
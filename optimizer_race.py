@@ -0,0 +1,315 @@
+import numpy as np
+import contextlib
+import importlib.util
+import os
+import sys
+import time
+import training_data_generation as tdg
+import netcdf_read_write as nrw
+import utils_optimizers as uopt
+import utils_deck_generation as idg
+import optimize as opt
+
+RACE_OPTIMISERS = ["genetic_algorithm", "steady_state_genetic_algorithm", "gradient_ascent",
+                   "speculative_gradient_ascent", "bayesian_optimisation", "cmaes", "nsga2"]
+ASYNC_OPTIMISERS = ["steady_state_genetic_algorithm"]
+
+
+def define_race_params(dir_race, **kwargs):
+    race_params = {}
+    race_params["dir_race"] = dir_race
+    race_params["optimisers"] = kwargs.get("optimisers", RACE_OPTIMISERS)
+    race_params["num_seeds"] = kwargs.get("num_seeds", 5)
+    race_params["first_seed"] = kwargs.get("first_seed", 12345)
+    race_params["num_init_examples"] = kwargs.get("num_init_examples", 20) # shared initial design
+    race_params["num_simulations"] = kwargs.get("num_simulations", 200) # budget after the initial design
+    race_params["objective"] = kwargs.get("objective", "analytic") # or trained networks, a directory or registry:name
+    race_params["num_slots"] = kwargs.get("num_slots", 4) # simulations run at once
+    race_params["simulation_hours"] = kwargs.get("simulation_hours", 1.0) # mean duration of one Ifriit run
+    race_params["simulation_hours_spread"] = kwargs.get("simulation_hours_spread", 0.3) # log-normal width
+    race_params["filename_report"] = kwargs.get("filename_report", "optimizer_race.nc")
+    return race_params
+
+
+
+def analytic_objective(dataset_params, opt_params):
+    # a bowl around a fixed optimum with a ripple on top, the flux is held at its desired value so
+    # fitness_function only rewards a low rms
+    x_opt = np.random.default_rng(0).uniform(0.2, 0.8, dataset_params["num_input_params"])
+
+    def evaluate(X):
+        deviation = X - x_opt
+        rms = 0.02 + 0.3 * np.mean(deviation**2, axis=1) + 0.01 * (1.0 - np.mean(np.cos(6.0 * np.pi * deviation), axis=1))
+        avg_flux = np.full(np.shape(X)[0], opt_params["fitness_desired_power_per_steradian"])
+        return rms, avg_flux
+
+    return evaluate
+
+
+
+def surrogate_objective(dir_nn_weights, dataset_params, opt_params, registry=None):
+    # the rms predicted by the trained networks, a directory or a registered surrogate name, the flux is
+    # not predicted and is held at its desired value
+    import surrogate_predictor as spred
+    if registry is None:
+        predictor = spred.load_predictor(spred.define_predictor_params(dir_nn_weights, dataset_params["LMAX"],
+                                                                       num_input_params=dataset_params["num_input_params"]))
+    else:
+        import surrogate_registry as sreg
+        predictor = sreg.load_surrogate(registry, dir_nn_weights, expected={"LMAX": dataset_params["LMAX"]},
+                                        num_input_params=dataset_params["num_input_params"])
+
+    def evaluate(X):
+        _, rms = spred.predict(predictor, X)
+        avg_flux = np.full(np.shape(X)[0], opt_params["fitness_desired_power_per_steradian"])
+        return rms, avg_flux
+
+    return evaluate
+
+
+
+def define_race_log():
+    race_log = {}
+    race_log["rows"] = [] # (start, stop, wall time) of each objective call
+    race_log["tic"] = time.perf_counter()
+    return race_log
+
+
+
+def objective_function(evaluate, race_log):
+    # the hook called by uopt.run_ifriit_input and uopt.harvest_async_run
+    def objective(dataset, start, stop):
+        rms, avg_flux = evaluate(dataset["input_parameters"][start:stop,:])
+        dataset["rms"][start:stop,:] = rms[:,np.newaxis]
+        dataset["avg_flux"][start:stop,:] = avg_flux[:,np.newaxis]
+        race_log["rows"].append((start, stop, time.perf_counter() - race_log["tic"]))
+        return dataset
+
+    return objective
+
+
+
+def simulated_completion_hours(race_log, num_init_examples, num_slots, is_async, random_generator, race_params):
+    # log-normal run durations on num_slots slots. A batch starts once every earlier row has finished,
+    # in the asynchronous optimisers a row starts as soon as a slot is free
+    num_rows = max([stop for _, stop, _ in race_log["rows"]] + [num_init_examples])
+    spread = race_params["simulation_hours_spread"]
+    durations = race_params["simulation_hours"] * random_generator.lognormal(-0.5 * spread**2, spread, num_rows)
+    completion = np.zeros(num_rows)
+    slot_free = np.zeros(num_slots)
+    for start, stop, _ in race_log["rows"]:
+        if start < num_init_examples:
+            continue
+        barrier = 0.0 if is_async else np.max(completion[:start])
+        for iex in range(start, stop):
+            islot = np.argmin(slot_free)
+            completion[iex] = max(slot_free[islot], barrier) + durations[iex]
+            slot_free[islot] = completion[iex]
+    return completion[num_init_examples:]
+
+
+
+def prepare_race_dir(run_dir, seed, evaluate_factory, race_params):
+    # the shared initial design, evaluated with the objective and written as by training_data_generation
+    os.makedirs(run_dir, exist_ok=True)
+    sys_params = tdg.define_system_params(run_dir)
+    dataset_params, facility_spec = tdg.define_dataset_params(race_params["num_init_examples"], random_seed=seed)
+    dataset = tdg.define_dataset(dataset_params)
+    dataset = tdg.populate_dataset_random_inputs(dataset_params, dataset)
+    deck_gen_params = idg.define_deck_generation_params(dataset_params, facility_spec)
+
+    opt_params = uopt.define_optimizer_parameters(run_dir, dataset_params["num_input_params"],
+                                                  race_params["num_init_examples"], 0, seed, facility_spec, True)
+    evaluate = evaluate_factory(dataset_params, opt_params)
+    rms, avg_flux = evaluate(dataset["input_parameters"])
+    dataset["rms"][:,:] = rms[:,np.newaxis]
+    dataset["avg_flux"][:,:] = avg_flux[:,np.newaxis]
+    dataset["num_evaluated"] = race_params["num_init_examples"]
+    idg.save_data_dicts_to_file(sys_params, dataset, dataset_params, deck_gen_params, facility_spec)
+    return dataset, dataset_params, facility_spec, evaluate
+
+
+
+def run_optimiser(optimiser, dataset, dataset_params, facility_spec, opt_params, race_params, resume_state=None):
+    # each optimiser's iterations are rounded up so it spends at least num_simulations runs
+    num_slots = race_params["num_slots"]
+    num_params = dataset_params["num_input_params"]
+    budget = race_params["num_simulations"]
+    pop_size = race_params["num_init_examples"]
+
+    if optimiser in ("genetic_algorithm", "steady_state_genetic_algorithm"):
+        num_parents_mating = max(2, int(pop_size / 10.0) - (int(pop_size / 10.0) % 2))
+        ga_params = uopt.define_genetic_algorithm_params(pop_size, num_parents_mating, int(num_params / 2))
+        if optimiser == "steady_state_genetic_algorithm":
+            ga_params["num_offspring"] = budget
+            ga_params["num_slots"] = num_slots
+            return opt.wrapper_steady_state_genetic_algorithm(dataset, ga_params, opt_params, resume_state)
+        opt_params["n_iter"] = -(-budget // pop_size) + 1
+        return opt.wrapper_genetic_algorithm(dataset, ga_params, opt_params, resume_state)
+    if optimiser in ("gradient_ascent", "speculative_gradient_ascent"):
+        gd_params = uopt.define_gradient_ascent_params(num_slots, num_params)
+        if optimiser == "speculative_gradient_ascent":
+            opt_params["n_iter"] = max(1, -(-(budget - 2 * num_params) // (num_slots + 2 * num_params)))
+            return opt.wrapper_speculative_gradient_ascent(dataset, gd_params, opt_params, resume_state)
+        opt_params["n_iter"] = max(1, -(-budget // (num_slots + 2 * num_params)))
+        return opt.wrapper_gradient_ascent(dataset, gd_params, opt_params, resume_state)
+    if optimiser == "bayesian_optimisation":
+        bo_params = uopt.define_bayesian_optimisation_params(num_slots, num_params)
+        opt_params["n_iter"] = max(1, -(-budget // num_slots))
+        return opt.wrapper_bayesian_optimisation(dataset, bo_params, opt_params, resume_state)
+    if optimiser == "cmaes":
+        cmaes_params = uopt.define_cmaes_optimisation_params(num_slots, num_params)
+        opt_params["n_iter"] = max(1, -(-budget // max(cmaes_params["population_size"], 4)))
+        return opt.wrapper_cmaes(dataset, cmaes_params, opt_params, resume_state)
+    if optimiser == "nsga2":
+        nsga2_params = uopt.define_nsga2_optimisation_params(num_slots, num_params)
+        opt_params["n_iter"] = max(1, -(-budget // nsga2_params["population_size"]))
+        return opt.wrapper_nsga2(dataset, nsga2_params, opt_params, resume_state)
+    sys.exit("Unknown optimiser " + optimiser)
+
+
+
+def race_one(optimiser, seed, evaluate_factory, race_params):
+    # the best fitness, simulated hours and wall time after each simulation (nan past an early stop)
+    run_dir = race_params["dir_race"] + "/" + optimiser + "_seed" + str(seed)
+    dataset, dataset_params, facility_spec, evaluate = prepare_race_dir(run_dir, seed, evaluate_factory, race_params)
+
+    opt_params = uopt.define_optimizer_parameters(run_dir, dataset_params["num_input_params"],
+                                                  race_params["num_init_examples"], 0, seed, facility_spec, True)
+    opt_params["printout_iteration_skip"] = race_params["num_simulations"] + 1
+    race_log = define_race_log()
+    opt_params["objective_function"] = objective_function(evaluate, race_log)
+
+    with open(run_dir + "/log.txt", "w") as log_file, contextlib.redirect_stdout(log_file):
+        dataset = run_optimiser(optimiser, dataset, dataset_params, facility_spec, opt_params, race_params)
+
+    num_init = race_params["num_init_examples"]
+    num_simulations = min(dataset["num_evaluated"] - num_init, race_params["num_simulations"])
+    target = uopt.fitness_function(dataset, opt_params)
+    best_initial = np.max(target[:num_init])
+    best_fitness = np.full(race_params["num_simulations"], np.nan)
+    best_fitness[:num_simulations] = np.maximum.accumulate(np.maximum(target[num_init:num_init+num_simulations], best_initial))
+
+    wall_time = np.zeros(dataset["num_evaluated"])
+    for start, stop, seconds in race_log["rows"]:
+        wall_time[start:stop] = seconds
+    simulated_hours = simulated_completion_hours(race_log, num_init, race_params["num_slots"],
+                                                 optimiser in ASYNC_OPTIMISERS,
+                                                 np.random.default_rng(seed), race_params)
+    # the best so far is only known once every earlier row has completed
+    simulated_hours = np.maximum.accumulate(simulated_hours)
+    wall_time = np.maximum.accumulate(wall_time[num_init:])
+
+    times = {}
+    for key, item in (("simulated_hours", simulated_hours), ("wall_time", wall_time)):
+        times[key] = np.full(race_params["num_simulations"], np.nan)
+        times[key][:num_simulations] = item[:num_simulations]
+    return best_fitness, times["simulated_hours"], times["wall_time"], num_simulations
+
+
+
+def run_race(race_params, evaluate_factory):
+    num_optimisers = len(race_params["optimisers"])
+    shape = (num_optimisers, race_params["num_seeds"], race_params["num_simulations"])
+    name_length = max(len(optimiser) for optimiser in race_params["optimisers"])
+
+    report = {}
+    report["optimisers"] = [optimiser.ljust(name_length) for optimiser in race_params["optimisers"]]
+    report["seeds"] = race_params["first_seed"] + np.arange(race_params["num_seeds"], dtype="i")
+    report["best_fitness"] = np.zeros(shape)
+    report["simulated_hours"] = np.zeros(shape)
+    report["wall_time"] = np.zeros(shape)
+    report["num_simulations"] = np.zeros(shape[:2], dtype="i")
+    report["num_slots"] = race_params["num_slots"]
+    report["num_init_examples"] = race_params["num_init_examples"]
+
+    for iopt, optimiser in enumerate(race_params["optimisers"]):
+        for iseed, seed in enumerate(report["seeds"]):
+            (report["best_fitness"][iopt,iseed,:], report["simulated_hours"][iopt,iseed,:],
+             report["wall_time"][iopt,iseed,:], report["num_simulations"][iopt,iseed]) = race_one(
+                 optimiser, int(seed), evaluate_factory, race_params)
+
+    # an optimiser that stopped early is only compared up to the simulations every run reached
+    num_compared = int(np.min(report["num_simulations"]))
+    if num_compared < race_params["num_simulations"]:
+        print("An optimiser stopped after " + str(num_compared) + " simulations, the comparison is made there")
+    for iopt, optimiser in enumerate(race_params["optimisers"]):
+        if num_compared == 0:
+            print(optimiser + ": no simulations")
+            continue
+        print("{}: best fitness {:.4e} +/- {:.1e} after {} simulations, {:.1f} simulated hours, {:.2f}s optimiser time".format(
+            optimiser, np.mean(report["best_fitness"][iopt,:,num_compared-1]), np.std(report["best_fitness"][iopt,:,num_compared-1]),
+            num_compared, np.mean(report["simulated_hours"][iopt,:,num_compared-1]),
+            np.mean(report["wall_time"][iopt,:,num_compared-1])))
+
+    nrw.save_general_netcdf(report, race_params["dir_race"] + "/" + race_params["filename_report"])
+    return report
+
+
+
+def plot_race(report, race_params):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    sys_params = tdg.define_system_params(race_params["dir_race"])
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    num_simulations = np.arange(1, np.shape(report["best_fitness"])[2] + 1)
+    for iopt, optimiser in enumerate(report["optimisers"]):
+        mean_fitness = np.mean(report["best_fitness"][iopt], axis=0)
+        line, = axes[0].plot(num_simulations, mean_fitness, label=optimiser.strip())
+        axes[0].fill_between(num_simulations, np.min(report["best_fitness"][iopt], axis=0),
+                             np.max(report["best_fitness"][iopt], axis=0), color=line.get_color(), alpha=0.2)
+        axes[1].plot(np.nanmean(report["simulated_hours"][iopt], axis=0), mean_fitness, color=line.get_color())
+    axes[0].set_xlabel("Simulations")
+    axes[1].set_xlabel("Simulated hours on " + str(report["num_slots"]) + " slots")
+    for ax in axes:
+        ax.set_ylabel("Best fitness")
+    axes[0].legend()
+    filename = race_params["dir_race"] + "/optimizer_race" + sys_params["plot_file_type"]
+    fig.savefig(filename, bbox_inches="tight")
+    plt.close(fig)
+    print("Saved " + filename)
+
+
+
+def main(argv):
+    """
+    python optimizer_race.py [race directory] [simulations per optimiser] [seeds] [objective] [slots]
+    objective is "analytic" (default), a directory of trained networks or [registry directory]:[name],
+    slots the simulations run at once (4 by default).
+    """
+    race_params = define_race_params(argv[1])
+    if len(argv) > 2:
+        race_params["num_simulations"] = int(argv[2])
+    if len(argv) > 3:
+        race_params["num_seeds"] = int(argv[3])
+    if len(argv) > 4:
+        race_params["objective"] = argv[4]
+    if len(argv) > 5:
+        race_params["num_slots"] = int(argv[5])
+    os.makedirs(race_params["dir_race"], exist_ok=True)
+
+    if race_params["objective"] == "analytic":
+        evaluate_factory = analytic_objective
+    elif (":" in race_params["objective"]) and not os.path.isdir(race_params["objective"]):
+        import surrogate_registry as sreg
+        registry_dir, name = race_params["objective"].rsplit(":", 1)
+        registry = sreg.define_registry(registry_dir)
+        evaluate_factory = lambda dataset_params, opt_params: surrogate_objective(name, dataset_params, opt_params,
+                                                                                  registry=registry)
+    else:
+        evaluate_factory = lambda dataset_params, opt_params: surrogate_objective(race_params["objective"],
+                                                                                  dataset_params, opt_params)
+    report = run_race(race_params, evaluate_factory)
+
+    if importlib.util.find_spec("matplotlib") is not None:
+        plot_race(report, race_params)
+    else:
+        print("matplotlib is not installed, no plot written")
+    return report
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
@@ -0,0 +1,199 @@
+import numpy as np
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+import netcdf_read_write as nrw
+import np_neural_network as npnn
+
+
+def define_predictor_params(dir_nn_weights, LMAX, **kwargs):
+    predictor_params = {}
+    predictor_params["dir_nn_weights"] = dir_nn_weights
+    predictor_params["filename_hyperparams"] = kwargs.get("filename_hyperparams", "NN_hyper_parameters")
+    predictor_params["LMAX"] = LMAX
+    predictor_params["num_input_params"] = kwargs.get("num_input_params", None) # checked against the networks if given
+    predictor_params["backend"] = kwargs.get("backend", "numpy") # "numpy" avoids importing tensorflow
+    predictor_params["quantise_int8"] = kwargs.get("quantise_int8", False) # numpy backend only
+    predictor_params["max_batch_size"] = kwargs.get("max_batch_size", 4096) # rows per forward pass
+    predictor_params["max_wait_seconds"] = kwargs.get("max_wait_seconds", 0.001) # time to gather a micro-batch
+    return predictor_params
+
+
+
+def load_predictor(predictor_params):
+    # the networks must map the inputs to [real modes, imaginary modes] up to LMAX, as surrogate_refresh
+    # trains them, the program stops if their sizes do not match
+    nn_hyperparams = nrw.read_nn_weights(predictor_params["dir_nn_weights"] + "/"
+                                         + predictor_params["filename_hyperparams"])
+    num_nn = np.shape(nn_hyperparams["mu"])[0]
+
+    predictor = dict(predictor_params)
+    predictor["num_nn"] = num_nn
+    predictor["mu"] = np.array(nn_hyperparams["mu"], dtype=np.float32)
+    predictor["sigma"] = np.array(nn_hyperparams["sigma"], dtype=np.float32)
+    predictor["use_final_sigmoid"] = [int(flag) for flag in nn_hyperparams["use_final_sigmoid"]]
+    predictor["parameters"] = []
+    for inn in range(num_nn):
+        predictor["parameters"].append(npnn.read_nn_weights(predictor_params["dir_nn_weights"] + "/NN" + str(inn)))
+    predictor["input_size"] = int(np.shape(predictor["parameters"][0]["W1"])[1])
+    check_network_sizes(predictor["input_size"], int(np.shape(predictor["parameters"][0]["W4"])[0]),
+                        predictor["num_input_params"], predictor["LMAX"], predictor["dir_nn_weights"])
+
+    if predictor["backend"] == "tensorflow":
+        predictor["forward"] = tensorflow_ensemble_forward(predictor)
+    else:
+        predictor["forward"] = numpy_ensemble_forward(predictor)
+    return predictor
+
+
+
+def reload_predictor(predictor):
+    # each forward pass holds its own weights, so a concurrent prediction uses the old or the new ensemble
+    reloaded = load_predictor(predictor)
+    predictor["forward"] = reloaded["forward"]
+    for key in ("num_nn", "mu", "sigma", "use_final_sigmoid", "parameters", "input_size"):
+        predictor[key] = reloaded[key]
+    return predictor
+
+
+
+def check_network_sizes(input_size, output_size, num_input_params, LMAX, label):
+    # neural_network_generation trains X_train to Y_train of the training data file, not this model
+    num_coeff = int(((LMAX + 2) * (LMAX + 1)) / 2.0)
+    if (output_size != 2 * num_coeff) or ((num_input_params is not None) and (input_size != num_input_params)):
+        num_inputs = "the" if num_input_params is None else str(num_input_params)
+        print("The networks in " + label + " map " + str(input_size) + " inputs to " + str(output_size)
+              + " outputs, the predictor needs " + num_inputs + " input parameters to "
+              + str(2 * num_coeff) + " real and imaginary modes (LMAX " + str(LMAX) + ")")
+        sys.exit("Networks in " + label + " are not a forward model of the modes")
+
+
+
+def numpy_ensemble_forward(predictor):
+    # the ensemble is bound here, not read from the predictor, so a reload cannot change it mid-call
+    num_nn, mu, sigma = predictor["num_nn"], predictor["mu"], predictor["sigma"]
+    use_final_sigmoid, input_size = list(predictor["use_final_sigmoid"]), predictor["input_size"]
+    if predictor["quantise_int8"]:
+        parameters = [npnn.quantise_parameters(item) for item in predictor["parameters"]]
+        forward = npnn.forward_propagation_int8
+    else:
+        parameters = list(predictor["parameters"])
+        forward = npnn.forward_propagation
+
+    def ensemble_forward(X):
+        X = X.reshape((-1, input_size))
+        Y_sum = 0.0
+        for inn in range(num_nn):
+            X_norm = (X - mu[inn]) / sigma[inn]
+            Y_sum += forward(X_norm.T, parameters[inn], use_final_sigmoid[inn]).T
+        return Y_sum / float(num_nn)
+
+    return ensemble_forward
+
+
+
+def tensorflow_ensemble_forward(predictor):
+    import tensorflow as tf
+    import tf_neural_network as tfnn
+
+    num_nn, mu, sigma = predictor["num_nn"], predictor["mu"], predictor["sigma"]
+    use_final_sigmoid, input_size = list(predictor["use_final_sigmoid"]), predictor["input_size"]
+    tf_parameters = []
+    for parameters in predictor["parameters"]:
+        tf_parameters.append({key: tf.constant(item) for key, item in parameters.items()})
+
+    def ensemble_forward(X):
+        Y_sum = 0.0
+        for inn in range(num_nn):
+            X_norm = (X - mu[inn]) / sigma[inn]
+            Y_sum += tf.transpose(tfnn.forward_propagation(tf.transpose(X_norm), tf_parameters[inn],
+                                                           use_final_sigmoid[inn]))
+        return Y_sum / float(num_nn)
+
+    compiled_forward = tf.function(ensemble_forward,
+                                   input_signature=[tf.TensorSpec(shape=[None, input_size], dtype=tf.float32)])
+    return lambda X: compiled_forward(X.reshape((-1, input_size))).numpy()
+
+
+
+def modes2rms(modes, LMAX):
+    # vectorised form of uim.alms2rms for rows of [real modes, imaginary modes]
+    num_coeff = int(np.shape(modes)[1] / 2)
+    real_modes = modes[:,:num_coeff]
+    imag_modes = modes[:,num_coeff:]
+    pwr_spec_m0 = np.sum(np.abs(real_modes[:,:LMAX]**2 + imag_modes[:,:LMAX]**2), axis=1)
+    pwr_spec_rest = np.sum(np.abs(real_modes[:,LMAX:]**2 + imag_modes[:,LMAX:]**2)*2, axis=1)
+    rms = np.sqrt((pwr_spec_m0+pwr_spec_rest)/4.0/np.pi)
+    return rms
+
+
+
+def predict(predictor, X):
+    # ensemble mean of the modes and their rms for X of shape (num_examples, num_input_params)
+    modes = predictor["forward"](np.array(X, dtype=np.float32))
+    rms = modes2rms(modes, predictor["LMAX"])
+    return modes, rms
+
+
+
+def start_predictor_service(predictor):
+    # micro-batches queries from any number of threads into single forward passes
+    predictor["request_queue"] = queue.Queue()
+    predictor["service_thread"] = threading.Thread(target=serve_predictions, args=(predictor,), daemon=True)
+    predictor["service_thread"].start()
+    return predictor
+
+
+
+def stop_predictor_service(predictor):
+    predictor["request_queue"].put(None)
+    predictor["service_thread"].join()
+
+
+
+def submit_prediction(predictor, X):
+    # queues X for the predictor service, the Future's result is (modes, rms) for those rows
+    future = Future()
+    predictor["request_queue"].put((np.array(X, dtype=np.float32).reshape((-1, predictor["input_size"])), future))
+    return future
+
+
+
+def serve_predictions(predictor):
+    request_queue = predictor["request_queue"]
+    running = True
+    while running:
+        request = request_queue.get()
+        if request is None:
+            break
+        requests = [request]
+        num_rows = np.shape(request[0])[0]
+
+        deadline = time.perf_counter() + predictor["max_wait_seconds"]
+        while num_rows < predictor["max_batch_size"]:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0.0:
+                break
+            try:
+                request = request_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                running = False
+                break
+            requests.append(request)
+            num_rows += np.shape(request[0])[0]
+
+        try:
+            modes, rms = predict(predictor, np.vstack([X for X, _ in requests]))
+        except Exception as err:
+            for _, future in requests:
+                future.set_exception(err)
+            continue
+        il = 0
+        for X, future in requests:
+            iu = il + np.shape(X)[0]
+            future.set_result((modes[il:iu,:], rms[il:iu]))
+            il = iu
@@ -0,0 +1,154 @@
+import numpy as np
+import os
+import queue
+import sys
+import threading
+import netcdf_read_write as nrw
+import np_neural_network as npnn
+
+
+def define_refresh_params(dir_nn_weights, **kwargs):
+    refresh_params = {}
+    refresh_params["dir_nn_weights"] = dir_nn_weights
+    refresh_params["filename_hyperparams"] = kwargs.get("filename_hyperparams", "NN_hyper_parameters")
+    refresh_params["epochs_per_refresh"] = kwargs.get("epochs_per_refresh", 10)
+    refresh_params["min_new_examples"] = kwargs.get("min_new_examples", 1) # new rows needed to start a refresh
+    refresh_params["num_replay_examples"] = kwargs.get("num_replay_examples", 1024) # old rows mixed in against forgetting
+    refresh_params["minibatch_size"] = kwargs.get("minibatch_size", 32)
+    refresh_params["num_threads"] = kwargs.get("num_threads", 1) # leave the other cores to the simulations
+    refresh_params["profile"] = kwargs.get("profile", 0) # which profile's modes the networks predict
+    refresh_params["random_seed"] = kwargs.get("random_seed", 12345)
+    refresh_params["weights_precision"] = kwargs.get("weights_precision", "f4")
+    return refresh_params
+
+
+
+def dataset_to_nn_arrays(dataset, num_rows, profile):
+    # inputs (num_rows, num_input_params) and outputs [real modes, imaginary modes] as in the predictor
+    X = np.array(dataset["input_parameters"][:num_rows,:], dtype=np.float32)
+    Y = np.hstack((np.array(dataset["real_modes"][:num_rows,profile,:], dtype=np.float32),
+                   np.array(dataset["imag_modes"][:num_rows,profile,:], dtype=np.float32)))
+    return X, Y
+
+
+
+def start_refresh_service(refresh_params, num_trained, predictor=None):
+    # fine-tunes the networks in dir_nn_weights in a background thread on every submitted dataset,
+    # num_trained rows are already seen. A given predictor is reloaded after each refresh
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(refresh_params["num_threads"])
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+    refresher = dict(refresh_params)
+    refresher["num_trained"] = num_trained
+    refresher["num_refreshes"] = 0
+    refresher["predictor"] = predictor
+    refresher["random_generator"] = np.random.default_rng(refresh_params["random_seed"])
+    nn_weights = nrw.read_nn_weights(refresh_params["dir_nn_weights"] + "/NN0")
+    refresher["input_size"] = int(np.shape(nn_weights["W1"])[1])
+    refresher["output_size"] = int(np.shape(nn_weights["W4"])[0])
+    refresher["dataset_queue"] = queue.Queue()
+    refresher["service_thread"] = threading.Thread(target=serve_refreshes, args=(refresher,), daemon=True)
+    refresher["service_thread"].start()
+    return refresher
+
+
+
+def stop_refresh_service(refresher):
+    # finishes any refresh in progress and the last submitted dataset
+    refresher["dataset_queue"].put(None)
+    refresher["service_thread"].join()
+
+
+
+def submit_dataset(refresher, dataset):
+    # copies the evaluated rows so the optimiser can keep modifying its dataset
+    X, Y = dataset_to_nn_arrays(dataset, dataset["num_evaluated"], refresher["profile"])
+    if (np.shape(X)[1] != refresher["input_size"]) or (np.shape(Y)[1] != refresher["output_size"]):
+        print("The networks in " + refresher["dir_nn_weights"] + " map " + str(refresher["input_size"]) + " inputs to "
+              + str(refresher["output_size"]) + " outputs, the refresh trains " + str(np.shape(X)[1])
+              + " input parameters to " + str(np.shape(Y)[1]) + " real and imaginary modes")
+        sys.exit("Networks in " + refresher["dir_nn_weights"] + " are not a forward model of the modes")
+    refresher["dataset_queue"].put((X, Y))
+
+
+
+def serve_refreshes(refresher):
+    dataset_queue = refresher["dataset_queue"]
+    stop = False
+    while not stop:
+        item = dataset_queue.get()
+        stop = item is None
+        # every snapshot holds all rows, only the latest is needed
+        while not dataset_queue.empty():
+            newer = dataset_queue.get_nowait()
+            if newer is None:
+                stop = True
+            else:
+                item = newer
+        if item is None:
+            continue
+        X, Y = item
+        if np.shape(X)[0] - refresher["num_trained"] >= refresher["min_new_examples"]:
+            refresh_networks(refresher, X, Y)
+
+
+
+def refresh_networks(refresher, X, Y):
+    # warm-starts every network and trains it on the unseen rows plus a replay sample of the old ones,
+    # the new rows are the test set. The normalisation of the original training is kept
+    import tf_neural_network as tfnn
+
+    num_rows = np.shape(X)[0]
+    new_rows = np.arange(refresher["num_trained"], num_rows)
+    old_rows = np.arange(refresher["num_trained"])
+    num_replay = min(refresher["num_replay_examples"], len(old_rows))
+    replay_rows = refresher["random_generator"].choice(old_rows, num_replay, replace=False)
+    train_rows = np.concatenate((new_rows, np.sort(replay_rows)))
+
+    dir_nn_weights = refresher["dir_nn_weights"]
+    filename_hyperparams = dir_nn_weights + "/" + refresher["filename_hyperparams"]
+    nn_hyperparams = nrw.read_nn_weights(filename_hyperparams)
+    nn_hyperparams = {key: np.array(item) for key, item in nn_hyperparams.items()}
+    num_nn = np.shape(nn_hyperparams["mu"])[0]
+
+    for inn in range(num_nn):
+        mu = nn_hyperparams["mu"][inn]
+        sigma = nn_hyperparams["sigma"][inn]
+        nn_dataset = {}
+        nn_dataset["X_train"] = (X[train_rows,:] - mu) / sigma
+        nn_dataset["Y_train"] = Y[train_rows,:]
+        nn_dataset["X_test"] = (X[new_rows,:] - mu) / sigma
+        nn_dataset["Y_test"] = Y[new_rows,:]
+
+        # model_wrapper only warm starts from nn_weights for start_epoch > 0
+        start_epoch = max(int(nn_hyperparams["num_epochs"][inn]), 1)
+        nn_weights = npnn.read_nn_weights(dir_nn_weights + "/NN" + str(inn))
+        parameters, costs, train_acc, test_acc, epochs = tfnn.model_wrapper(
+            {}, nn_dataset, start_epoch + refresher["epochs_per_refresh"],
+            nn_hyperparams["learning_rate"][inn], int(nn_hyperparams["hidden_units1"][inn]),
+            int(nn_hyperparams["hidden_units2"][inn]), int(nn_hyperparams["hidden_units3"][inn]),
+            minibatch_size=refresher["minibatch_size"], print_cost=False, start_epoch=start_epoch,
+            nn_weights=nn_weights, use_final_sigmoid=int(nn_hyperparams["use_final_sigmoid"][inn]))
+
+        replace_nn_weights(parameters, dir_nn_weights + "/NN" + str(inn), refresher["weights_precision"])
+        nn_hyperparams["num_epochs"][inn] = start_epoch + refresher["epochs_per_refresh"]
+        nn_hyperparams["cost"][inn] = np.atleast_1d(costs)[-1]
+        nn_hyperparams["train_acc"][inn] = np.atleast_1d(train_acc)[-1]
+        nn_hyperparams["test_acc"][inn] = np.atleast_1d(test_acc)[-1]
+    replace_nn_weights(nn_hyperparams, filename_hyperparams, "f4")
+
+    refresher["num_trained"] = num_rows
+    refresher["num_refreshes"] += 1
+    print("Surrogate refresh ", refresher["num_refreshes"], ": trained on ", len(new_rows), " new and ",
+          num_replay, " replayed examples, mean abs error on the new examples ", np.mean(nn_hyperparams["test_acc"]))
+
+    if refresher["predictor"] is not None:
+        import surrogate_predictor as spred
+        spred.reload_predictor(refresher["predictor"])
+
+
+
+def replace_nn_weights(parameters, filename_nn_weights, precision):
+    nrw.save_nn_weights(parameters, filename_nn_weights + "_refresh", precision=precision)
+    os.replace(filename_nn_weights + "_refresh.nc", filename_nn_weights + ".nc")
@@ -0,0 +1,169 @@
+import numpy as np
+import errno
+import glob
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import netcdf_read_write as nrw
+import surrogate_predictor as spred
+
+REGISTRY_METADATA_FILENAME = "surrogate_metadata.nc"
+
+
+def define_registry(registry_dir, **kwargs):
+    registry = {}
+    registry["registry_dir"] = registry_dir
+    registry["cache_size"] = kwargs.get("cache_size", 4) # loaded surrogates kept in memory
+    registry["filename_hyperparams"] = kwargs.get("filename_hyperparams", "NN_hyper_parameters")
+    registry["max_register_attempts"] = kwargs.get("max_register_attempts", 100) # versions taken by other processes
+    registry["cache"] = OrderedDict() # (name, version, backend, quantise_int8) -> predictor, least recent first
+    registry["cache_lock"] = threading.Lock()
+    return registry
+
+
+
+def training_data_hash(filename, block_size=2**20):
+    checksum = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+
+def define_surrogate_metadata(filename_trainingdata, facility_spec, LMAX):
+    metadata = {}
+    metadata["data_hash"] = training_data_hash(filename_trainingdata)
+    metadata["facility"] = str(facility_spec["facility"])
+    metadata["LMAX"] = int(LMAX)
+    return metadata
+
+
+
+def version_location(registry, name, version):
+    return registry["registry_dir"] + "/" + name + "/v" + str(version).zfill(4)
+
+
+
+def list_versions(registry, name):
+    versions = []
+    for location in glob.glob(registry["registry_dir"] + "/" + name + "/v[0-9][0-9][0-9][0-9]"):
+        versions.append(int(os.path.basename(location)[1:]))
+    return sorted(versions)
+
+
+
+def register_surrogate(registry, name, dir_nn_weights, metadata):
+    # copies the networks into the next version of name with the metadata, normalisation and test metrics
+    nn_hyperparams = nrw.read_nn_weights(dir_nn_weights + "/" + registry["filename_hyperparams"])
+    num_nn = np.shape(nn_hyperparams["mu"])[0]
+
+    metadata = dict(metadata)
+    metadata["surrogate_name"] = name
+    metadata["num_nn"] = num_nn
+    metadata["created"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    metadata["mu"] = np.array(nn_hyperparams["mu"], dtype=float)
+    metadata["sigma"] = np.array(nn_hyperparams["sigma"], dtype=float)
+    metadata["test_acc"] = np.array(nn_hyperparams["test_acc"], dtype=float)
+    metadata["train_acc"] = np.array(nn_hyperparams["train_acc"], dtype=float)
+
+    name_dir = registry["registry_dir"] + "/" + name
+    os.makedirs(name_dir, exist_ok=True)
+    tmp_location = tempfile.mkdtemp(dir=name_dir)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_location, 0o777 & ~umask) # mkdtemp makes it private to the user, the registry is shared
+    for inn in range(num_nn):
+        shutil.copyfile(dir_nn_weights + "/NN" + str(inn) + ".nc", tmp_location + "/NN" + str(inn) + ".nc")
+    shutil.copyfile(dir_nn_weights + "/" + registry["filename_hyperparams"] + ".nc",
+                    tmp_location + "/" + registry["filename_hyperparams"] + ".nc")
+    nrw.save_general_netcdf(metadata, tmp_location + "/" + REGISTRY_METADATA_FILENAME)
+
+    for attempt in range(registry["max_register_attempts"]):
+        versions = list_versions(registry, name)
+        version = versions[-1] + 1 if len(versions) > 0 else 1
+        try:
+            os.rename(tmp_location, version_location(registry, name, version))
+            break
+        except OSError as err:
+            # only retry if another process registered this version first
+            if (err.errno not in (errno.EEXIST, errno.ENOTEMPTY)) and not os.path.exists(version_location(registry, name, version)):
+                shutil.rmtree(tmp_location, ignore_errors=True)
+                raise
+    else:
+        shutil.rmtree(tmp_location, ignore_errors=True)
+        sys.exit("Could not register surrogate " + name + ", every version tried was taken by another process")
+    print("Registered surrogate ", name, " version ", version)
+    return version
+
+
+
+def read_surrogate_metadata(registry, name, version):
+    metadata = nrw.read_general_netcdf(version_location(registry, name, version) + "/" + REGISTRY_METADATA_FILENAME)
+    return metadata
+
+
+
+def check_surrogate_metadata(metadata, expected, label):
+    for key, item in expected.items():
+        if str(metadata[key]) != str(item):
+            print("Surrogate ", label, " has ", key, "=", metadata[key], " but ", item, " was expected")
+            sys.exit("Surrogate does not match the requested " + key)
+
+
+
+def load_surrogate(registry, name, version=None, expected={}, **kwargs):
+    # predictor for version of name (the latest by default) from an LRU cache, expected holds metadata the
+    # surrogate must have, e.g. {"facility": "NIF", "LMAX": 30}. kwargs go to define_predictor_params
+    if version is None:
+        versions = list_versions(registry, name)
+        if len(versions) == 0:
+            sys.exit("No surrogate registered as " + name)
+        version = versions[-1]
+    label = name + " v" + str(version)
+    cache_key = (name, version, kwargs.get("backend", "numpy"), kwargs.get("quantise_int8", False))
+
+    with registry["cache_lock"]:
+        if cache_key in registry["cache"].keys():
+            registry["cache"].move_to_end(cache_key)
+            predictor = registry["cache"][cache_key]
+            check_surrogate_metadata(predictor["metadata"], expected, label)
+            return predictor
+
+    metadata = read_surrogate_metadata(registry, name, version)
+    check_surrogate_metadata(metadata, expected, label)
+    predictor_params = spred.define_predictor_params(version_location(registry, name, version),
+                                                     int(metadata["LMAX"]), **kwargs)
+    predictor = spred.load_predictor(predictor_params)
+    if (not np.allclose(predictor["mu"], metadata["mu"])) or (not np.allclose(predictor["sigma"], metadata["sigma"])):
+        sys.exit("Normalisation of surrogate " + label + " does not match its registered metadata")
+    predictor["metadata"] = metadata
+
+    with registry["cache_lock"]:
+        registry["cache"][cache_key] = predictor
+        registry["cache"].move_to_end(cache_key)
+        while len(registry["cache"]) > registry["cache_size"]:
+            registry["cache"].popitem(last=False)
+    return predictor
+
+
+
+def main(argv):
+    """
+    python surrogate_registry.py [registry directory] [name] [neural_network_weights] [training data file] [LMAX] [facility]
+    Registers the networks in neural_network_weights as a new version of name.
+    """
+    registry = define_registry(argv[1])
+    metadata = define_surrogate_metadata(argv[4], {"facility": argv[6]}, int(argv[5]))
+    version = register_surrogate(registry, argv[2], argv[3], metadata)
+    return version
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
@@ -1,29 +1,25 @@
 import numpy as np
+import os
 import tensorflow as tf
 
+# created once, constructing the loss object on every minibatch is expensive
+mse = tf.keras.losses.MeanSquaredError()
 
-def model_wrapper(nn_params, nn_dataset, num_epochs, learning_rate, hidden_units1, hidden_units2, hidden_units3, minibatch_size = 32, print_cost = True, start_epoch = 0, nn_weights = {}, initialize_seed=0, use_final_sigmoid=1):
 
-    x_train = nn_dataset["X_train"]
-    y_train = nn_dataset["Y_train"]
-    x_test = nn_dataset["X_test"]
-    y_test = nn_dataset["Y_test"]
+def model_wrapper(nn_params, nn_dataset, num_epochs, learning_rate, hidden_units1, hidden_units2, hidden_units3, minibatch_size = 32, print_cost = True, start_epoch = 0, nn_weights = {}, initialize_seed=0, use_final_sigmoid=1, compile_steps=True, jit_compile=False, checkpoint_dir="", checkpoint_every=10, early_stopping_patience=0):
+
+    dataset, test_dataset, num_train_examples, input_size, output_size = training_datasets(nn_dataset)
 
     if start_epoch == 0:
         # Initialize your parameters
-        parameters = initialize_parameters(x_train.shape[1], y_train.shape[1], hidden_units1, hidden_units2, hidden_units3, initialize_seed)
+        parameters = initialize_parameters(input_size, output_size, hidden_units1, hidden_units2, hidden_units3, initialize_seed)
     else:
         parameters = {}
         keys = nn_weights.keys()
         for key in keys:
             parameters[key] = tf.Variable(nn_weights[key])
 
-    X_train = tf.data.Dataset.from_tensor_slices(tf.convert_to_tensor(x_train, dtype=tf.float32))
-    Y_train = tf.data.Dataset.from_tensor_slices(tf.convert_to_tensor(y_train, dtype=tf.float32))
-    X_test = tf.data.Dataset.from_tensor_slices(tf.convert_to_tensor(x_test, dtype=tf.float32))
-    Y_test = tf.data.Dataset.from_tensor_slices(tf.convert_to_tensor(y_test, dtype=tf.float32))
-
-    parameters, costs, train_acc, test_acc, epochs = model(X_train, Y_train, X_test, Y_test, parameters, learning_rate, num_epochs, minibatch_size, print_cost, start_epoch, use_final_sigmoid)
+    parameters, costs, train_acc, test_acc, epochs = model(dataset, test_dataset, num_train_examples, parameters, learning_rate, num_epochs, minibatch_size, print_cost, start_epoch, use_final_sigmoid, compile_steps, jit_compile, checkpoint_dir, checkpoint_every, early_stopping_patience)
 
     numpy_parameters = {}
     keys = parameters.keys()
@@ -34,6 +30,135 @@ def model_wrapper(nn_params, nn_dataset, num_epochs, learning_rate, hidden_units
 
 
 
+def training_datasets(nn_dataset):
+    """
+    Training and test datasets, the number of training examples and the input and output sizes,
+    from either the in-memory arrays or streaming_training_datasets.
+    """
+    if "train_dataset" in nn_dataset.keys():
+        return (nn_dataset["train_dataset"], nn_dataset["test_dataset"], nn_dataset["num_train_examples"],
+                nn_dataset["input_size"], nn_dataset["output_size"])
+
+    x_train = nn_dataset["X_train"]
+    y_train = nn_dataset["Y_train"]
+    x_test = nn_dataset["X_test"]
+    y_test = nn_dataset["Y_test"]
+    dataset = tf.data.Dataset.from_tensor_slices((tf.convert_to_tensor(x_train, dtype=tf.float32),
+                                                  tf.convert_to_tensor(y_train, dtype=tf.float32)))
+    test_dataset = tf.data.Dataset.from_tensor_slices((tf.convert_to_tensor(x_test, dtype=tf.float32),
+                                                       tf.convert_to_tensor(y_test, dtype=tf.float32)))
+    return dataset, test_dataset, x_train.shape[0], x_train.shape[1], y_train.shape[1]
+
+
+
+def streaming_dataset(filename, start, stop, mu, sigma, input_size, output_size, chunk_size, shuffle_buffer_size=0, seed=0, cache_filename=""):
+    """
+    Normalised (input, output) pairs for the examples start to stop, read from file chunk_size
+    examples at a time. With a cache_filename they are cached on local disk after the first epoch.
+    """
+    import netcdf_read_write as nrw
+    import threading
+
+    # HDF5 is not thread safe, only the normalisation runs in parallel
+    file_lock = threading.Lock()
+    mu = np.float32(mu)
+    sigma = np.float32(sigma)
+
+    def read_chunk(chunk_start):
+        chunk_stop = min(int(chunk_start) + chunk_size, stop)
+        with file_lock:
+            X_chunk, Y_chunk = nrw.read_training_data_chunk(filename, int(chunk_start), chunk_stop)
+        return (X_chunk - mu) / sigma, Y_chunk
+
+    def read_chunk_tensors(chunk_start):
+        X_chunk, Y_chunk = tf.numpy_function(read_chunk, [chunk_start], (tf.float32, tf.float32))
+        X_chunk.set_shape([None, input_size])
+        Y_chunk.set_shape([None, output_size])
+        return X_chunk, Y_chunk
+
+    chunk_starts = tf.data.Dataset.range(start, stop, chunk_size)
+    dataset = chunk_starts.map(read_chunk_tensors, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    dataset = dataset.unbatch()
+    if cache_filename != "":
+        dataset = dataset.cache(cache_filename)
+    if shuffle_buffer_size > 0:
+        dataset = dataset.shuffle(shuffle_buffer_size, seed=seed, reshuffle_each_iteration=True)
+    return dataset
+
+
+
+def streaming_training_datasets(nn_params, filename):
+    """
+    Streaming replacement for seperate_test_set and normalise in neural_network_generation.
+    """
+    import netcdf_read_write as nrw
+
+    num_examples, input_size, output_size = nrw.training_data_shape(filename)
+    nn_params["num_examples"] = num_examples
+    nn_params["input_size"] = input_size
+    nn_params["output_size"] = output_size
+    if nn_params["use_test_set"]:
+        test_size = max(int(num_examples * nn_params["test_fraction"]), 1)
+    else:
+        test_size = 0
+        nn_params["test_fraction"] = 0.0
+    nn_params["test_size"] = test_size
+
+    chunk_size = nn_params["stream_chunk_size"]
+    mu, sigma = nrw.training_data_statistics(filename, test_size, num_examples, chunk_size)
+
+    cache_filename = ""
+    test_cache_filename = ""
+    if nn_params["stream_cache_dir"] != "":
+        os.makedirs(nn_params["stream_cache_dir"], exist_ok=True)
+        cache_filename = nn_params["stream_cache_dir"] + "/train"
+        test_cache_filename = nn_params["stream_cache_dir"] + "/test"
+
+    nn_dataset = {}
+    nn_dataset["mu"] = mu
+    nn_dataset["sigma"] = sigma
+    nn_dataset["num_train_examples"] = num_examples - test_size
+    nn_dataset["input_size"] = input_size
+    nn_dataset["output_size"] = output_size
+    nn_dataset["train_dataset"] = streaming_dataset(filename, test_size, num_examples, mu, sigma, input_size, output_size, chunk_size,
+                                                    shuffle_buffer_size=nn_params["shuffle_buffer_size"], seed=nn_params["random_seed"],
+                                                    cache_filename=cache_filename)
+    nn_dataset["test_dataset"] = streaming_dataset(filename, 0, test_size, mu, sigma, input_size, output_size, chunk_size,
+                                                   cache_filename=test_cache_filename)
+
+    print("Streaming ", num_examples - test_size, " training and ", test_size, " test examples from ", filename)
+    return nn_dataset
+
+
+
+def training_progress(start_epoch, num_nn=0):
+    # epoch reached and best test mean abs error, per member when training an ensemble
+    shape = (num_nn,) if num_nn > 0 else ()
+    progress = {}
+    progress["epoch"] = tf.Variable(start_epoch, dtype=tf.int64)
+    progress["best_test_acc"] = tf.Variable(np.full(shape, np.inf), dtype=tf.float32)
+    progress["best_epoch"] = tf.Variable(np.full(shape, start_epoch), dtype=tf.int64)
+    return progress
+
+
+
+def restore_training_checkpoint(checkpoint_dir, parameters, optimizer, best_parameters, progress):
+    """
+    CheckpointManager for the weights, Adam moments and progress, restored from checkpoint_dir
+    if a killed run left a checkpoint there.
+    """
+    # build the Adam moments now so they are restored rather than created at the first step
+    optimizer.build([parameters[key] for key in ("W1", "b1", "W2", "b2", "W3", "b3", "W4", "b4")])
+    checkpoint = tf.train.Checkpoint(optimizer=optimizer, parameters=parameters,
+                                     best_parameters=best_parameters, **progress)
+    checkpoint_manager = tf.train.CheckpointManager(checkpoint, checkpoint_dir, max_to_keep=2)
+    if checkpoint_manager.latest_checkpoint:
+        checkpoint.restore(checkpoint_manager.latest_checkpoint)
+        print("Resuming training from ", checkpoint_manager.latest_checkpoint, " at epoch ", int(progress["epoch"].numpy()))
+    return checkpoint_manager
+
+
+
 def apply_network(x_test, nn_weights, use_final_sigmoid):
     num_examples = x_test.shape[0]
     input_size = x_test.shape[1]
@@ -56,20 +181,27 @@ def apply_network(x_test, nn_weights, use_final_sigmoid):
 
 # Taken from Coursera by deeplearning.AI Andrew Ng:
 # https://www.coursera.org/specializations/deep-learning?skipBrowseRedirect=true
-def model(X_train, Y_train, X_test, Y_test, parameters, learning_rate,
-          num_epochs, minibatch_size, print_cost, start_epoch, use_final_sigmoid):
+def model(dataset, test_dataset, m, parameters, learning_rate,
+          num_epochs, minibatch_size, print_cost, start_epoch, use_final_sigmoid,
+          compile_steps=True, jit_compile=False, checkpoint_dir="", checkpoint_every=10,
+          early_stopping_patience=0):
     """
     Implements a three-layer tensorflow neural network: LINEAR->RELU->LINEAR->RELU->LINEAR->SIGMOID.
 
     Arguments:
-    X_train -- training set, of shape (input size, number of training examples)
-    Y_train -- test set, of shape (output size, number of training examples)
-    X_test -- training set, of shape (input size, number of training examples)
-    Y_test -- test set, of shape (output size, number of test examples)
+    dataset -- training set of (input, output) pairs, of sizes (input size) and (output size)
+    test_dataset -- test set of (input, output) pairs
+    m -- number of training examples
     learning_rate -- learning rate of the optimization
     num_epochs -- number of epochs of the optimization loop
     minibatch_size -- size of a minibatch
     print_cost -- True to print the cost every 10 epochs
+    compile_steps -- True to run the training and evaluation steps as graphs (tf.function)
+    jit_compile -- True to also compile the steps with XLA
+    checkpoint_dir -- directory for checkpoints of the training state, "" for none
+    checkpoint_every -- number of epochs between checkpoints
+    early_stopping_patience -- stop once the test mean abs error has not improved for this many
+                               epochs and return the best weights, 0 to always run num_epochs
 
     Returns:
     parameters -- parameters learnt by the model. They can then be used to predict.
@@ -81,14 +213,8 @@ def model(X_train, Y_train, X_test, Y_test, parameters, learning_rate,
     test_accuracy = tf.keras.metrics.MeanAbsoluteError()
     train_accuracy = tf.keras.metrics.MeanAbsoluteError()
 
-    dataset = tf.data.Dataset.zip((X_train, Y_train))
-    test_dataset = tf.data.Dataset.zip((X_test, Y_test))
-
-    # We can get the number of elements of a dataset using the cardinality method
-    m = dataset.cardinality().numpy()
-
-    minibatches = dataset.batch(minibatch_size).prefetch(8)
-    test_minibatches = test_dataset.batch(minibatch_size).prefetch(8)
+    minibatches = dataset.batch(minibatch_size).prefetch(tf.data.AUTOTUNE)
+    test_minibatches = test_dataset.batch(minibatch_size).prefetch(tf.data.AUTOTUNE)
     #X_train = X_train.batch(minibatch_size, drop_remainder=True).prefetch(8)# <<< extra step
     #Y_train = Y_train.batch(minibatch_size, drop_remainder=True).prefetch(8) # loads memory faster
 
@@ -105,22 +231,60 @@ def model(X_train, Y_train, X_test, Y_test, parameters, learning_rate,
     b3 = parameters['b3']
     W4 = parameters['W4']
     b4 = parameters['b4']
+    trainable_variables = [W1, b1, W2, b2, W3, b3, W4, b4]
+
+    progress = training_progress(start_epoch)
+    best_parameters = {}
+    if early_stopping_patience > 0:
+        best_parameters = {key: tf.Variable(item) for key, item in parameters.items()}
+    checkpoint_manager = None
+    if checkpoint_dir != "":
+        checkpoint_manager = restore_training_checkpoint(checkpoint_dir, parameters, optimizer, best_parameters, progress)
+        start_epoch = int(progress["epoch"].numpy())
+
+    def train_step(minibatch_X, minibatch_Y):
+        with tf.GradientTape() as tape:
+            # 1. predict
+            Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
+
+            # 2. loss
+            minibatch_cost = calculate_cost(minibatch_Y, tf.transpose(Z4))
+
+        # We accumulate the accuracy of all the batches
+        train_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
+
+        grads = tape.gradient(minibatch_cost, trainable_variables)
+        optimizer.apply_gradients(zip(grads, trainable_variables))
+        return minibatch_cost
+
+    def train_evaluation_step(minibatch_X, minibatch_Y):
+        Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
+        train_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
+        return calculate_cost(minibatch_Y, tf.transpose(Z4))
+
+    def test_evaluation_step(minibatch_X, minibatch_Y):
+        Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
+        test_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
+
+    if compile_steps:
+        # Fixed signatures (any batch size) so the final partial minibatch does not retrace
+        input_signature = [tf.TensorSpec(shape=[None, W1.shape[1]], dtype=tf.float32),
+                           tf.TensorSpec(shape=[None, W4.shape[0]], dtype=tf.float32)]
+        train_step = tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+        train_evaluation_step = tf.function(train_evaluation_step, input_signature=input_signature, jit_compile=jit_compile)
+        test_evaluation_step = tf.function(test_evaluation_step, input_signature=input_signature, jit_compile=jit_compile)
 
     # Save pre-training cost and accuracy
     epoch_cost = 0.0
     for (minibatch_X, minibatch_Y) in minibatches:
-        Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
-        train_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
-        minibatch_cost = calculate_cost(minibatch_Y, tf.transpose(Z4))
-        epoch_cost += minibatch_cost
+        epoch_cost += train_evaluation_step(minibatch_X, minibatch_Y)
     epoch_cost /= m
     costs = [epoch_cost]
     epochs = [start_epoch]
     train_acc = [train_accuracy.result()]
 
     for (minibatch_X, minibatch_Y) in test_minibatches:
-        Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
-        test_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
+        test_evaluation_step(minibatch_X, minibatch_Y)
     test_acc = [test_accuracy.result()]
 
     if print_cost == True:
@@ -129,6 +293,10 @@ def model(X_train, Y_train, X_test, Y_test, parameters, learning_rate,
     train_accuracy.reset_states()
     test_accuracy.reset_states()
 
+    if early_stopping_patience > 0 and (start_epoch - int(progress["best_epoch"].numpy())) >= early_stopping_patience:
+        # resumed from a run that had already stopped early
+        num_epochs = start_epoch
+
     # Do the training loop
     for epoch in range(start_epoch+1, num_epochs+1):
 
@@ -138,32 +306,28 @@ def model(X_train, Y_train, X_test, Y_test, parameters, learning_rate,
         train_accuracy.reset_states()
 
         for (minibatch_X, minibatch_Y) in minibatches:
-
-            with tf.GradientTape() as tape:
-                # 1. predict
-                Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
-
-                # 2. loss
-                minibatch_cost = calculate_cost(minibatch_Y, tf.transpose(Z4))
-
-            # We accumulate the accuracy of all the batches
-            train_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
-
-            trainable_variables = [W1, b1, W2, b2, W3, b3, W4, b4]
-            grads = tape.gradient(minibatch_cost, trainable_variables)
-            optimizer.apply_gradients(zip(grads, trainable_variables))
-            epoch_cost += minibatch_cost
+            epoch_cost += train_step(minibatch_X, minibatch_Y)
 
         # We divide the epoch cost over the number of samples
         epoch_cost /= m
 
-        # Print the cost every 10 epochs
-        if (epoch % 10 == 0):
-
-            # We evaluate the test set every 10 epochs to avoid computational overhead
+        # We evaluate the test set every 10 epochs to avoid computational overhead,
+        # or every epoch when it decides when to stop
+        if (epoch % 10 == 0) or (epoch == num_epochs) or (early_stopping_patience > 0):
             for (minibatch_X, minibatch_Y) in test_minibatches:
-                Z4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
-                test_accuracy.update_state(minibatch_Y, tf.transpose(Z4))
+                test_evaluation_step(minibatch_X, minibatch_Y)
+
+        stop_early = False
+        if early_stopping_patience > 0:
+            if test_accuracy.result() < progress["best_test_acc"]:
+                progress["best_test_acc"].assign(test_accuracy.result())
+                progress["best_epoch"].assign(epoch)
+                for key in parameters.keys():
+                    best_parameters[key].assign(parameters[key])
+            stop_early = (epoch - int(progress["best_epoch"].numpy())) >= early_stopping_patience
+
+        # Print the cost every 10 epochs
+        if (epoch % 10 == 0) or (epoch == num_epochs) or stop_early:
 
             if (print_cost == True):
                 print ("Cost after epoch %i: %f" % (epoch, epoch_cost))
@@ -174,18 +338,160 @@ def model(X_train, Y_train, X_test, Y_test, parameters, learning_rate,
             train_acc.append(train_accuracy.result())
             test_acc.append(test_accuracy.result())
             epochs.append(epoch)
-            test_accuracy.reset_states()
+        test_accuracy.reset_states()
+
+        progress["epoch"].assign(epoch)
+        if (checkpoint_manager is not None) and ((epoch % checkpoint_every == 0) or stop_early or (epoch == num_epochs)):
+            checkpoint_manager.save(checkpoint_number=epoch)
+        if stop_early:
+            break
+
+    if early_stopping_patience > 0 and np.isfinite(progress["best_test_acc"].numpy()):
+        if print_cost == True:
+            print("Stopped at epoch %i, keeping the weights of epoch %i with test mean abs error %f"
+                  % (epochs[-1], int(progress["best_epoch"].numpy()), progress["best_test_acc"].numpy()))
+        for key in parameters.keys():
+            parameters[key].assign(best_parameters[key])
 
     return parameters, costs, train_acc, test_acc, epochs
 
 
 
+def ensemble_model_wrapper(nn_params, nn_dataset, num_epochs, learning_rate, hidden_units1, hidden_units2, hidden_units3, initialize_seeds, minibatch_size = 32, print_cost = True, use_final_sigmoid=1, compile_steps=True, jit_compile=False, checkpoint_dir="", checkpoint_every=10, early_stopping_patience=0):
+    """
+    Trains one network per seed in initialize_seeds at once, with the weights stacked along a leading
+    ensemble axis. Each member gets its own gradient, so it trains as model_wrapper with its seed.
+    """
+    dataset, test_dataset, m, input_size, output_size = training_datasets(nn_dataset)
+    num_nn = len(initialize_seeds)
+
+    member_parameters = [initialize_parameters(input_size, output_size, hidden_units1, hidden_units2, hidden_units3, seed) for seed in initialize_seeds]
+    parameters = {}
+    for key in member_parameters[0].keys():
+        parameters[key] = tf.Variable(tf.stack([member[key] for member in member_parameters]))
+
+    minibatches = dataset.batch(minibatch_size).prefetch(tf.data.AUTOTUNE)
+    test_minibatches = test_dataset.batch(minibatch_size).prefetch(tf.data.AUTOTUNE)
+
+    optimizer = tf.keras.optimizers.Adam(learning_rate)
+    trainable_variables = [parameters[key] for key in ("W1", "b1", "W2", "b2", "W3", "b3", "W4", "b4")]
+
+    start_epoch = 0
+    progress = training_progress(start_epoch, num_nn)
+    best_parameters = {}
+    if early_stopping_patience > 0:
+        best_parameters = {key: tf.Variable(item) for key, item in parameters.items()}
+    checkpoint_manager = None
+    if checkpoint_dir != "":
+        checkpoint_manager = restore_training_checkpoint(checkpoint_dir, parameters, optimizer, best_parameters, progress)
+        start_epoch = int(progress["epoch"].numpy())
+
+    def member_errors(minibatch_X, minibatch_Y):
+        # A4 has shape (num_nn, output size, minibatch size)
+        A4 = forward_propagation(tf.transpose(minibatch_X), parameters, use_final_sigmoid)
+        error = A4 - tf.transpose(minibatch_Y)[tf.newaxis,:,:]
+        member_cost = tf.reduce_mean(tf.square(error), axis=[1, 2])
+        member_abs_error = tf.reduce_sum(tf.abs(error), axis=[1, 2])
+        return member_cost, member_abs_error
+
+    def train_step(minibatch_X, minibatch_Y):
+        with tf.GradientTape() as tape:
+            member_cost, member_abs_error = member_errors(minibatch_X, minibatch_Y)
+            minibatch_cost = tf.reduce_sum(member_cost)
+        grads = tape.gradient(minibatch_cost, trainable_variables)
+        optimizer.apply_gradients(zip(grads, trainable_variables))
+        return member_cost, member_abs_error
+
+    evaluation_step = member_errors
+    if compile_steps:
+        input_signature = [tf.TensorSpec(shape=[None, input_size], dtype=tf.float32),
+                           tf.TensorSpec(shape=[None, output_size], dtype=tf.float32)]
+        train_step = tf.function(train_step, input_signature=input_signature, jit_compile=jit_compile)
+        evaluation_step = tf.function(member_errors, input_signature=input_signature, jit_compile=jit_compile)
+
+    def evaluate(minibatches, step):
+        epoch_cost = np.zeros(num_nn)
+        abs_error = np.zeros(num_nn)
+        num_values = 0
+        for (minibatch_X, minibatch_Y) in minibatches:
+            member_cost, member_abs_error = step(minibatch_X, minibatch_Y)
+            epoch_cost += member_cost.numpy()
+            abs_error += member_abs_error.numpy()
+            num_values += int(np.prod(minibatch_Y.shape))
+        return epoch_cost / m, abs_error / max(num_values, 1)
+
+    epoch_cost, train_mae = evaluate(minibatches, evaluation_step)
+    _, test_mae = evaluate(test_minibatches, evaluation_step)
+    costs = [epoch_cost]
+    train_acc = [train_mae]
+    test_acc = [test_mae]
+    epochs = [start_epoch]
+    if print_cost == True:
+        print("Mean abs error for initialialized weights (train):", train_mae)
+        print("Mean abs error for initialialized weights (test):", test_mae)
+
+    def members_stopped(epoch):
+        return np.all((epoch - progress["best_epoch"].numpy()) >= early_stopping_patience)
+
+    if early_stopping_patience > 0 and members_stopped(start_epoch):
+        # resumed from a run that had already stopped early
+        num_epochs = start_epoch
+
+    for epoch in range(start_epoch+1, num_epochs+1):
+        epoch_cost, train_mae = evaluate(minibatches, train_step)
+
+        if (epoch % 10 == 0) or (epoch == num_epochs) or (early_stopping_patience > 0):
+            _, test_mae = evaluate(test_minibatches, evaluation_step)
+
+        stop_early = False
+        if early_stopping_patience > 0:
+            improved = test_mae < progress["best_test_acc"].numpy()
+            progress["best_test_acc"].assign(np.where(improved, test_mae, progress["best_test_acc"].numpy()))
+            progress["best_epoch"].assign(np.where(improved, epoch, progress["best_epoch"].numpy()))
+            for key in parameters.keys():
+                member_mask = improved.reshape((num_nn,) + (1,) * (len(parameters[key].shape) - 1))
+                best_parameters[key].assign(tf.where(member_mask, parameters[key], best_parameters[key]))
+            stop_early = members_stopped(epoch)
+
+        if (epoch % 10 == 0) or (epoch == num_epochs) or stop_early:
+            if (print_cost == True):
+                print("Cost after epoch %i: " % epoch, epoch_cost)
+                print("Mean abs error on train:", train_mae)
+                print("Mean abs error on test:", test_mae)
+
+            costs.append(epoch_cost)
+            train_acc.append(train_mae)
+            test_acc.append(test_mae)
+            epochs.append(epoch)
+
+        progress["epoch"].assign(epoch)
+        if (checkpoint_manager is not None) and ((epoch % checkpoint_every == 0) or stop_early or (epoch == num_epochs)):
+            checkpoint_manager.save(checkpoint_number=epoch)
+        if stop_early:
+            break
+
+    if early_stopping_patience > 0 and np.all(np.isfinite(progress["best_test_acc"].numpy())):
+        if print_cost == True:
+            print("Stopped at epoch %i, keeping the weights of epochs" % epochs[-1], progress["best_epoch"].numpy())
+        for key in parameters.keys():
+            parameters[key].assign(best_parameters[key])
+
+    member_numpy_parameters = []
+    for inn in range(num_nn):
+        numpy_parameters = {}
+        for key in parameters.keys():
+            numpy_parameters[key] = parameters[key][inn].numpy()
+        member_numpy_parameters.append(numpy_parameters)
+
+    return member_numpy_parameters, np.array(costs), np.array(train_acc), np.array(test_acc), epochs
+
+
+
 def calculate_cost(y_true, y_pred):
     """
     Calculate cost function
     """
 
-    mse = tf.keras.losses.MeanSquaredError()
     cost = mse(y_true, y_pred)
     #bce = tf.keras.losses.BinaryCrossentropy()
     #cost = bce(y_true, y_pred)
@@ -3,10 +3,11 @@ import utils_deck_generation as idg
 import healpy_pointings as hpoint
 import netcdf_read_write as nrw
 import utils_intensity_map as uim
+import utils_sampler as usam
 import os
 import subprocess
 import sys
-from scipy.stats import qmc
+import time
 
 
 def define_system_params(root_dir):
@@ -14,6 +15,7 @@ def define_system_params(root_dir):
     sys_params["num_parallel_ifriits"] = 1
     sys_params["num_openmp_parallel"] = 4
     sys_params["num_ex_checkpoint"] = 1
+    sys_params["num_scan_threads"] = 8 # threads used to scan run directories on resume
 
     sys_params["run_gen_deck"] = True
     sys_params["run_sims"] = True
@@ -47,7 +49,8 @@ def define_dataset_params(num_examples,
     # Number of samples, size of NN training set
     dataset_params["num_examples"] = num_examples
     dataset_params["random_seed"] = random_seed
-    dataset_params["random_sampling"] = random_sampling
+    dataset_params["random_sampling"] = random_sampling # 0 LHS, 1 random, 2 Sobol, 3 Halton
+    dataset_params = usam.define_sampler_params(dataset_params)
     dataset_params["hemisphere_symmetric"] = True
     dataset_params["imap_nside"] = 256
     dataset_params["run_plasma_profile"] = False
@@ -96,20 +99,39 @@ def define_dataset_params(num_examples,
 
 def populate_dataset_random_inputs(dataset_params, dataset):
 
-    random_generator=np.random.default_rng(dataset_params["random_seed"])
-    if dataset_params["random_sampling"] == 1:
+    if dataset_params["random_sampling"] == usam.SAMPLER_RANDOM:
         print("Random Sampling!")
-        sample = random_generator.random((dataset_params["num_examples"], dataset_params["num_input_params"]))
-    else:
-        sampler = qmc.LatinHypercube(d=dataset_params["num_input_params"],
-                                     strength=1, seed=random_generator, optimization="random-cd")
-        sample = sampler.random(n=dataset_params["num_examples"])
-    dataset["input_parameters"] = sample
+    dataset["input_parameters"] = usam.draw_samples(dataset_params, dataset_params["num_examples"])
 
     return dataset
 
 
 
+def extend_dataset_random_inputs(dataset, dataset_params, deck_gen_params, facility_spec, num_examples):
+    import utils_optimizers as uopt
+
+    old_num_examples = dataset_params["num_examples"]
+    if num_examples < old_num_examples:
+        print("The dataset already has " + str(old_num_examples) + " examples, an extension cannot reduce it to "
+              + str(num_examples))
+        sys.exit("Extend to at least the current number of examples")
+    if "sampler_num_drawn" not in dataset_params.keys():
+        # datasets created before the sampler state was recorded
+        dataset_params = usam.define_sampler_params(dataset_params)
+        dataset_params["sampler_num_drawn"] = old_num_examples
+    dataset_params["num_examples"] = num_examples
+
+    dataset = uopt.expand_dataset(dataset, dataset_params, old_num_examples)
+    deck_gen_params = uopt.expand_deck_gen_params(deck_gen_params, dataset_params, facility_spec, old_num_examples)
+    dataset["input_parameters"][old_num_examples:,:] = usam.extend_samples(dataset_params,
+                                                                           dataset["input_parameters"][:old_num_examples,:],
+                                                                           num_examples - old_num_examples)
+    print("Extended design from " + str(old_num_examples) + " to " + str(num_examples) + " examples")
+
+    return dataset, dataset_params, deck_gen_params
+
+
+
 def define_dataset(dataset_params):
     dataset = {}
     dataset["non_expand_keys"] = ["non_expand_keys","num_evaluated"]
@@ -120,6 +142,18 @@ def define_dataset(dataset_params):
     dataset["imag_modes"] = np.zeros((dataset_params["num_examples"], dataset_params["num_profiles_per_config"], dataset_params["num_coeff"]))
     dataset["avg_flux"] = np.zeros((dataset_params["num_examples"], dataset_params["num_profiles_per_config"]))
     dataset["rms"] = np.zeros((dataset_params["num_examples"], dataset_params["num_profiles_per_config"]))
+    # number of profiles evaluated, fewer than num_profiles_per_config for examples only screened
+    dataset["fidelity"] = np.full(dataset_params["num_examples"], dataset_params["num_profiles_per_config"], dtype="i")
+    dataset["cost"] = np.zeros(dataset_params["num_examples"]) # MPI process seconds of the runs
+    return dataset
+
+
+
+def add_missing_dataset_keys(dataset, dataset_params):
+    # datasets written before a key was added to define_dataset get its default
+    for key, item in define_dataset(dataset_params).items():
+        if key not in dataset.keys():
+            dataset[key] = item
     return dataset
 
 
@@ -160,18 +194,136 @@ def generate_training_data(dataset, dataset_params, sys_params, facility_spec):
 
 
 def run_and_delete(min_parallel, max_parallel, dataset, dataset_params, sys_params, facility_spec):
+    dataset = run_and_delete_indices(list(range(min_parallel, max_parallel+1)), dataset, dataset_params, sys_params, facility_spec)
+    return dataset
+
+
+
+def contiguous_ranges(example_indices):
+    # splits sorted indices into (min, max) ranges accepted by bash_parallel_ifriit
+    ranges = []
+    for iex in example_indices:
+        if (len(ranges) > 0) and (ranges[-1][1] == iex - 1):
+            ranges[-1][1] = iex
+        else:
+            ranges.append([iex, iex])
+    return ranges
+
+
+
+def completed_prefix(is_complete):
+    if np.all(is_complete):
+        return len(is_complete)
+    return int(np.argmin(is_complete))
+
+
+
+def run_and_delete_indices(example_indices, dataset, dataset_params, sys_params, facility_spec, profiles=None):
+    cost = run_indices(example_indices, dataset_params, sys_params, facility_spec, profiles=profiles)
+
+    for min_parallel, max_parallel in contiguous_ranges(example_indices):
+        dataset = nrw.retrieve_xtrain_and_delete(min_parallel, max_parallel, dataset, dataset_params, sys_params, facility_spec,
+                                                 profiles=profiles)
+    dataset["cost"][example_indices] += cost
+    return dataset
+
+
+
+def num_mpi_processes(tind, dataset_params, facility_spec):
+    if dataset_params["run_plasma_profile"] and tind!=0: # this ensures the first run will be a solid sphere
+        return int(facility_spec['nbeams'] / facility_spec['beams_per_ifriit_beam'])
+    return 1
+
+
+
+def run_indices(example_indices, dataset_params, sys_params, facility_spec, profiles=None):
+    # the outputs are read separately, profiles restricts the runs to some time steps. Returns the cost
+    # of each example, the wall time of its runs times their MPI processes
+    if profiles is None:
+        profiles = range(dataset_params["num_profiles_per_config"])
     config_location = sys_params["root_dir"] + "/" + sys_params["config_dir"]
-    for tind in range(dataset_params["num_profiles_per_config"]):
+    ranges = contiguous_ranges(example_indices)
+    cost = 0.0
+    for tind in profiles:
         sim_dir = "/" + sys_params["sim_dir"] + str(tind)
+        num_mpi_parallel = num_mpi_processes(tind, dataset_params, facility_spec)
+
+        # non-contiguous examples are launched together so they still run concurrently
+        tic = time.perf_counter()
+        processes = []
+        for min_parallel, max_parallel in ranges:
+            processes.append(subprocess.Popen(["./bash_parallel_ifriit", config_location, sim_dir, str(min_parallel), str(max_parallel), str(num_mpi_parallel), str(sys_params["num_openmp_parallel"])]))
+        for process in processes:
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+        cost += (time.perf_counter() - tic) * num_mpi_parallel
+    return cost
+
+
+
+def screen_and_promote(example_indices, dataset, dataset_params, sys_params, facility_spec,
+                       screening_fitness, promote_fraction):
+    # every example runs the solid sphere (profile 0), only the best promote_fraction by
+    # screening_fitness(dataset) run the plasma profiles, the others keep fidelity 1
+    example_indices = np.array(example_indices)
+    num_parallel = sys_params["num_parallel_ifriits"]
+    full_profiles = list(range(1, dataset_params["num_profiles_per_config"]))
+    for start in range(0, len(example_indices), num_parallel):
+        dataset = run_and_delete_indices(list(example_indices[start:start+num_parallel]), dataset, dataset_params,
+                                         sys_params, facility_spec, profiles=[0])
+    dataset["fidelity"][example_indices] = 1
+
+    num_promoted = max(1, int(np.ceil(promote_fraction * len(example_indices))))
+    target = screening_fitness(dataset)[example_indices]
+    promoted = np.sort(example_indices[np.argsort(-target, kind="stable")[:num_promoted]])
+    print("Promoting " + str(num_promoted) + " of " + str(len(example_indices)) + " screened examples: " + str(promoted))
+    for start in range(0, len(promoted), num_parallel):
+        dataset = run_and_delete_indices(list(promoted[start:start+num_parallel]), dataset, dataset_params,
+                                         sys_params, facility_spec, profiles=full_profiles)
+    dataset["fidelity"][promoted] = dataset_params["num_profiles_per_config"]
+    return dataset
 
-        if dataset_params["run_plasma_profile"] and tind!=0: # this ensures the first run will be a solid sphere
-            num_mpi_parallel = int(facility_spec['nbeams'] / facility_spec['beams_per_ifriit_beam'])
-        else:
-            num_mpi_parallel = 1
 
-        subprocess.check_call(["./bash_parallel_ifriit", config_location, sim_dir, str(min_parallel), str(max_parallel), str(num_mpi_parallel), str(sys_params["num_openmp_parallel"])])
 
-    dataset = nrw.retrieve_xtrain_and_delete(min_parallel, max_parallel, dataset, dataset_params, sys_params, facility_spec)
+def resume_training_data(dataset, dataset_params, deck_gen_params, sys_params, facility_spec):
+    # finished runs are harvested from their directories, missing decks are regenerated and the rest
+    # of the examples run as usual
+    nrw.save_general_netcdf(dataset_params, sys_params["root_dir"] + "/" + sys_params["dataset_params_filename"])
+    nrw.save_general_netcdf(facility_spec, sys_params["root_dir"] + "/" + sys_params["facility_spec_filename"])
+    filename_trainingdata = sys_params["root_dir"] + "/" + sys_params["trainingdata_filename"]
+    dataset = add_missing_dataset_keys(dataset, dataset_params)
+
+    num_examples = dataset_params["num_examples"]
+    is_complete = np.zeros(num_examples, dtype=bool)
+    is_complete[:dataset["num_evaluated"]] = True
+
+    pending = list(range(dataset["num_evaluated"], num_examples))
+    harvested = nrw.harvest_completed_examples(pending, dataset, dataset_params, sys_params, facility_spec)
+    is_complete[harvested] = True
+    print("Harvested " + str(len(harvested)) + " completed examples from the run directories")
+
+    remaining = list(np.where(~is_complete)[0])
+    missing_decks = [iex for iex in remaining if not idg.run_files_exist(iex, dataset_params, sys_params)]
+    if len(missing_decks) > 0:
+        print("Regenerating decks for " + str(len(missing_decks)) + " examples")
+        deck_gen_params = idg.create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec,
+                                               example_indices=missing_decks)
+
+    if sys_params["run_sims"]:
+        for ir in range(0, len(remaining), sys_params["num_parallel_ifriits"]):
+            batch = remaining[ir:ir+sys_params["num_parallel_ifriits"]]
+            dataset = run_and_delete_indices(batch, dataset, dataset_params, sys_params, facility_spec)
+            is_complete[batch] = True
+
+            if sys_params["run_checkpoint"]:
+                # num_evaluated counts the completed prefix, later examples are found again by the scan
+                dataset["num_evaluated"] = completed_prefix(is_complete)
+                print("Save training data checkpoint at run: " + str(dataset["num_evaluated"] - 1))
+                nrw.save_general_netcdf(dataset, filename_trainingdata)
+
+    dataset["num_evaluated"] = completed_prefix(is_complete)
+    nrw.save_general_netcdf(dataset, filename_trainingdata)
+
     return dataset
 
 
@@ -192,7 +344,18 @@ def main(argv):
         deck_gen_params = idg.create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec)
         idg.save_data_dicts_to_file(sys_params, dataset, dataset_params, deck_gen_params, facility_spec)
 
-    if (run_type=="restart") or (run_type=="full"):
+    if run_type=="extend":
+        dataset, dataset_params, deck_gen_params, facility_spec = idg.load_data_dicts_from_file(sys_params)
+        dataset, dataset_params, deck_gen_params = extend_dataset_random_inputs(dataset, dataset_params, deck_gen_params,
+                                                                                facility_spec, int(argv[2]))
+        deck_gen_params = idg.create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec)
+        idg.save_data_dicts_to_file(sys_params, dataset, dataset_params, deck_gen_params, facility_spec)
+
+    if run_type=="resume":
+        dataset, dataset_params, deck_gen_params, facility_spec = idg.load_data_dicts_from_file(sys_params)
+        dataset = resume_training_data(dataset, dataset_params, deck_gen_params, sys_params, facility_spec)
+
+    if (run_type=="restart") or (run_type=="full") or (run_type=="extend"):
         dataset, dataset_params, deck_gen_params, facility_spec = idg.load_data_dicts_from_file(sys_params)
         generate_training_data(dataset, dataset_params, sys_params, facility_spec)
 
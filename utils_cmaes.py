@@ -0,0 +1,176 @@
+import numpy as np
+
+
+def define_cmaes_params(num_dims, population_size, **kwargs):
+    cmaes_params = {}
+    cmaes_params["num_dims"] = num_dims
+    cmaes_params["population_size"] = population_size # candidates per generation (ask)
+    cmaes_params["sigma0"] = kwargs.get("sigma0", 0.2) # initial step size in units of the bounds
+    cmaes_params["max_restarts"] = kwargs.get("max_restarts", 4)
+    cmaes_params["ipop_factor"] = kwargs.get("ipop_factor", 2) # population growth at each restart
+    cmaes_params["tol_x"] = kwargs.get("tol_x", 1.0e-4) # restart once the search distribution is this narrow
+    cmaes_params["tol_fun"] = kwargs.get("tol_fun", 1.0e-10) # or the recent fitness range is this flat
+    cmaes_params["tol_condition"] = kwargs.get("tol_condition", 1.0e14)
+    cmaes_params["history_length"] = kwargs.get("history_length", 10) # generations in the flat fitness test
+    cmaes_params["num_warm_start"] = kwargs.get("num_warm_start", 0) # best dataset rows for the initial mean/covariance
+    return cmaes_params
+
+
+
+def scale_to_unit(X, pbounds):
+    return (X - pbounds[:,0]) / (pbounds[:,1] - pbounds[:,0])
+
+
+
+def scale_from_unit(X_unit, pbounds):
+    return pbounds[:,0] + X_unit * (pbounds[:,1] - pbounds[:,0])
+
+
+
+def selection_weights(num_selected):
+    weights = np.log(num_selected + 0.5) - np.log(np.arange(1, num_selected + 1))
+    return weights / np.sum(weights)
+
+
+
+def initialise_cmaes(cmaes_params, pbounds, random_generator, population_size=None, X_warm=None, target_warm=None):
+    # Hansen's tutorial, maximising, in the unit box of pbounds. Warm-started from the spread of the best
+    # rows of X_warm, otherwise the mean is drawn uniformly
+    n = cmaes_params["num_dims"]
+    lam = population_size if population_size is not None else cmaes_params["population_size"]
+    lam = max(lam, 4)
+    mu = lam // 2
+
+    es = {}
+    es["pbounds"] = pbounds
+    es["random_generator"] = random_generator
+    es["population_size"] = lam
+    es["num_selected"] = mu
+    es["weights"] = selection_weights(mu)
+    mueff = 1.0 / np.sum(es["weights"]**2)
+    es["mueff"] = mueff
+    es["cc"] = (4.0 + mueff / n) / (n + 4.0 + 2.0 * mueff / n)
+    es["cs"] = (mueff + 2.0) / (n + mueff + 5.0)
+    es["c1"] = 2.0 / ((n + 1.3)**2 + mueff)
+    es["cmu"] = min(1.0 - es["c1"], 2.0 * (mueff - 2.0 + 1.0 / mueff) / ((n + 2.0)**2 + mueff))
+    es["damps"] = 1.0 + 2.0 * max(0.0, np.sqrt((mueff - 1.0) / (n + 1.0)) - 1.0) + es["cs"]
+    es["chiN"] = np.sqrt(n) * (1.0 - 1.0 / (4.0 * n) + 1.0 / (21.0 * n**2))
+
+    es["mean"] = random_generator.random(n)
+    es["sigma"] = cmaes_params["sigma0"]
+    es["C"] = np.eye(n)
+    if (X_warm is not None) and (np.shape(X_warm)[0] >= 2):
+        order = np.argsort(-np.array(target_warm), kind="stable")
+        X_best = scale_to_unit(np.array(X_warm)[order,:], pbounds)
+        weights = selection_weights(np.shape(X_best)[0])
+        es["mean"] = np.matmul(weights, X_best)
+        deviation = X_best - es["mean"]
+        covariance = np.matmul(deviation.T * weights, deviation)
+        variance = max(np.trace(covariance) / n, 1.0e-12)
+        es["sigma"] = min(max(np.sqrt(variance), 10.0 * cmaes_params["tol_x"]), cmaes_params["sigma0"])
+        # keep some of the isotropic search so directions the best rows never moved along are explored
+        es["C"] = 0.5 * covariance / variance + 0.5 * np.eye(n)
+
+    es["pc"] = np.zeros(n)
+    es["ps"] = np.zeros(n)
+    es["generation"] = 0
+    es["fitness_history"] = []
+    es = eigen_decomposition(es)
+    return es
+
+
+
+CMAES_STATE_KEYS = ["population_size", "num_selected", "weights", "mueff", "cc", "cs", "c1", "cmu", "damps", "chiN",
+                    "mean", "sigma", "C", "B", "D", "inv_sqrt_C", "pc", "ps", "generation", "fitness_history"]
+
+
+
+def cmaes_state(es):
+    # the arrays and numbers of es that restore_cmaes needs, for optimiser checkpoints
+    state = {key: es[key] for key in CMAES_STATE_KEYS}
+    state["fitness_history"] = np.array(es["fitness_history"], dtype=float)
+    return state
+
+
+
+def restore_cmaes(state, pbounds, random_generator):
+    es = {key: state[key] for key in CMAES_STATE_KEYS if key in state.keys()}
+    es["pbounds"] = pbounds
+    es["random_generator"] = random_generator
+    es["population_size"] = int(es["population_size"])
+    es["num_selected"] = int(es["num_selected"])
+    es["generation"] = int(es["generation"])
+    es["fitness_history"] = list(state.get("fitness_history", []))
+    return es
+
+
+
+def eigen_decomposition(es):
+    es["C"] = 0.5 * (es["C"] + es["C"].T)
+    eigenvalues, es["B"] = np.linalg.eigh(es["C"])
+    es["D"] = np.sqrt(np.maximum(eigenvalues, 1.0e-20))
+    es["inv_sqrt_C"] = np.matmul(es["B"] / es["D"], es["B"].T)
+    return es
+
+
+
+def ask(es):
+    # X_unit is the unbounded sample used in the update, X the candidates clipped to pbounds that are run
+    n = np.shape(es["mean"])[0]
+    Z = es["random_generator"].standard_normal((es["population_size"], n))
+    X_unit = es["mean"] + es["sigma"] * np.matmul(Z * es["D"], es["B"].T)
+    X = scale_from_unit(np.clip(X_unit, 0.0, 1.0), es["pbounds"])
+    return X_unit, X
+
+
+
+def tell(es, X_unit, fitness):
+    # clipped candidates are penalised by their squared distance outside the box in units of sigma,
+    # scaled by the fitness spread
+    fitness = np.array(fitness, dtype=float)
+    outside = np.sum((X_unit - np.clip(X_unit, 0.0, 1.0))**2, axis=1) / es["sigma"]**2
+    spread = np.max(fitness) - np.min(fitness) + 1.0e-30
+    penalised = fitness - spread * outside
+
+    n = np.shape(es["mean"])[0]
+    order = np.argsort(-penalised, kind="stable")[:es["num_selected"]]
+    mean_old = es["mean"]
+    es["mean"] = np.matmul(es["weights"], X_unit[order,:])
+    step = (es["mean"] - mean_old) / es["sigma"]
+
+    es["ps"] = (1.0 - es["cs"]) * es["ps"] + np.sqrt(es["cs"] * (2.0 - es["cs"]) * es["mueff"]) * np.matmul(es["inv_sqrt_C"], step)
+    es["generation"] += 1
+    ps_norm = np.linalg.norm(es["ps"]) / np.sqrt(1.0 - (1.0 - es["cs"])**(2 * es["generation"]))
+    hsig = float(ps_norm / es["chiN"] < 1.4 + 2.0 / (n + 1.0))
+    es["pc"] = (1.0 - es["cc"]) * es["pc"] + hsig * np.sqrt(es["cc"] * (2.0 - es["cc"]) * es["mueff"]) * step
+
+    Y = (X_unit[order,:] - mean_old) / es["sigma"]
+    es["C"] = ((1.0 - es["c1"] - es["cmu"]) * es["C"]
+               + es["c1"] * (np.outer(es["pc"], es["pc"]) + (1.0 - hsig) * es["cc"] * (2.0 - es["cc"]) * es["C"])
+               + es["cmu"] * np.matmul(Y.T * es["weights"], Y))
+    es["sigma"] *= np.exp((es["cs"] / es["damps"]) * (np.linalg.norm(es["ps"]) / es["chiN"] - 1.0))
+    es["sigma"] = min(es["sigma"], 1.0)
+    es = eigen_decomposition(es)
+
+    es["fitness_history"].append(np.max(fitness))
+    es["fitness_history"].append(np.min(fitness))
+    return es
+
+
+
+def should_restart(es, cmaes_params):
+    if es["sigma"] * np.max(es["D"]) < cmaes_params["tol_x"]:
+        return "tol_x"
+    if (np.max(es["D"]) / np.min(es["D"]))**2 > cmaes_params["tol_condition"]:
+        return "tol_condition"
+    history = es["fitness_history"][-2 * cmaes_params["history_length"]:]
+    if (len(history) == 2 * cmaes_params["history_length"]) and (np.max(history) - np.min(history) < cmaes_params["tol_fun"]):
+        return "tol_fun"
+    return ""
+
+
+
+def restart(es, cmaes_params):
+    # IPOP: a fresh search from a random mean with a larger population
+    population_size = es["population_size"] * cmaes_params["ipop_factor"]
+    return initialise_cmaes(cmaes_params, es["pbounds"], es["random_generator"], population_size=population_size)
@@ -2,11 +2,17 @@ import os
 import shutil
 import numpy as np
 import csv
+import hashlib
+import json
+import tempfile
 import healpy_pointings as hpoint
 import netcdf_read_write as nrw
 
+FACILITY_CACHE_VERSION = 1
+FACILITY_CACHE_DIR = "facility_spec_cache"
 
-def create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec):
+
+def create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec, example_indices=None):
 
     num_input_params = dataset_params["num_input_params"]
     num_examples = dataset_params["num_examples"]
@@ -17,7 +23,10 @@ def create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facil
 
     num_ifriit_beams = int(facility_spec['nbeams'] / facility_spec['beams_per_ifriit_beam'])
 
-    for iex in range(dataset["num_evaluated"], num_examples):
+    if example_indices is None:
+        example_indices = range(dataset["num_evaluated"], num_examples)
+
+    for iex in example_indices:
         ex_params = dataset["input_parameters"][iex,:]
         for icone in range(facility_spec['num_cones']):
             il = (icone*num_vars) % num_input_params
@@ -105,6 +114,16 @@ def create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facil
 
 
 
+def run_files_exist(iex, dataset_params, sys_params):
+    config_location = sys_params["root_dir"] + "/" + sys_params["config_dir"] + str(iex)
+    for tind in range(dataset_params["num_profiles_per_config"]):
+        run_location = config_location + "/" + sys_params["sim_dir"] + str(tind)
+        if not os.path.exists(run_location + "/ifriit_inputs.txt"):
+            return False
+    return True
+
+
+
 def load_data_dicts_from_file(sys_params):
 
     root_dir = sys_params["root_dir"]
@@ -168,8 +187,7 @@ def import_nif_config():
 
     filename1 = "NIF_UpperBeams.txt"
     filename2 = "NIF_LowerBeams.txt"
-    facility_spec = config_read_csv(facility_spec, filename1, filename2)
-    facility_spec = config_formatting(facility_spec)
+    facility_spec = config_read_cached(facility_spec, filename1, filename2)
 
     return facility_spec
 
@@ -191,13 +209,90 @@ def import_lmj_config():
 
     filename1 = "LMJ_UpperBeams.txt"
     filename2 = "LMJ_LowerBeams.txt"
+    facility_spec = config_read_cached(facility_spec, filename1, filename2)
+
+    return facility_spec
+
+
+
+def config_read_cached(facility_spec, filename1, filename2, cache_dir=FACILITY_CACHE_DIR):
+    # the beam tables from a binary cache, rebuilt when its version or the checksum of the text files
+    # and facility settings does not match
+    checksum = facility_checksum(facility_spec, filename1, filename2)
+    cache_location = cache_dir + "/" + facility_spec['facility'] + "_v" + str(FACILITY_CACHE_VERSION)
+
+    cached_arrays = load_facility_cache(cache_location, checksum)
+    if cached_arrays is not None:
+        facility_spec.update(cached_arrays)
+        return facility_spec
+
+    scalar_keys = list(facility_spec.keys())
     facility_spec = config_read_csv(facility_spec, filename1, filename2)
     facility_spec = config_formatting(facility_spec)
+    array_keys = [key for key in facility_spec.keys() if key not in scalar_keys]
+    try:
+        save_facility_cache(cache_location, checksum, facility_spec, array_keys)
+    except OSError as err:
+        print("Could not write facility cache: ", err)
 
     return facility_spec
 
 
 
+def facility_checksum(facility_spec, filename1, filename2):
+    checksum = hashlib.sha256()
+    checksum.update(str(FACILITY_CACHE_VERSION).encode())
+    for key in ('facility', 'nbeams', 'num_cones', 'beams_per_ifriit_beam', 'quad_from_each_cone'):
+        checksum.update(str(facility_spec[key]).encode())
+    for filename in (filename1, filename2):
+        with open(filename, "rb") as f:
+            checksum.update(f.read())
+    return checksum.hexdigest()
+
+
+
+def load_facility_cache(cache_location, checksum):
+    try:
+        with open(cache_location + "/cache_meta.json", "r") as f:
+            cache_meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (cache_meta.get("version") != FACILITY_CACHE_VERSION) or (cache_meta.get("checksum") != checksum):
+        return None
+
+    cached_arrays = {}
+    try:
+        for key in cache_meta["keys"]:
+            # memory mapped, read-only views of the cached arrays
+            cached_arrays[key] = np.load(cache_location + "/" + key + ".npy", mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    return cached_arrays
+
+
+
+def save_facility_cache(cache_location, checksum, facility_spec, array_keys):
+    cache_dir = os.path.dirname(cache_location)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # write to a temporary directory and rename so concurrent workers never see a partial cache
+    tmp_location = tempfile.mkdtemp(dir=cache_dir)
+    for key in array_keys:
+        np.save(tmp_location + "/" + key + ".npy", np.asarray(facility_spec[key]))
+    cache_meta = {"version": FACILITY_CACHE_VERSION, "checksum": checksum, "keys": array_keys}
+    with open(tmp_location + "/cache_meta.json", "w") as f:
+        json.dump(cache_meta, f)
+
+    if os.path.exists(cache_location):
+        shutil.rmtree(cache_location, ignore_errors=True)
+    try:
+        os.rename(tmp_location, cache_location)
+    except OSError:
+        # another worker created the cache first
+        shutil.rmtree(tmp_location, ignore_errors=True)
+
+
+
 def config_read_csv(facility_spec, filename1, filename2):
     num_ifriit_beams = int(facility_spec['nbeams'] / facility_spec['beams_per_ifriit_beam'])
     j = -1
@@ -0,0 +1,321 @@
+import numpy as np
+from scipy.linalg import cho_solve, solve_triangular
+from scipy.optimize import minimize
+from scipy.stats import norm
+import utils_neighbour_index as uknn
+
+
+def define_gp_params(num_dims, **kwargs):
+    gp_params = {}
+    gp_params["num_dims"] = num_dims
+    gp_params["length_scales"] = np.full(num_dims, kwargs.get("length_scale", 0.2)) # in units of the bounds
+    gp_params["signal_variance"] = kwargs.get("signal_variance", 1.0)
+    gp_params["noise_variance"] = kwargs.get("noise_variance", 1.0e-4) # relative to the normalised target
+    gp_params["length_scale_bounds"] = kwargs.get("length_scale_bounds", [1.0e-2, 1.0e1])
+    gp_params["signal_variance_bounds"] = kwargs.get("signal_variance_bounds", [1.0e-2, 1.0e2])
+    gp_params["noise_variance_bounds"] = kwargs.get("noise_variance_bounds", [1.0e-6, 1.0e0])
+    gp_params["refit_every"] = kwargs.get("refit_every", 5) # rounds between hyperparameter fits
+    gp_params["max_fit_points"] = kwargs.get("max_fit_points", 500) # subset for the marginal likelihood
+    gp_params["max_global_points"] = kwargs.get("max_global_points", 2000) # beyond this a local GP is used
+    gp_params["local_num_points"] = kwargs.get("local_num_points", 500) # nearest points in the local GP
+    gp_params["trust_region_length"] = kwargs.get("trust_region_length", 0.4) # local candidate box side
+    gp_params["num_candidates"] = kwargs.get("num_candidates", 2048) # acquisition evaluated on these
+    gp_params["num_top_points"] = kwargs.get("num_top_points", 5) # candidates are also drawn around these
+    gp_params["xi"] = kwargs.get("xi", 0.0) # expected improvement exploration margin
+    return gp_params
+
+
+
+def matern52_kernel(X1, X2, length_scales, signal_variance):
+    # ARD Matern 5/2 covariance between the rows of X1 and X2
+    X1_scaled = X1 / length_scales
+    X2_scaled = X2 / length_scales
+    sq_dist = (np.sum(X1_scaled**2, axis=1)[:,np.newaxis] + np.sum(X2_scaled**2, axis=1)[np.newaxis,:]
+               - 2.0 * np.matmul(X1_scaled, X2_scaled.T))
+    r = np.sqrt(5.0 * np.maximum(sq_dist, 0.0))
+    return signal_variance * (1.0 + r + r**2 / 3.0) * np.exp(-r)
+
+
+
+def gp_fit(X, y, gp_params):
+    # inputs X (num points, num dims) in the unit box, the targets y are normalised inside gp_solve
+    gp = {}
+    gp["X"] = np.array(X, dtype=float)
+    gp["y"] = np.array(y, dtype=float)
+    gp["length_scales"] = np.array(gp_params["length_scales"], dtype=float)
+    gp["signal_variance"] = float(gp_params["signal_variance"])
+    gp["noise_variance"] = float(gp_params["noise_variance"])
+    K = matern52_kernel(gp["X"], gp["X"], gp["length_scales"], gp["signal_variance"])
+    K[np.diag_indices_from(K)] += gp["noise_variance"]
+    gp["L"] = jittered_cholesky(K, gp["noise_variance"])
+    gp = gp_solve(gp)
+    return gp
+
+
+
+def jittered_cholesky(K, noise_variance, max_tries=6):
+    # near-duplicate points at a small noise variance can make K numerically singular
+    jitter = 0.0
+    for itry in range(max_tries):
+        try:
+            return np.linalg.cholesky(K + jitter * np.eye(np.shape(K)[0]))
+        except np.linalg.LinAlgError:
+            jitter = max(10.0 * jitter, noise_variance, 1.0e-10)
+    return np.linalg.cholesky(K + jitter * np.eye(np.shape(K)[0]))
+
+
+
+def gp_solve(gp):
+    gp["y_mean"] = np.mean(gp["y"])
+    gp["y_std"] = max(np.std(gp["y"]), 1.0e-12)
+    gp["alpha"] = cho_solve((gp["L"], True), (gp["y"] - gp["y_mean"]) / gp["y_std"])
+    return gp
+
+
+
+def gp_append(gp, X_new, y_new):
+    # rank-k update of the Cholesky factor, O(n^2 k). gp is not modified, so fantasies can go on a copy
+    X_new = np.atleast_2d(np.array(X_new, dtype=float))
+    K12 = matern52_kernel(gp["X"], X_new, gp["length_scales"], gp["signal_variance"])
+    K22 = matern52_kernel(X_new, X_new, gp["length_scales"], gp["signal_variance"])
+    K22[np.diag_indices_from(K22)] += gp["noise_variance"]
+    L12 = solve_triangular(gp["L"], K12, lower=True)
+    try:
+        L22 = np.linalg.cholesky(K22 - np.matmul(L12.T, L12))
+    except np.linalg.LinAlgError:
+        # e.g. a Kriging believer fantasy on top of an existing point, refactorise with jitter
+        gp_params = {"length_scales":gp["length_scales"], "signal_variance":gp["signal_variance"],
+                     "noise_variance":gp["noise_variance"]}
+        return gp_fit(np.vstack((gp["X"], X_new)), np.concatenate((gp["y"], np.atleast_1d(y_new))), gp_params)
+
+    num_old = np.shape(gp["L"])[0]
+    num_new = np.shape(X_new)[0]
+    updated = dict(gp)
+    updated["L"] = np.zeros((num_old + num_new, num_old + num_new))
+    updated["L"][:num_old,:num_old] = gp["L"]
+    updated["L"][num_old:,:num_old] = L12.T
+    updated["L"][num_old:,num_old:] = L22
+    updated["X"] = np.vstack((gp["X"], X_new))
+    updated["y"] = np.concatenate((gp["y"], np.atleast_1d(y_new)))
+    updated = gp_solve(updated)
+    return updated
+
+
+
+def gp_predict(gp, X_star):
+    # posterior mean and standard deviation in the units of y
+    K_star = matern52_kernel(gp["X"], X_star, gp["length_scales"], gp["signal_variance"])
+    mean = np.matmul(K_star.T, gp["alpha"])
+    v = solve_triangular(gp["L"], K_star, lower=True)
+    variance = np.maximum(gp["signal_variance"] - np.sum(v**2, axis=0), 1.0e-12)
+    return mean * gp["y_std"] + gp["y_mean"], np.sqrt(variance) * gp["y_std"]
+
+
+
+def negative_log_marginal_likelihood(log_hyperparams, X, y_norm):
+    num_dims = np.shape(X)[1]
+    length_scales = np.exp(log_hyperparams[:num_dims])
+    signal_variance = np.exp(log_hyperparams[num_dims])
+    noise_variance = np.exp(log_hyperparams[num_dims+1])
+    K = matern52_kernel(X, X, length_scales, signal_variance)
+    K[np.diag_indices_from(K)] += noise_variance
+    try:
+        L = np.linalg.cholesky(K)
+    except np.linalg.LinAlgError:
+        return 1.0e10
+    alpha = cho_solve((L, True), y_norm)
+    return 0.5 * np.dot(y_norm, alpha) + np.sum(np.log(np.diag(L))) + 0.5 * len(y_norm) * np.log(2.0 * np.pi)
+
+
+
+def fit_hyperparameters(X, y, gp_params, random_generator):
+    # maximum marginal likelihood on at most max_fit_points points (the best half and a random sample
+    # of the rest), gp_params is updated in place
+    num_points = np.shape(X)[0]
+    max_fit_points = gp_params["max_fit_points"]
+    if num_points > max_fit_points:
+        order = np.argsort(-y)
+        best = order[:max_fit_points // 2]
+        rest = random_generator.choice(order[max_fit_points // 2:], max_fit_points - len(best), replace=False)
+        subset = np.concatenate((best, rest))
+        X = X[subset,:]
+        y = y[subset]
+    y_norm = (y - np.mean(y)) / max(np.std(y), 1.0e-12)
+
+    num_dims = gp_params["num_dims"]
+    log_hyperparams = np.log(np.concatenate((gp_params["length_scales"],
+                                             [gp_params["signal_variance"], gp_params["noise_variance"]])))
+    bounds = ([tuple(np.log(gp_params["length_scale_bounds"]))] * num_dims
+              + [tuple(np.log(gp_params["signal_variance_bounds"])), tuple(np.log(gp_params["noise_variance_bounds"]))])
+    result = minimize(negative_log_marginal_likelihood, log_hyperparams, args=(X, y_norm),
+                      method="L-BFGS-B", bounds=bounds)
+    if np.isfinite(result.fun):
+        gp_params["length_scales"] = np.exp(result.x[:num_dims])
+        gp_params["signal_variance"] = float(np.exp(result.x[num_dims]))
+        gp_params["noise_variance"] = float(np.exp(result.x[num_dims+1]))
+    return gp_params
+
+
+
+def expected_improvement(mean, std_dev, best_target, xi):
+    improvement = mean - best_target - xi
+    z = improvement / std_dev
+    return improvement * norm.cdf(z) + std_dev * norm.pdf(z)
+
+
+
+def initialise_bayesian_optimiser(X, target, gp_params, pbounds, random_generator):
+    # one Gaussian process updated incrementally up to max_global_points observations, beyond that a
+    # local one around the incumbent for each batch (a trust region)
+    bo_state = {}
+    bo_state["gp_params"] = gp_params
+    bo_state["pbounds"] = np.array(pbounds, dtype=float)
+    bo_state["random_generator"] = random_generator
+    bo_state["X"] = scale_to_unit(np.array(X, dtype=float), bo_state["pbounds"]) # not a masked array read from NetCDF
+    bo_state["target"] = np.array(target, dtype=float)
+    bo_state["num_rounds"] = 0
+    unit_bounds = np.zeros((gp_params["num_dims"], 2))
+    unit_bounds[:,1] = 1.0
+    bo_state["index"] = uknn.create_index(unit_bounds, uknn.define_index_params(), bo_state["X"])
+    bo_state = refit_bayesian_optimiser(bo_state)
+    return bo_state
+
+
+
+def bayesian_optimiser_state(bo_state):
+    # the arrays and numbers that restore_bayesian_optimiser needs, for optimiser checkpoints
+    state = {}
+    state["X"] = bo_state["X"]
+    state["target"] = bo_state["target"]
+    state["num_rounds"] = bo_state["num_rounds"]
+    state["length_scales"] = bo_state["gp_params"]["length_scales"]
+    state["signal_variance"] = bo_state["gp_params"]["signal_variance"]
+    state["noise_variance"] = bo_state["gp_params"]["noise_variance"]
+    if bo_state["gp"] is not None:
+        for key, item in bo_state["gp"].items():
+            state["gp_" + key] = item
+    return state
+
+
+
+def restore_bayesian_optimiser(state, gp_params, pbounds, random_generator):
+    # the fitted hyperparameters and the Gaussian process are restored rather than refitted
+    gp_params["length_scales"] = np.array(state["length_scales"], dtype=float)
+    gp_params["signal_variance"] = float(state["signal_variance"])
+    gp_params["noise_variance"] = float(state["noise_variance"])
+    bo_state = {}
+    bo_state["gp_params"] = gp_params
+    bo_state["pbounds"] = np.array(pbounds, dtype=float)
+    bo_state["random_generator"] = random_generator
+    bo_state["X"] = np.array(state["X"], dtype=float)
+    bo_state["target"] = np.array(state["target"], dtype=float)
+    bo_state["num_rounds"] = int(state["num_rounds"])
+    unit_bounds = np.zeros((gp_params["num_dims"], 2))
+    unit_bounds[:,1] = 1.0
+    bo_state["index"] = uknn.create_index(unit_bounds, uknn.define_index_params(), bo_state["X"])
+    bo_state["gp"] = None
+    if "gp_L" in state.keys():
+        bo_state["gp"] = {key[len("gp_"):]: item for key, item in state.items() if key.startswith("gp_")}
+    return bo_state
+
+
+
+def scale_to_unit(X, pbounds):
+    return (np.atleast_2d(X) - pbounds[:,0]) / (pbounds[:,1] - pbounds[:,0])
+
+
+
+def scale_from_unit(X_unit, pbounds):
+    return pbounds[:,0] + X_unit * (pbounds[:,1] - pbounds[:,0])
+
+
+
+def refit_bayesian_optimiser(bo_state):
+    gp_params = bo_state["gp_params"]
+    finite = np.isfinite(bo_state["target"])
+    X = bo_state["X"][finite,:]
+    target = bo_state["target"][finite]
+    gp_params = fit_hyperparameters(X, target, gp_params, bo_state["random_generator"])
+    if np.shape(X)[0] <= gp_params["max_global_points"]:
+        bo_state["gp"] = gp_fit(X, target, gp_params)
+    else:
+        bo_state["gp"] = None
+    return bo_state
+
+
+
+def local_gaussian_process(bo_state):
+    # the nearest points to the incumbent, in length-scale units, and the trust region around it
+    gp_params = bo_state["gp_params"]
+    finite = np.isfinite(bo_state["target"])
+    incumbent = bo_state["X"][np.argmax(np.where(finite, bo_state["target"], -np.inf)),:]
+    nearest = uknn.index_nearest_scaled(bo_state["index"], incumbent, gp_params["local_num_points"] + np.sum(~finite),
+                                        gp_params["length_scales"])
+    nearest = nearest[finite[nearest]][:gp_params["local_num_points"]]
+    gp = gp_fit(bo_state["X"][nearest,:], bo_state["target"][nearest], gp_params)
+
+    half_width = 0.5 * gp_params["trust_region_length"] * gp_params["length_scales"] / np.exp(np.mean(np.log(gp_params["length_scales"])))
+    trust_region = np.zeros((gp_params["num_dims"], 2))
+    trust_region[:,0] = np.clip(incumbent - half_width, 0.0, 1.0)
+    trust_region[:,1] = np.clip(incumbent + half_width, 0.0, 1.0)
+    return gp, trust_region
+
+
+
+def acquisition_candidates(gp, region, gp_params, random_generator):
+    # uniform in the region plus gaussian perturbations of the best observations
+    num_candidates = gp_params["num_candidates"]
+    num_uniform = num_candidates // 2
+    candidates = region[:,0] + random_generator.random((num_uniform, gp_params["num_dims"])) * (region[:,1] - region[:,0])
+
+    top = np.argsort(-gp["y"])[:gp_params["num_top_points"]]
+    centres = gp["X"][random_generator.choice(top, num_candidates - num_uniform),:]
+    perturbed = centres + random_generator.standard_normal(np.shape(centres)) * 0.25 * gp_params["length_scales"]
+    perturbed = np.clip(perturbed, region[:,0], region[:,1])
+    return np.vstack((candidates, perturbed))
+
+
+
+def suggest_batch(bo_state, batch_size):
+    # Kriging believer: each point of maximum expected improvement is added as a fantasy at its
+    # posterior mean before the next one is chosen
+    gp_params = bo_state["gp_params"]
+    if bo_state["gp"] is not None:
+        gp = bo_state["gp"]
+        region = np.zeros((gp_params["num_dims"], 2))
+        region[:,1] = 1.0
+    else:
+        gp, region = local_gaussian_process(bo_state)
+
+    best_target = np.max(gp["y"])
+    X_batch = np.zeros((batch_size, gp_params["num_dims"]))
+    for ib in range(batch_size):
+        candidates = acquisition_candidates(gp, region, gp_params, bo_state["random_generator"])
+        mean, std_dev = gp_predict(gp, candidates)
+        acquisition = expected_improvement(mean, std_dev, best_target, gp_params["xi"] * gp["y_std"])
+        ibest = np.argmax(acquisition)
+        X_batch[ib,:] = candidates[ibest,:]
+        gp = gp_append(gp, candidates[ibest:ibest+1,:], mean[ibest:ibest+1])
+
+    return scale_from_unit(X_batch, bo_state["pbounds"])
+
+
+
+def register_observations(bo_state, X_new, target_new):
+    # non-finite targets (broken runs) are kept out of the Gaussian process
+    X_new = scale_to_unit(np.array(X_new, dtype=float), bo_state["pbounds"])
+    target_new = np.array(target_new, dtype=float)
+    bo_state["X"] = np.vstack((bo_state["X"], X_new))
+    bo_state["index"] = uknn.index_append(bo_state["index"], X_new)
+    bo_state["target"] = np.concatenate((bo_state["target"], target_new))
+    bo_state["num_rounds"] += 1
+
+    finite = np.isfinite(target_new)
+    num_points = np.sum(np.isfinite(bo_state["target"]))
+    if (bo_state["num_rounds"] % bo_state["gp_params"]["refit_every"] == 0) or (bo_state["gp"] is None and num_points <= bo_state["gp_params"]["max_global_points"]):
+        bo_state = refit_bayesian_optimiser(bo_state)
+    elif num_points > bo_state["gp_params"]["max_global_points"]:
+        bo_state["gp"] = None
+    elif np.any(finite):
+        bo_state["gp"] = gp_append(bo_state["gp"], X_new[finite,:], target_new[finite])
+    return bo_state
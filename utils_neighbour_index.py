@@ -0,0 +1,157 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+def define_index_params(**kwargs):
+    index_params = {}
+    index_params["buffer_size"] = kwargs.get("buffer_size", 64) # appended points searched by brute force before a tree is built
+    index_params["tolerance"] = kwargs.get("tolerance", 1.0e-4) # duplicate distance in units of the bounds
+    index_params["redirect_distance"] = kwargs.get("redirect_distance", 2.0e-4) # a duplicate is moved this far
+    index_params["max_redirects"] = kwargs.get("max_redirects", 20)
+    return index_params
+
+
+
+def create_index(pbounds, index_params, X=None):
+    # inputs scaled to the unit box of pbounds. Full buffers become KD-trees merged like a binary counter,
+    # so an append is amortised O(log N). Ids are the order of appending, the dataset rows
+    index = dict(index_params)
+    index["pbounds"] = np.array(pbounds, dtype=float)
+    index["num_dims"] = np.shape(index["pbounds"])[0]
+    index["levels"] = [] # (tree, ids), largest first
+    index["buffer_X"] = np.zeros((0, index["num_dims"]))
+    index["buffer_ids"] = np.zeros(0, dtype=int)
+    index["num_points"] = 0
+    index["points"] = np.zeros((index["buffer_size"], index["num_dims"])) # by id, grown by doubling
+    if X is not None:
+        index = index_append(index, X)
+    return index
+
+
+
+def scale_to_unit(X, pbounds):
+    return (np.atleast_2d(X) - pbounds[:,0]) / (pbounds[:,1] - pbounds[:,0])
+
+
+
+def scale_from_unit(X_unit, pbounds):
+    return pbounds[:,0] + X_unit * (pbounds[:,1] - pbounds[:,0])
+
+
+
+def index_append(index, X, is_unit=False):
+    X_unit = np.array(X, dtype=float).reshape((-1, index["num_dims"]))
+    if not is_unit:
+        X_unit = scale_to_unit(X_unit, index["pbounds"])
+    ids = index["num_points"] + np.arange(np.shape(X_unit)[0])
+    index["buffer_X"] = np.vstack((index["buffer_X"], X_unit))
+    index["buffer_ids"] = np.concatenate((index["buffer_ids"], ids))
+    index["num_points"] += len(ids)
+    if index["num_points"] > np.shape(index["points"])[0]:
+        points = np.zeros((max(2 * np.shape(index["points"])[0], index["num_points"]), index["num_dims"]))
+        points[:ids[0],:] = index["points"][:ids[0],:]
+        index["points"] = points
+    index["points"][ids,:] = X_unit
+
+    if len(index["buffer_ids"]) >= index["buffer_size"]:
+        index["levels"].append((cKDTree(index["buffer_X"]), index["buffer_ids"]))
+        index["buffer_X"] = np.zeros((0, index["num_dims"]))
+        index["buffer_ids"] = np.zeros(0, dtype=int)
+        # merge equal sized trees, the sizes stay powers of two times buffer_size
+        while (len(index["levels"]) >= 2) and (index["levels"][-1][0].n >= index["levels"][-2][0].n):
+            tree_small, ids_small = index["levels"].pop()
+            tree_large, ids_large = index["levels"].pop()
+            index["levels"].append((cKDTree(np.vstack((tree_large.data, tree_small.data))),
+                                    np.concatenate((ids_large, ids_small))))
+    return index
+
+
+
+def index_query(index, X, k=1, is_unit=False):
+    # distances (in units of the bounds) and ids of the k nearest points, padded with inf and -1
+    X_unit = np.array(X, dtype=float).reshape((-1, index["num_dims"]))
+    if not is_unit:
+        X_unit = scale_to_unit(X_unit, index["pbounds"])
+    num_rows = np.shape(X_unit)[0]
+    distances = [np.full((num_rows, k), np.inf)]
+    ids = [np.full((num_rows, k), -1)]
+
+    for tree, tree_ids in index["levels"]:
+        kk = min(k, tree.n)
+        tree_distances, positions = tree.query(X_unit, k=kk)
+        distances.append(tree_distances.reshape((num_rows, kk)))
+        ids.append(tree_ids[positions.reshape((num_rows, kk))])
+    if len(index["buffer_ids"]) > 0:
+        buffer_distances = np.sqrt(np.sum((X_unit[:,np.newaxis,:] - index["buffer_X"][np.newaxis,:,:])**2, axis=2))
+        distances.append(buffer_distances)
+        ids.append(np.broadcast_to(index["buffer_ids"], np.shape(buffer_distances)))
+
+    distances = np.hstack(distances)
+    ids = np.hstack(ids)
+    nearest = np.argsort(distances, axis=1, kind="stable")[:,:k]
+    return np.take_along_axis(distances, nearest, axis=1), np.take_along_axis(ids, nearest, axis=1)
+
+
+
+def index_query_ball(index, x_unit, radius):
+    # ids of the indexed points within radius of the point x_unit
+    ids = [tree_ids[tree.query_ball_point(x_unit, radius)] for tree, tree_ids in index["levels"]]
+    if len(index["buffer_ids"]) > 0:
+        inside = np.sum((index["buffer_X"] - x_unit)**2, axis=1) <= radius**2
+        ids.append(index["buffer_ids"][inside])
+    return np.concatenate(ids + [np.zeros(0, dtype=int)]).astype(int)
+
+
+
+def index_nearest_scaled(index, x_unit, k, length_scales):
+    # the k nearest in the unscaled distance bound a ball holding the k nearest in the ARD scaled one
+    k = min(k, index["num_points"])
+    _, ids = index_query(index, x_unit, k=k, is_unit=True)
+    X_near = index_points(index, ids[0])
+    max_scaled = np.sqrt(np.max(np.sum(((X_near - x_unit) / length_scales)**2, axis=1)))
+    candidates = index_query_ball(index, x_unit, max_scaled * np.max(length_scales) * (1.0 + 1.0e-12))
+    scaled = np.sum(((index_points(index, candidates) - x_unit) / length_scales)**2, axis=1)
+    return candidates[np.argsort(scaled, kind="stable")[:k]]
+
+
+
+def index_points(index, ids):
+    # unit box coordinates of the points with ids
+    return index["points"][np.array(ids, dtype=int),:]
+
+
+
+def find_duplicates(index, X, tolerance=None):
+    # rows of X within tolerance of an indexed point or of an earlier row of X
+    tolerance = index["tolerance"] if tolerance is None else tolerance
+    X_unit = scale_to_unit(np.array(X, dtype=float).reshape((-1, index["num_dims"])), index["pbounds"])
+    distances, _ = index_query(index, X_unit, k=1, is_unit=True)
+    is_duplicate = distances[:,0] <= tolerance
+    for i, j in cKDTree(X_unit).query_pairs(tolerance):
+        is_duplicate[max(i, j)] = True
+    return is_duplicate
+
+
+
+def redirect_duplicates(index, X, random_generator):
+    # rows within tolerance of an indexed point or an earlier row are moved by redirect_distance in a random
+    # direction until they are not, then every row is appended
+    X_unit = scale_to_unit(np.array(X, dtype=float).reshape((-1, index["num_dims"])), index["pbounds"])
+    if not np.any(find_duplicates(index, X)):
+        index = index_append(index, X_unit, is_unit=True)
+        return scale_from_unit(X_unit, index["pbounds"]), 0
+
+    num_redirected = 0
+    for i in range(np.shape(X_unit)[0]):
+        distances, _ = index_query(index, X_unit[i,:], k=1, is_unit=True)
+        if distances[0,0] <= index["tolerance"]:
+            num_redirected += 1
+            for attempt in range(index["max_redirects"]):
+                direction = random_generator.standard_normal(index["num_dims"])
+                candidate = np.clip(X_unit[i,:] + index["redirect_distance"] * direction / np.linalg.norm(direction), 0.0, 1.0)
+                distances, _ = index_query(index, candidate, k=1, is_unit=True)
+                if distances[0,0] > index["tolerance"]:
+                    break
+            X_unit[i,:] = candidate
+        index = index_append(index, X_unit[i,:], is_unit=True)
+    return scale_from_unit(X_unit, index["pbounds"]), num_redirected
@@ -1,12 +1,14 @@
-#some code copied from https://github.com/fmfn/BayesianOptimization edited by Duncan Barlow
 #some code copied from https://github.com/ahmedfgad/GeneticAlgorithmPython/tree/master/Tutorial%20Project edited by Duncan Barlow
-#from bayes_opt import BayesianOptimization, UtilityFunction
 import numpy as np
 import training_data_generation as tdg
 import netcdf_read_write as nrw
 import utils_deck_generation as idg
 import time
 import sys
+import os
+import json
+import heapq
+from concurrent.futures import Future
 
 
 
@@ -28,6 +30,7 @@ def define_optimizer_parameters(run_dir, num_optimization_params,
     optimizer_params["num_init_examples"] = num_init_examples
     optimizer_params["n_iter"] = n_iter
     optimizer_params["run_clean"] = run_clean
+    optimizer_params["random_seed"] = random_seed
     optimizer_params["random_generator"] = np.random.default_rng(random_seed)
     optimizer_params["fitness_desired_power_per_steradian"] = facility_spec['nbeams'] \
         * facility_spec['default_power'] * 1.0e12 / (4.0 * np.pi)
@@ -36,6 +39,8 @@ def define_optimizer_parameters(run_dir, num_optimization_params,
     optimizer_params["fitness_desired_rms"] = 0.05
     optimizer_params["fitness_norm_factor"] = 0.5
     optimizer_params["printout_iteration_skip"] = 1
+    optimizer_params["dedup_tolerance"] = 1.0e-4 # candidates this close to an evaluated input (in units of the bounds) are moved, 0 turns it off
+    optimizer_params["promote_fraction"] = 1.0 # below 1 only this fraction of solid-sphere screened runs get the plasma profiles
 
     pbounds = np.zeros((optimizer_params["num_optimization_params"], 2))
     pbounds[:,1] = 1.0
@@ -44,47 +49,264 @@ def define_optimizer_parameters(run_dir, num_optimization_params,
 
 
 
-def fitness_function(dataset, opt_params):
+OPTIMIZER_STATE_FILENAME = "optimizer_state.nc"
+OPTIMIZER_STAGES = ["genetic_algorithm", "bayesian_optimisation", "gradient_ascent", "cmaes", "nsga2"] # the order main runs them
+
+
+
+def fitness_function(dataset, opt_params, rows=None):
+    # all rows by default, the dataset is not modified and broken runs score as zero mean pressure
+    rows = slice(None) if rows is None else rows
     target_rms = opt_params["fitness_desired_rms"]
     norm_factor = opt_params["fitness_norm_factor"]
     number_of_timesteps = np.shape(dataset["rms"][:,:])[1]
 
     if number_of_timesteps == 1:
         target_flux = opt_params["fitness_desired_power_per_steradian"]
-        rms = dataset["rms"][:,0]
-        avg_flux = dataset["avg_flux"][:,0]
+        rms = dataset["rms"][rows,0]
+        avg_flux = dataset["avg_flux"][rows,0]
     else:
         target_flux = opt_params["fitness_desired_pressure_mbar"]
-        rms = np.sqrt(np.sum(dataset["rms"][:,:]**2, axis=1) / float(number_of_timesteps))
-        avg_flux = dataset["avg_flux"][:,1]
-        indices = np.where(np.array(avg_flux) > opt_params["fitness_limit_broken_pressure_mbar"])[0]
-        print("Fitness function detects broken runs: ", indices)
-        avg_flux[indices] = 0.0
+        rms = np.sqrt(np.sum(dataset["rms"][rows,:]**2, axis=1) / float(number_of_timesteps))
+        avg_flux = np.where(broken_runs(dataset, opt_params, rows), 0.0, dataset["avg_flux"][rows,1])
 
     maxi_func = np.exp(-(rms/target_rms) + (avg_flux / target_flux)) * (avg_flux / target_flux) * norm_factor
+    if "fidelity" in dataset.keys():
+        maxi_func[np.array(dataset["fidelity"][rows]) < number_of_timesteps] = 0.0 # only screened, never fully run
     return maxi_func
 
 
 
-def run_ifriit_input(num_new_examples, X_all, opt_params):
+def broken_runs(dataset, opt_params, rows=None):
+    # with the plasma profiles, a mean pressure above fitness_limit_broken_pressure_mbar is unphysical
+    rows = slice(None) if rows is None else rows
+    if np.shape(dataset["rms"][:,:])[1] == 1:
+        return np.zeros(np.shape(dataset["rms"][rows,0]), dtype=bool)
+    return np.array(dataset["avg_flux"][rows,1]) > opt_params["fitness_limit_broken_pressure_mbar"]
+
+
+
+def pareto_objectives(dataset, opt_params, rows=None):
+    # the rms and minus the drive (num rows, 2), both minimised. Screened, broken, non-finite and unread
+    # runs (zero rms and drive) get inf so they are never on the front
+    rows = slice(None) if rows is None else rows
+    number_of_timesteps = np.shape(dataset["rms"][:,:])[1]
+    if number_of_timesteps == 1:
+        rms = dataset["rms"][rows,0]
+        drive = dataset["avg_flux"][rows,0]
+    else:
+        rms = np.sqrt(np.sum(dataset["rms"][rows,:]**2, axis=1) / float(number_of_timesteps))
+        drive = dataset["avg_flux"][rows,1]
+    objectives = np.column_stack((np.array(rms, dtype=float), -np.array(drive, dtype=float)))
+
+    invalid = broken_runs(dataset, opt_params, rows) | ~np.all(np.isfinite(objectives), axis=1)
+    invalid = invalid | (np.all(np.array(dataset["rms"][rows,:]) == 0.0, axis=1) & (objectives[:,1] == 0.0))
+    if "fidelity" in dataset.keys():
+        invalid = invalid | (np.array(dataset["fidelity"][rows]) < number_of_timesteps)
+    objectives[invalid,:] = np.inf
+    return objectives
+
+
+
+def define_fitness_tracker(num_best=10):
+    fitness_tracker = {}
+    fitness_tracker["num_best"] = num_best
+    fitness_tracker["fitness"] = np.zeros(1024) # by row, grown by doubling
+    fitness_tracker["num_rows"] = 0
+    fitness_tracker["best_heap"] = [] # (fitness, -row) of the num_best fittest rows, smallest first
+    fitness_tracker["broken_runs"] = set()
+    return fitness_tracker
+
+
+
+def tracked_fitness(dataset, opt_params):
+    # only the rows evaluated since the last call are computed. opt_params["fitness_tracker"] holds the
+    # fitness by row, a heap of the fittest rows and the broken runs, the result is a read-only view
+    fitness_tracker = opt_params.get("fitness_tracker", None)
+    num_evaluated = dataset["num_evaluated"]
+    if (fitness_tracker is None) or (fitness_tracker["num_rows"] > num_evaluated):
+        fitness_tracker = define_fitness_tracker()
+        opt_params["fitness_tracker"] = fitness_tracker
+
+    first_row = fitness_tracker["num_rows"]
+    if num_evaluated > first_row:
+        if num_evaluated > np.shape(fitness_tracker["fitness"])[0]:
+            fitness = np.zeros(max(2 * np.shape(fitness_tracker["fitness"])[0], num_evaluated))
+            fitness[:first_row] = fitness_tracker["fitness"][:first_row]
+            fitness_tracker["fitness"] = fitness
+        new_fitness = np.ma.getdata(fitness_function(dataset, opt_params, slice(first_row, num_evaluated)))
+        fitness_tracker["fitness"][first_row:num_evaluated] = new_fitness
+
+        # the fittest new rows, earlier rows first on ties as np.argmax, non-finite rows are never the best
+        heap = fitness_tracker["best_heap"]
+        for row in np.argsort(-new_fitness, kind="stable")[:fitness_tracker["num_best"]]:
+            if np.isfinite(new_fitness[row]):
+                item = (new_fitness[row], -(first_row + row))
+                if len(heap) < fitness_tracker["num_best"]:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        broken = first_row + np.where(broken_runs(dataset, opt_params, slice(first_row, num_evaluated)))[0]
+        if len(broken) > 0:
+            print("Fitness function detects broken runs: ", broken)
+            fitness_tracker["broken_runs"].update(broken.tolist())
+        fitness_tracker["num_rows"] = num_evaluated
+
+    target = fitness_tracker["fitness"][:num_evaluated]
+    target.flags.writeable = False
+    return target
+
+
+
+def best_fitness_rows(opt_params):
+    # the rows of the num_best fittest examples seen by tracked_fitness, the best first
+    return [-item[1] for item in sorted(opt_params["fitness_tracker"]["best_heap"], reverse=True)]
+
+
+
+def best_fitness_row(opt_params):
+    # as np.argmax of tracked_fitness, row 0 if no fitness is finite
+    rows = best_fitness_rows(opt_params)
+    return rows[0] if len(rows) > 0 else 0
+
+
+
+def screening_fitness(dataset, opt_params):
+    # fitness of the solid-sphere run alone, used to choose which examples get the expensive runs
+    target_rms = opt_params["fitness_desired_rms"]
+    target_flux = opt_params["fitness_desired_power_per_steradian"]
+    rms = dataset["rms"][:,0]
+    avg_flux = dataset["avg_flux"][:,0]
+    return np.exp(-(rms/target_rms) + (avg_flux / target_flux)) * (avg_flux / target_flux) * opt_params["fitness_norm_factor"]
+
+
+
+def run_ifriit_input(num_new_examples, X_all, opt_params, redirect_duplicates=True):
+    # runs X_all after the evaluated examples. On resuming, rows already saved are not run again and
+    # finished runs are harvested. Gradient stencils and line searches are not redirected as duplicates
     sys_params = tdg.define_system_params(opt_params["run_dir"])
     sys_params["run_clean"] = opt_params["run_clean"] # Create new run files
 
     dataset, dataset_params, deck_gen_params, facility_spec = idg.load_data_dicts_from_file(sys_params)
-    dataset_params["num_examples"] = dataset["num_evaluated"] + num_new_examples
-
     num_evaluated = dataset["num_evaluated"]
+    is_resuming = "resume_num_evaluated" in opt_params.keys()
+    first_new = opt_params.pop("resume_num_evaluated", num_evaluated)
+    num_done = num_evaluated - first_new
+    dataset_params["num_examples"] = first_new + num_new_examples
+
     dataset = expand_dataset(dataset, dataset_params, num_evaluated)
     deck_gen_params = expand_deck_gen_params(deck_gen_params, dataset_params, facility_spec, num_evaluated)
-    dataset["input_parameters"][dataset["num_evaluated"]:,:] = X_all
+    if (opt_params["dedup_tolerance"] > 0.0) and redirect_duplicates:
+        X_all = redirect_duplicate_inputs(X_all, dataset, first_new, opt_params)
+    if num_done > 0:
+        if not np.allclose(dataset["input_parameters"][first_new:num_evaluated,:], X_all[:num_done,:], rtol=0.0, atol=1.0e-6):
+            print("")
+            sys.exit("The examples run since the optimiser state was saved are not the ones proposed on resuming")
+        print("Resuming a batch of " + str(num_new_examples) + " examples, " + str(num_done) + " were already run")
+    dataset["input_parameters"][num_evaluated:,:] = X_all[num_done:,:]
+
+    if "objective_function" in opt_params.keys():
+        # a fast stand-in for the Ifriit runs, e.g. in optimizer_race
+        dataset = opt_params["objective_function"](dataset, num_evaluated, dataset_params["num_examples"])
+        dataset["num_evaluated"] = dataset_params["num_examples"]
+        idg.save_data_dicts_to_file(sys_params, dataset, dataset_params, deck_gen_params, facility_spec)
+        return reload_dataset(opt_params, dataset["num_evaluated"])
+
+    if is_resuming:
+        # decks written before the interruption are kept, the runs that finished are harvested from them
+        missing_decks = [iex for iex in range(num_evaluated, dataset_params["num_examples"])
+                         if not idg.run_files_exist(iex, dataset_params, sys_params)]
+        deck_gen_params = idg.create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec,
+                                               example_indices=missing_decks)
+    else:
+        deck_gen_params = idg.create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec)
+
+    if "surrogate_refresher" in opt_params.keys():
+        # the surrogate trains on the rows evaluated so far while the new ones run
+        import surrogate_refresh as sref
+        sref.submit_dataset(opt_params["surrogate_refresher"], dataset)
+
+    if (opt_params["promote_fraction"] < 1.0) and (dataset_params["num_profiles_per_config"] > 1):
+        nrw.save_general_netcdf(dataset_params, sys_params["root_dir"] + "/" + sys_params["dataset_params_filename"])
+        nrw.save_general_netcdf(facility_spec, sys_params["root_dir"] + "/" + sys_params["facility_spec_filename"])
+        dataset = tdg.screen_and_promote(range(num_evaluated, dataset_params["num_examples"]), dataset, dataset_params,
+                                         sys_params, facility_spec, lambda dataset: screening_fitness(dataset, opt_params),
+                                         opt_params["promote_fraction"])
+        dataset["num_evaluated"] = dataset_params["num_examples"]
+        nrw.save_general_netcdf(dataset, sys_params["root_dir"] + "/" + sys_params["trainingdata_filename"])
+    else:
+        if opt_params["promote_fraction"] < 1.0:
+            print("Screening needs the solid sphere and plasma profile runs (run_plasma_profile), every example is fully run")
+        if is_resuming:
+            tdg.resume_training_data(dataset, dataset_params, deck_gen_params, sys_params, facility_spec)
+        else:
+            tdg.generate_training_data(dataset, dataset_params, sys_params, facility_spec)
+            if not sys_params["run_checkpoint"]:
+                nrw.save_general_netcdf(dataset, sys_params["root_dir"] + "/" + sys_params["trainingdata_filename"])
+    return reload_dataset(opt_params, dataset_params["num_examples"])
+
 
-    deck_gen_params = idg.create_run_files(dataset, deck_gen_params, dataset_params, sys_params, facility_spec)
 
-    tdg.generate_training_data(dataset, dataset_params, sys_params, facility_spec)
+def optimizer_start_dataset(dataset, opt_params, resume_state):
+    # the saved dataset an optimiser starts or resumes from, so both start from the same values
+    num_evaluated = dataset["num_evaluated"] if resume_state is None else resume_state["num_evaluated"]
+    return reload_dataset(opt_params, num_evaluated)
+
+
+
+def reload_dataset(opt_params, num_evaluated):
+    # the saved (single precision) values, so a resumed run sees what the uninterrupted one saw, in double
+    # precision as small fitness values underflow in single
+    sys_params = tdg.define_system_params(opt_params["run_dir"])
+    dataset = nrw.read_general_netcdf(sys_params["root_dir"] + "/" + sys_params["trainingdata_filename"])
+    prohibited_list = dataset["non_expand_keys"]
+    for key, item in dataset.items():
+        if not any(x in key for x in prohibited_list):
+            item = np.ma.getdata(item[:num_evaluated])
+            dataset[key] = item.astype(float) if item.dtype.kind == "f" else item
+    dataset["num_evaluated"] = num_evaluated
     return dataset
 
 
 
+def neighbour_index(dataset, num_evaluated, opt_params):
+    # opt_params["neighbour_index"] after appending the rows evaluated since it was last used
+    import utils_neighbour_index as uknn
+
+    index = opt_params.get("neighbour_index", None)
+    if (index is None) or (index["num_points"] > num_evaluated):
+        index = empty_neighbour_index(opt_params)
+    if index["num_points"] < num_evaluated:
+        index = uknn.index_append(index, dataset["input_parameters"][index["num_points"]:num_evaluated,:])
+    opt_params["neighbour_index"] = index
+    return index
+
+
+
+def empty_neighbour_index(opt_params):
+    import utils_neighbour_index as uknn
+
+    index_params = uknn.define_index_params(tolerance=opt_params["dedup_tolerance"],
+                                            redirect_distance=2.0*opt_params["dedup_tolerance"])
+    return uknn.create_index(opt_params["pbounds"], index_params)
+
+
+
+def redirect_duplicate_inputs(X_all, dataset, num_evaluated, opt_params):
+    # X_all is changed in place, so the optimiser holds the inputs that are actually run
+    import utils_neighbour_index as uknn
+
+    index = neighbour_index(dataset, num_evaluated, opt_params)
+    X_new, num_redirected = uknn.redirect_duplicates(index, X_all, opt_params["random_generator"])
+    if num_redirected > 0:
+        print("Moved " + str(num_redirected) + " candidates within " + str(opt_params["dedup_tolerance"])
+              + " of an evaluated input")
+    X_all[...] = X_new.reshape(np.shape(X_all))
+    return X_all
+
+
+
 def expand_dataset(dataset_small, dataset_params, num_evaluated):
     dataset_big = tdg.define_dataset(dataset_params)
     dataset_big = expand_dict(dataset_big, dataset_small, num_evaluated)
@@ -104,15 +326,19 @@ def expand_dict(big_dictionary, small_dictionary, old_size):
     for key, item in big_dictionary.items():
         dims = np.shape(item)
         total_dims = np.shape(dims)[0]
+        if key not in small_dictionary.keys():
+            continue # added since the file was written, keeps its default
         if any(x in key for x in prohibited_list):#(key == "num_evaluated"):
             big_dictionary[key] = small_dictionary[key]
         else:
+            # the deck parameters file is not written by the asynchronous runs, so it can be shorter
+            num_rows = min(old_size, np.shape(small_dictionary[key])[0])
             if total_dims == 3:
-                big_dictionary[key][:old_size,:,:] = small_dictionary[key][:old_size,:,:]
+                big_dictionary[key][:num_rows,:,:] = small_dictionary[key][:num_rows,:,:]
             if total_dims == 2:
-                big_dictionary[key][:old_size,:] = small_dictionary[key][:old_size,:]
+                big_dictionary[key][:num_rows,:] = small_dictionary[key][:num_rows,:]
             if total_dims == 1:
-                big_dictionary[key][:old_size] = small_dictionary[key][:old_size]
+                big_dictionary[key][:num_rows] = small_dictionary[key][:num_rows]
     small_dictionary.clear()
     return big_dictionary
 
@@ -122,46 +348,199 @@ def printout_optimizer_iteration(tic, dataset, opt_params):
     toc = time.perf_counter()
     print("{:0.4f} seconds".format(toc - tic))
 
-    target = fitness_function(dataset, opt_params)
-    maxdex = np.argmax(target)
+    target = tracked_fitness(dataset, opt_params)
+    maxdex = best_fitness_row(opt_params)
     print(maxdex)
     print(target[maxdex])
     print(dataset["rms"][maxdex,:])
 
+def prepare_async_runs(num_new_examples, opt_params, resume_state=None):
+    # the dataset extended by num_new_examples rows for submit_async_run. On resuming, the rows that were
+    # submitted are kept and num_new_examples counts from the saved num_evaluated
+    async_runs = {}
+    sys_params = tdg.define_system_params(opt_params["run_dir"])
+    sys_params["run_clean"] = opt_params["run_clean"] # Create new run files
+
+    dataset, dataset_params, deck_gen_params, facility_spec = idg.load_data_dicts_from_file(sys_params)
+    num_evaluated = dataset["num_evaluated"]
+    num_submitted = num_evaluated
+    if resume_state is not None:
+        num_evaluated = resume_state["num_evaluated"]
+        num_submitted = int(resume_state["num_submitted"])
+    dataset_params["num_examples"] = num_evaluated + num_new_examples
+
+    async_runs["dataset"] = expand_dataset(dataset, dataset_params, num_submitted)
+    async_runs["deck_gen_params"] = expand_deck_gen_params(deck_gen_params, dataset_params, facility_spec, num_evaluated)
+    async_runs["dataset_params"] = dataset_params
+    async_runs["facility_spec"] = facility_spec
+    async_runs["sys_params"] = sys_params
+    async_runs["filename_trainingdata"] = sys_params["root_dir"] + "/" + sys_params["trainingdata_filename"]
+    async_runs["is_complete"] = np.zeros(dataset_params["num_examples"], dtype=bool)
+    async_runs["is_complete"][:num_evaluated] = True
+    async_runs["num_submitted"] = num_submitted
+    async_runs["objective_function"] = opt_params.get("objective_function", None)
+    async_runs["opt_params"] = opt_params
+    if resume_state is not None:
+        async_runs["is_complete"][:num_submitted] |= np.array(resume_state["is_complete"], dtype=bool)[:num_submitted]
+        async_runs["dataset"]["num_evaluated"] = tdg.completed_prefix(async_runs["is_complete"])
+    if opt_params["dedup_tolerance"] > 0.0:
+        # running examples count as evaluated, their inputs are appended as they are submitted
+        neighbour_index(async_runs["dataset"], num_submitted, opt_params)
+
+    nrw.save_general_netcdf(dataset_params, sys_params["root_dir"] + "/" + sys_params["dataset_params_filename"])
+    nrw.save_general_netcdf(facility_spec, sys_params["root_dir"] + "/" + sys_params["facility_spec_filename"])
+    return async_runs
+
+
+
+def harvest_interrupted_runs(async_runs):
+    # the submitted examples that finished after the state was saved, the rest have to be run again
+    interrupted = [iex for iex in range(async_runs["num_submitted"]) if not async_runs["is_complete"][iex]]
+    if (len(interrupted) == 0) or (async_runs["objective_function"] is not None):
+        return [], interrupted
+    harvested = nrw.harvest_completed_examples(interrupted, async_runs["dataset"], async_runs["dataset_params"],
+                                               async_runs["sys_params"], async_runs["facility_spec"])
+    async_runs["is_complete"][harvested] = True
+    async_runs["dataset"]["num_evaluated"] = tdg.completed_prefix(async_runs["is_complete"])
+    return harvested, [iex for iex in interrupted if iex not in harvested]
+
+
+
+def submit_async_run(executor, iex, X_new, async_runs, is_rerun=False):
+    # writes the decks of example iex and starts its simulations on a free executor thread
+    opt_params = async_runs["opt_params"]
+    if (opt_params["dedup_tolerance"] > 0.0) and not is_rerun: # a rerun's inputs are already indexed
+        X_new = redirect_duplicate_inputs(np.array(X_new, dtype=float).reshape((1, -1)), async_runs["dataset"],
+                                          opt_params["neighbour_index"]["num_points"], opt_params)
+    async_runs["dataset"]["input_parameters"][iex,:] = X_new
+    if async_runs["objective_function"] is not None:
+        # evaluated in harvest_async_run instead
+        future = Future()
+        future.set_result(0.0)
+        return future
+    async_runs["deck_gen_params"] = idg.create_run_files(async_runs["dataset"], async_runs["deck_gen_params"],
+                                                         async_runs["dataset_params"], async_runs["sys_params"],
+                                                         async_runs["facility_spec"], example_indices=[iex])
+    return executor.submit(tdg.run_indices, [iex], async_runs["dataset_params"], async_runs["sys_params"],
+                           async_runs["facility_spec"])
+
+
+
+def harvest_async_run(iex, async_runs, cost=0.0):
+    # reads example iex into the dataset on the calling thread, so the NetCDF reads are never concurrent.
+    # num_evaluated counts the completed prefix, as in tdg.resume_training_data
+    if async_runs["objective_function"] is not None:
+        dataset = async_runs["objective_function"](async_runs["dataset"], iex, iex+1)
+    else:
+        dataset = nrw.retrieve_xtrain_and_delete(iex, iex, async_runs["dataset"], async_runs["dataset_params"],
+                                                 async_runs["sys_params"], async_runs["facility_spec"])
+    dataset["cost"][iex] += cost
+    async_runs["is_complete"][iex] = True
+    dataset["num_evaluated"] = tdg.completed_prefix(async_runs["is_complete"])
+    return dataset
+
+
+
+def save_async_runs(async_runs):
+    nrw.save_general_netcdf(async_runs["dataset"], async_runs["filename_trainingdata"])
+
+
+
+def save_optimizer_state(dataset, opt_params, stage, iteration, state, finished=False):
+    # state, the random generator, the duplicate index points and num_evaluated, in double precision
+    checkpoint = {}
+    for key, item in state.items():
+        if np.ndim(item) > 0:
+            if np.size(item) > 0: # NetCDF has no empty dimensions, restored as missing
+                checkpoint["state_" + key] = np.array(item, dtype=float)
+        else:
+            checkpoint["state_" + key] = item
+    checkpoint["stage"] = stage
+    checkpoint["iteration"] = int(iteration)
+    checkpoint["finished"] = int(finished)
+    checkpoint["num_evaluated"] = int(dataset["num_evaluated"])
+    checkpoint["random_state"] = json.dumps(opt_params["random_generator"].bit_generator.state)
+    index = opt_params.get("neighbour_index", None)
+    if (index is not None) and (index["num_points"] > 0):
+        checkpoint["neighbour_points"] = index["points"][:index["num_points"],:]
+
+    filename = opt_params["run_dir"] + "/" + OPTIMIZER_STATE_FILENAME
+    nrw.save_general_netcdf(checkpoint, filename + ".tmp", float_type='f8')
+    os.replace(filename + ".tmp", filename)
+
+
+
+def read_optimizer_state(run_dir):
+    # the last state written by save_optimizer_state, None if there is none
+    filename = run_dir + "/" + OPTIMIZER_STATE_FILENAME
+    if not os.path.exists(filename):
+        print("No optimizer state in " + run_dir + ", starting afresh")
+        return None
+    checkpoint = nrw.read_general_netcdf(filename)
+    print("Optimizer state saved after iteration " + str(checkpoint["iteration"]) + " of " + checkpoint["stage"])
+    return checkpoint
+
+
+
+def stage_finished(checkpoint, stage):
+    # stages before the saved one, or the saved one if it ran to the end, are skipped on resuming
+    if checkpoint is None:
+        return False
+    saved = OPTIMIZER_STAGES.index(checkpoint["stage"])
+    return (saved > OPTIMIZER_STAGES.index(stage)) or ((saved == OPTIMIZER_STAGES.index(stage)) and (checkpoint["finished"] == 1))
+
+
+
+def resume_optimizer_state(checkpoint, opt_params, stage):
+    # restores the random generator and duplicate index if stage was interrupted and returns its state,
+    # None if it starts afresh
+    if (checkpoint is None) or (checkpoint["stage"] != stage) or (checkpoint["finished"] == 1):
+        return None
+    opt_params["random_generator"].bit_generator.state = json.loads(checkpoint["random_state"])
+    if "neighbour_points" in checkpoint.keys():
+        import utils_neighbour_index as uknn
+        index = empty_neighbour_index(opt_params)
+        opt_params["neighbour_index"] = uknn.index_append(index, np.ma.getdata(checkpoint["neighbour_points"]), is_unit=True)
+    # the next run_ifriit_input continues the batch that was running
+    opt_params["resume_num_evaluated"] = int(checkpoint["num_evaluated"])
+
+    state = {}
+    for key, item in checkpoint.items():
+        if key.startswith("state_"):
+            state[key[len("state_"):]] = np.array(np.ma.getdata(item), dtype=float) if np.ndim(item) > 0 else item
+    state["iteration"] = int(checkpoint["iteration"])
+    state["num_evaluated"] = int(checkpoint["num_evaluated"])
+    print("Resuming " + stage + " from iteration " + str(state["iteration"]))
+    return state
+
 #################################### Bayesian Optimization #############################################
 
-def define_bayesian_optimisation_params(ifriit_runs_per_iteration, target_set_undetermined, num_mutations):
+def define_bayesian_optimisation_params(ifriit_runs_per_iteration, num_optimization_params):
+    # the Gaussian process and its batch acquisition are in utils_gaussian_process
+    import utils_gaussian_process as ugp
+
     bo_params = {}
-    bo_params["target_set_undetermined"] = target_set_undetermined
-    bo_params["num_mutations"] = num_mutations
-    bo_params["mutation_amplitude"] = 0.25
     bo_params["ifriit_runs_per_iteration"] = ifriit_runs_per_iteration
+    bo_params["gp_params"] = ugp.define_gp_params(num_optimization_params)
 
     return bo_params
 
+def define_cmaes_optimisation_params(ifriit_runs_per_iteration, num_optimization_params):
+    # the evolution strategy itself is in utils_cmaes
+    import utils_cmaes as ucma
 
-def initialize_unknown_func(input_data, target, pbounds, init_points, num_inputs):
+    cmaes_params = ucma.define_cmaes_params(num_optimization_params, ifriit_runs_per_iteration,
+                                            num_warm_start=max(ifriit_runs_per_iteration, 2))
+    return cmaes_params
 
-    sys.exit("Bayesian optimization intentionally removed! Find this line to re-add")
-    optimizer = {}#BayesianOptimization(f=None,pbounds=pbounds,random_state=1)
-    utility = {}#UtilityFunction(kind = "ucb", kappa = 2.5, xi = 0.0)
 
-    # initial data points
-    params = {}
-    for ieval in range(init_points):
-        # put data in dict
-        for ii in range(num_inputs):
-            params["x"+str(ii)] = input_data[ieval, ii]
-        # add to optimizer
-        try:
-            optimizer.register(params = params, target = target[ieval])
-        except:
-            print("Broken input!", input_data[ieval, :])
-        if ieval%100 <= 0.0:
-            print(str(ieval) + " initialization data points added")
-    print(str(ieval) + " initialization data points added")
-
-    return optimizer, utility
+
+def define_nsga2_optimisation_params(ifriit_runs_per_iteration, num_optimization_params):
+    # the sorting and the Pareto archive are in utils_pareto
+    import utils_pareto as upar
+
+    nsga2_params = upar.define_nsga2_params(num_optimization_params, max(ifriit_runs_per_iteration, 4))
+    return nsga2_params
 
 ######################################## Gradient Descent ############################################
 
@@ -247,6 +626,16 @@ def grad_ascent(X_old, grad, step_size, pbounds, num_inputs, num_steps_per_iter)
 
     return X_new
 
+
+
+def speculative_gradient_batch(X_old, grad, step_size, predicted_step, learning_rate, pbounds,
+                               num_inputs, num_steps_per_iter, stencil_size):
+    # the line search from X_old along grad and the stencil around its step predicted_step, in one batch
+    X_line = grad_ascent(X_old, grad, step_size, pbounds, num_inputs, num_steps_per_iter)
+    X_stencil = gradient_stencil(X_line[predicted_step:predicted_step+1,:], learning_rate, pbounds,
+                                 num_inputs, stencil_size)
+    return np.vstack((X_line, X_stencil))
+
 ###################################### Genetic Algorithm ##############################################
 # Taken from https://github.com/ahmedfgad/GeneticAlgorithmPython/blob/master/Tutorial%20Project/Example_GeneticAlgorithm.py
 # https://towardsdatascience.com/genetic-algorithm-implementation-in-python-5ab67bb124a6
@@ -257,52 +646,108 @@ def define_genetic_algorithm_params(init_points, num_parents_mating, num_mutatio
     ga_params["initial_pop_size"] = init_points
     ga_params["num_mutations"] = num_mutations
     ga_params["mutation_amplitude"] = 0.25 # multiplier for standard normal distribution
+    ga_params["crossover_method"] = "single_point" # "single_point", "uniform", "blend" or "sbx"
+    ga_params["blend_alpha"] = 0.5 # blend crossover: extension beyond the parents
+    ga_params["sbx_eta"] = 15.0 # simulated binary crossover: larger keeps offspring closer to parents
+    ga_params["tournament_size"] = 3 # steady-state mode: individuals compared per parent selection
+    ga_params["num_offspring"] = 0 # steady-state mode: total number of offspring evaluated
+    ga_params["num_slots"] = 0 # steady-state mode: simulations run at once, 0 for num_parallel_ifriits
     return ga_params
 
 
 
-def select_mating_pool(pop, fitness, num_parents):
-    # Selecting the best individuals in the current generation as parents for producing the offspring of the next generation.
-    parents = np.empty((num_parents, pop.shape[1]))
-    for parent_num in range(num_parents):
-        max_fitness_idx = np.where(fitness == np.max(fitness))
-        max_fitness_idx = max_fitness_idx[0][0]
-        parents[parent_num, :] = pop[max_fitness_idx, :]
-        fitness[max_fitness_idx] = -99999999999
-    return parents
+def tournament_selection(fitness, num_selected, tournament_size, rng):
+    # each selection is the fittest of tournament_size individuals drawn at random
+    contestants = rng.integers(0, len(fitness), (num_selected, tournament_size))
+    winners = contestants[np.arange(num_selected), np.argmax(fitness[contestants], axis=1)]
+    return winners
+
 
 
+def generation_generator(opt_params, generation):
+    # an independent stream per generation, so any generation can be reproduced on its own
+    return np.random.default_rng([opt_params["random_seed"], generation])
 
-def crossover(parents, offspring_size):
-    offspring = np.empty(offspring_size)
-    # The point at which crossover takes place between two parents. Usually, it is at the center.
-    crossover_point = np.uint8(offspring_size[1]/2)
 
-    for k in range(offspring_size[0]):
-        # Index of the first parent to mate.
-        parent1_idx = k%parents.shape[0]
-        # Index of the second parent to mate.
-        parent2_idx = (k+1)%parents.shape[0]
-        # The new offspring will have its first half of its genes taken from the first parent.
-        offspring[k, 0:crossover_point] = parents[parent1_idx, 0:crossover_point]
-        # The new offspring will have its second half of its genes taken from the second parent.
-        offspring[k, crossover_point:] = parents[parent2_idx, crossover_point:]
-    return offspring
+
+def select_mating_pool(pop, fitness, num_parents):
+    # Selecting the best individuals in the current generation as parents for producing the offspring of the next generation.
+    # found in O(pop) from the num_parents-th largest fitness, then ordered best first with ties
+    # going to the lowest index as in a repeated argmax
+    fitness = np.asarray(fitness)
+    kth_fitness = -np.partition(-fitness, num_parents - 1)[num_parents - 1]
+    above = np.where(fitness > kth_fitness)[0]
+    tied = np.where(fitness == kth_fitness)[0][:num_parents - len(above)]
+    best = np.concatenate((above, tied))
+    best = best[np.lexsort((best, -fitness[best]))]
+    return pop[best,:]
+
+
+
+def crossover(parents, offspring_size, method="single_point", rng=None, pbounds=None, blend_alpha=0.5, sbx_eta=15.0):
+    # offspring k mates parents k and k+1 (cyclically). single_point takes the first half of the genes
+    # from the first parent, uniform, blend (BLX-alpha) and sbx draw from rng and clip to pbounds
+    num_offspring = offspring_size[0]
+    num_genes = offspring_size[1]
+    parent1 = parents[np.arange(num_offspring) % parents.shape[0],:]
+    parent2 = parents[(np.arange(num_offspring) + 1) % parents.shape[0],:]
+
+    if method == "single_point":
+        # The point at which crossover takes place between two parents. Usually, it is at the center.
+        crossover_point = np.uint8(num_genes/2)
+        offspring = np.empty(offspring_size)
+        offspring[:,0:crossover_point] = parent1[:,0:crossover_point]
+        offspring[:,crossover_point:] = parent2[:,crossover_point:]
+        return offspring
+
+    if method == "uniform":
+        offspring = np.where(rng.random(offspring_size) < 0.5, parent1, parent2)
+    elif method == "blend":
+        u = rng.uniform(-blend_alpha, 1.0 + blend_alpha, offspring_size)
+        offspring = parent1 + u * (parent2 - parent1)
+    elif method == "sbx":
+        u = rng.random(offspring_size)
+        beta = np.where(u <= 0.5, (2.0 * u)**(1.0 / (sbx_eta + 1.0)),
+                        (1.0 / (2.0 * (1.0 - u)))**(1.0 / (sbx_eta + 1.0)))
+        # each offspring is one of the two SBX children at random
+        sign = np.where(rng.random((num_offspring, 1)) < 0.5, -1.0, 1.0)
+        offspring = 0.5 * ((parent1 + parent2) + sign * beta * (parent2 - parent1))
+    else:
+        sys.exit("Unknown crossover method: " + method)
+    return np.clip(offspring, pbounds[:,0], pbounds[:,1])
 
 
 
 def mutation(offspring_crossover, rng, pbounds, num_mutations=1, mutation_amplitude=1.0):
-    for idx in range(offspring_crossover.shape[0]):
-        for ind_mut in range(num_mutations):
-            gene_mutation_ind = int(np.round(rng.random()
-                                * (offspring_crossover.shape[1] - 1.0)))
-            random_value = rng.standard_normal() * mutation_amplitude
-            offspring_crossover[idx, gene_mutation_ind] += random_value
-            if offspring_crossover[idx, gene_mutation_ind] < pbounds[gene_mutation_ind, 0]:
-                offspring_crossover[idx, gene_mutation_ind] = pbounds[gene_mutation_ind, 0]
-            if offspring_crossover[idx, gene_mutation_ind] > pbounds[gene_mutation_ind, 1]:
-                offspring_crossover[idx, gene_mutation_ind] = pbounds[gene_mutation_ind, 1]
+    # num_mutations random genes of every individual receive a normal perturbation, each mutated gene
+    # is clipped to its bounds straight away as in the loop over individuals, other genes are not
+    num_offspring = offspring_crossover.shape[0]
+    gene_mutation_ind = np.round(rng.random((num_offspring, num_mutations))
+                                 * (offspring_crossover.shape[1] - 1.0)).astype(int)
+    random_value = rng.standard_normal((num_offspring, num_mutations)) * mutation_amplitude
+    rows = np.arange(num_offspring)
+    for ind_mut in range(num_mutations):
+        genes = gene_mutation_ind[:,ind_mut]
+        offspring_crossover[rows, genes] = np.clip(offspring_crossover[rows, genes] + random_value[:,ind_mut],
+                                                   pbounds[genes,0], pbounds[genes,1])
 
     return offspring_crossover
 
+
+
+def evolve_population(X_pop, fitness, ga_params, pbounds, rng):
+    # the best num_parents_mating are kept and the rest are replaced by their mutated offspring
+    pop_size = np.shape(X_pop)[0]
+    num_parents = ga_params["num_parents_mating"]
+    parents = select_mating_pool(X_pop, fitness, num_parents)
+    offspring = crossover(parents, offspring_size=(pop_size - num_parents, np.shape(X_pop)[1]),
+                          method=ga_params["crossover_method"], rng=rng, pbounds=pbounds,
+                          blend_alpha=ga_params["blend_alpha"], sbx_eta=ga_params["sbx_eta"])
+    offspring = mutation(offspring, rng, pbounds, num_mutations=ga_params["num_mutations"],
+                         mutation_amplitude=ga_params["mutation_amplitude"])
+    X_new = np.empty_like(X_pop)
+    X_new[:num_parents,:] = parents
+    X_new[num_parents:,:] = offspring
+    return X_new
+
 #####################################################################################
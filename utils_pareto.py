@@ -0,0 +1,165 @@
+import numpy as np
+import bisect
+import sys
+import netcdf_read_write as nrw
+
+
+def define_nsga2_params(num_dims, population_size, **kwargs):
+    nsga2_params = {}
+    nsga2_params["num_dims"] = num_dims
+    nsga2_params["population_size"] = population_size # offspring per generation, and the population kept
+    nsga2_params["sbx_eta"] = kwargs.get("sbx_eta", 15.0) # simulated binary crossover: larger keeps offspring closer to parents
+    nsga2_params["num_mutations"] = kwargs.get("num_mutations", max(1, num_dims // 4))
+    nsga2_params["mutation_amplitude"] = kwargs.get("mutation_amplitude", 0.1) # in units of the bounds
+    nsga2_params["archive_filename"] = kwargs.get("archive_filename", "pareto_archive.nc")
+    return nsga2_params
+
+
+
+def nondominated_sort(objectives):
+    # front of each row of objectives (num points, 2), both minimised, 0 for the non-dominated points.
+    # Each point in order of the first objective joins the first front, found by bisection, whose last
+    # point does not dominate it, O(n log n)
+    objectives = np.asarray(objectives, dtype=float)
+    fronts = np.zeros(np.shape(objectives)[0], dtype=int)
+    last_f1 = [] # the last point of each front, which has the front's smallest second objective
+    last_f2 = []
+    for i in np.lexsort((objectives[:,1], objectives[:,0])):
+        f1, f2 = objectives[i,0], objectives[i,1]
+        low, high = 0, len(last_f2)
+        while low < high:
+            mid = (low + high) // 2
+            if (last_f2[mid] < f2) or ((last_f2[mid] == f2) and (last_f1[mid] < f1)): # dominated
+                low = mid + 1
+            else:
+                high = mid
+        if low == len(last_f2):
+            last_f1.append(f1)
+            last_f2.append(f2)
+        else:
+            last_f1[low] = f1
+            last_f2[low] = f2
+        fronts[i] = low
+    return fronts
+
+
+
+def crowding_distance(objectives, fronts):
+    # the NSGA-II crowding distance within each front, infinite at the ends of a front
+    objectives = np.asarray(objectives, dtype=float)
+    distance = np.zeros(np.shape(objectives)[0])
+    for front in np.unique(fronts):
+        members = np.where(fronts == front)[0]
+        if len(members) <= 2:
+            distance[members] = np.inf
+            continue
+        for iobj in range(np.shape(objectives)[1]):
+            values = objectives[members,iobj]
+            order = np.argsort(values, kind="stable")
+            sorted_values = values[order]
+            span = sorted_values[-1] - sorted_values[0]
+            distance[members[order[[0, -1]]]] = np.inf
+            if np.isfinite(span) and (span > 0.0):
+                distance[members[order[1:-1]]] += (sorted_values[2:] - sorted_values[:-2]) / span
+    return distance
+
+
+
+def environmental_selection(objectives, num_selected):
+    # indices of the num_selected best points by front, then by crowding distance within the last front
+    fronts = nondominated_sort(objectives)
+    distance = crowding_distance(objectives, fronts)
+    order = np.lexsort((-distance, fronts))
+    return order[:num_selected]
+
+
+
+def binary_tournament(fronts, distance, num_selected, rng):
+    # each selection is the better of two at random, by front and then by crowding distance
+    contestants = rng.integers(0, len(fronts), (num_selected, 2))
+    first, second = contestants[:,0], contestants[:,1]
+    first_wins = (fronts[first] < fronts[second]) | ((fronts[first] == fronts[second]) & (distance[first] >= distance[second]))
+    return np.where(first_wins, first, second)
+
+
+
+def define_pareto_archive():
+    # non-dominated points sorted by the first objective, so an insertion is a bisection and the
+    # points it dominates are the ones that follow it
+    archive = {}
+    archive["f1"] = []
+    archive["f2"] = []
+    archive["rows"] = []
+    return archive
+
+
+
+def archive_insert(archive, objectives, rows):
+    # adds the dataset rows with these objectives, returns the number that joined the front
+    num_added = 0
+    for (f1, f2), row in zip(np.asarray(objectives, dtype=float), rows):
+        if not (np.isfinite(f1) and np.isfinite(f2)):
+            continue
+        i = bisect.bisect_left(archive["f1"], f1)
+        if (i > 0) and (archive["f2"][i-1] <= f2):
+            continue
+        if (i < len(archive["f1"])) and (archive["f1"][i] == f1) and (archive["f2"][i] < f2):
+            continue
+        # the points from i on have an equal or larger first objective, those not below f2 are
+        # dominated, unless equal to this point (then it dominates nothing in the archive)
+        j = i
+        while (j < len(archive["f2"])) and (archive["f2"][j] >= f2) and not ((archive["f1"][j] == f1) and (archive["f2"][j] == f2)):
+            j += 1
+        del archive["f1"][i:j], archive["f2"][i:j], archive["rows"][i:j]
+        archive["f1"].insert(i, f1)
+        archive["f2"].insert(i, f2)
+        archive["rows"].insert(i, int(row))
+        num_added += 1
+    return num_added
+
+
+
+def save_pareto_archive(archive, dataset, filename):
+    # the front as rms, drive and inputs, ordered by increasing rms
+    if len(archive["rows"]) == 0:
+        return
+    front = {}
+    front["rows"] = np.array(archive["rows"], dtype="i")
+    front["rms"] = np.array(archive["f1"])
+    front["drive"] = -np.array(archive["f2"])
+    front["input_parameters"] = np.array(dataset["input_parameters"][front["rows"],:])
+    nrw.save_general_netcdf(front, filename)
+
+
+
+def best_drive_within_rms(front, max_rms):
+    # the point of a saved front with the highest drive and an rms of at most max_rms, -1 if none
+    within = np.where(np.array(front["rms"]) <= max_rms)[0]
+    if len(within) == 0:
+        return -1
+    return within[np.argmax(np.array(front["drive"])[within])]
+
+
+
+def main(argv):
+    """
+    python utils_pareto.py Data_output 0.02
+    Prints the saved front, and the point with the highest drive below the rms bound if one is given.
+    """
+    front = nrw.read_general_netcdf(argv[1] + "/" + define_nsga2_params(1, 1)["archive_filename"])
+    for ipoint in range(len(front["rows"])):
+        print("Example {}: rms {:.3f} %, drive {:.4e}".format(front["rows"][ipoint], front["rms"][ipoint] * 100.0,
+                                                             front["drive"][ipoint]))
+    if len(argv) > 2:
+        ipoint = best_drive_within_rms(front, float(argv[2]))
+        if ipoint < 0:
+            print("No example on the front has an rms below " + argv[2])
+        else:
+            print("Highest drive with rms below " + argv[2] + ": example " + str(front["rows"][ipoint]))
+            print(front["input_parameters"][ipoint,:])
+    return front
+
+
+
+if __name__ == "__main__":
+    _ = main(sys.argv)
@@ -0,0 +1,95 @@
+import numpy as np
+import warnings
+
+# random_sampling options stored in dataset_params
+SAMPLER_LHS = 0
+SAMPLER_RANDOM = 1
+SAMPLER_SOBOL = 2
+SAMPLER_HALTON = 3
+
+
+
+def define_sampler_params(dataset_params):
+    # dataset_params is saved with the dataset so the sampler state is recorded with it
+    dataset_params["sampler_block_size"] = 1024
+    dataset_params["sampler_num_drawn"] = 0 # number of points drawn so far, used to extend a design
+    dataset_params["sampler_num_candidates"] = 4 # candidates per new point when extending a design
+    return dataset_params
+
+
+
+def block_generator(dataset_params, block_start):
+    # The first block uses the bare seed so a single block reproduces the original sampling
+    if block_start == 0:
+        return np.random.default_rng(dataset_params["random_seed"])
+    return np.random.default_rng([dataset_params["random_seed"], block_start])
+
+
+
+def draw_samples(dataset_params, num_samples):
+    # num_samples points in the unit hypercube, drawn in blocks. The sampler state in dataset_params
+    # is advanced so the next call continues the same design
+    num_dims = dataset_params["num_input_params"]
+    block_size = int(dataset_params.get("sampler_block_size", num_samples))
+    num_drawn = int(dataset_params.get("sampler_num_drawn", 0))
+    sampler_type = dataset_params["random_sampling"]
+
+    sample = np.zeros((num_samples, num_dims))
+    if num_samples <= 0:
+        return sample
+
+    if (sampler_type == SAMPLER_SOBOL) or (sampler_type == SAMPLER_HALTON):
+        from scipy.stats import qmc
+        if sampler_type == SAMPLER_SOBOL:
+            sampler = qmc.Sobol(d=num_dims, scramble=True, seed=dataset_params["random_seed"])
+        else:
+            sampler = qmc.Halton(d=num_dims, scramble=True, seed=dataset_params["random_seed"])
+        if num_drawn > 0:
+            sampler.fast_forward(num_drawn)
+        with warnings.catch_warnings():
+            # Sobol balance warning for n not a power of 2, the sequence is still valid
+            warnings.simplefilter("ignore", UserWarning)
+            for il in range(0, num_samples, block_size):
+                iu = min(il + block_size, num_samples)
+                sample[il:iu,:] = sampler.random(n=iu-il)
+    else:
+        for il in range(0, num_samples, block_size):
+            iu = min(il + block_size, num_samples)
+            random_generator = block_generator(dataset_params, num_drawn + il)
+            if sampler_type == SAMPLER_RANDOM:
+                sample[il:iu,:] = random_generator.random((iu-il, num_dims))
+            else:
+                from scipy.stats import qmc
+                sampler = qmc.LatinHypercube(d=num_dims, strength=1,
+                                             seed=random_generator, optimization="random-cd")
+                sample[il:iu,:] = sampler.random(n=iu-il)
+
+    dataset_params["sampler_num_drawn"] = num_drawn + num_samples
+    return sample
+
+
+
+def extend_samples(dataset_params, existing_inputs, num_new):
+    # num_new points, each the candidate furthest from existing_inputs and the points already accepted
+    from scipy.spatial import cKDTree
+
+    num_candidates = int(dataset_params.get("sampler_num_candidates", 4))
+    block_size = int(dataset_params.get("sampler_block_size", num_new))
+
+    accepted = np.array(existing_inputs, dtype=float).reshape((-1, dataset_params["num_input_params"]))
+    sample = np.zeros((num_new, dataset_params["num_input_params"]))
+    for il in range(0, num_new, block_size):
+        iu = min(il + block_size, num_new)
+        candidates = draw_samples(dataset_params, (iu - il) * num_candidates)
+        if np.shape(accepted)[0] > 0:
+            min_dist, _ = cKDTree(accepted).query(candidates)
+        else:
+            min_dist = np.full(np.shape(candidates)[0], np.inf)
+
+        for inew in range(il, iu):
+            ibest = np.argmax(min_dist)
+            sample[inew,:] = candidates[ibest,:]
+            min_dist = np.minimum(min_dist, np.sqrt(np.sum((candidates - candidates[ibest,:])**2, axis=1)))
+        accepted = np.vstack((accepted, sample[il:iu,:]))
+
+    return sample